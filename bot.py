@@ -1,35 +1,53 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from typing import List, Any, Callable, Tuple, Set
+from typing import List, Dict, Any, Callable, Tuple, Set, Optional
 
 from config import (SALT, WORKERS, AT_ADMINS_RATELIMIT, STORE_CHAT_MESSAGES,
                     GARBAGE_COLLECTION_INTERVAL, PICKLE_FILE, PERMIT_RELOAD,
-                    USER_BOT_BACKEND, DEBUG)
+                    USER_BOT_BACKEND, TOKEN, DEBUG)
+import config
+# settings added later are optional, an older config.py keeps working
+SQLITE_FILE: str = getattr(config, 'SQLITE_FILE', 'antispambot.sqlite')
+CLUSTER_PROCESSES: int = getattr(config, 'CLUSTER_PROCESSES', 1)
+WEBHOOK_URL: str = getattr(config, 'WEBHOOK_URL', '')
+WEBHOOK_LISTEN: str = getattr(config, 'WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT: int = getattr(config, 'WEBHOOK_PORT', 8443)
 from chatsettings import CHAT_SETTINGS as CHAT_SETTINGS_DEFAULT, CHAT_SETTINGS_HELP
 from importlib import reload
 import userfilter
 assert not [k for k in CHAT_SETTINGS_DEFAULT if k not in CHAT_SETTINGS_HELP]
 
 import logging
-from ratelimited import mqbot
-from telegram import Update, User, Bot, Message
-from telegram.ext import CallbackContext, Job, PicklePersistence
+import sys
+from collections import deque
+from threading import Lock
+from ratelimited import mqbot, action_queue, delayed_message, circuit_breaker, backoff_delay, CircuitOpenError, share_budget
+from telegram import Update, User, Bot, Message, ChatMember, ChatMemberUpdated, ChatJoinRequest, CallbackQuery
+from telegram.ext import CallbackContext
+from sqlitepersistence import SQLitePersistence
+from shards import ShardedDispatcher
+from webhook import MAX_UPDATE_AGE, WebhookReceiver, set_webhook, webhook_path, secret_token, serve
+from queue import Queue
 
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters,
-                          CallbackQueryHandler, run_async)
+                          CallbackQueryHandler, ChatMemberHandler, ChatJoinRequestHandler, JobQueue)
 from telegram.ext.filters import InvertedFilter
 
-from datetime import datetime, timedelta
+from datetime import datetime
 from time import time
 from telegram.error import (TelegramError, Unauthorized, BadRequest,
-                            TimedOut, ChatMigrated, NetworkError)
+                            TimedOut, NetworkError, RetryAfter)
 
 from mwt import MWT
-from utils import print_traceback, find_cjk_letters, is_spam_message, is_suspect_user
-from random import choice, randint, shuffle
-from hashlib import md5, sha256
-from threading import Lock
+from deadlines import DeadlineScheduler, Deadline
+from msgring import MessageRing
+from usermanager import restUser, UserManager
+from tokens import ChallengeTokens
+from chatconfig import ChatConfigs, ChallengeTemplate, button_width
+from concurrent.futures import Future
+from utils import print_traceback, scan_spam_features, is_suspect_user, score_cache
+from random import choice, shuffle
 
 
 
@@ -57,6 +75,10 @@ def get_gitver() -> str:
 # Manually defined version (used when git version is unavailable)
 VER: str = "1.6.0"  # Update version number
 
+# chat_member updates are only delivered when requested explicitly
+ALLOWED_UPDATES: List[str] = ['message', 'edited_message', 'callback_query', 'my_chat_member', 'chat_member',
+                               'chat_join_request']
+
 def error_callback(update: Update, context:CallbackContext) -> None:
     error: Exception = context.error
     try:
@@ -106,8 +128,8 @@ def filter_old_updates(func: Callable[[Update, CallbackContext], Callable]) -> C
         sent_time: datetime = msg.edit_date if msg.edit_date else msg.date
         seconds_from_now: float = (datetime.now(tz=sent_time.tzinfo) - sent_time).total_seconds()
         
-        # Skip processing for old messages
-        if seconds_from_now > 300:  # 5 minutes in seconds (more readable than 5*60)
+        # Skip processing for old messages, with a webhook or in cluster mode they are dropped before parsing
+        if seconds_from_now > MAX_UPDATE_AGE:
             logger.warning(f'Not processing update {update.update_id} since it\'s too old ({int(seconds_from_now)} seconds).')
             return
             
@@ -155,24 +177,52 @@ def fName(user: User, atuser: bool = True, markdown: bool = True) -> str:
             name += " ({})".format(user.username)
     return name
 
-@MWT(timeout=60*60)
-def getAdminIds(bot: Bot, chat_id: int) -> List[int]:
-    admin_ids = list()
-    for chat_member in bot.get_chat_administrators(chat_id):
-        admin_ids.append(chat_member.user.id)
-    return admin_ids
+class AdminSnapshot:
+    '''
+        Administrators of a chat, fetched with one get_chat_administrators call
+    '''
+    def __init__(self, bot: Bot, users: List[User]) -> None:
+        self.users = tuple(users)
+        self.ids = frozenset(u.id for u in self.users)
+        self.mentions = [u.mention_markdown(name=u.name) for u in self.users if u.id != bot.id]
+        self.usernames = [u.username for u in self.users if u.username and u.username != bot.username]
+    def updated(self, bot: Bot, user: User, is_admin: bool) -> 'AdminSnapshot':
+        users = [u for u in self.users if u.id != user.id]
+        if is_admin:
+            users.append(user)
+        return AdminSnapshot(bot, users)
+
+# Snapshots are kept up to date by chat_member updates, the timeout is only a fallback
+@MWT(timeout=6*60*60, maxsize=4096, stale=10*60)
+def getAdmins(bot: Bot, chat_id: int) -> AdminSnapshot:
+    return AdminSnapshot(bot, [chat_member.user for chat_member in bot.get_chat_administrators(chat_id)])
+
+def getAdminIds(bot: Bot, chat_id: int) -> frozenset:
+    return getAdmins(bot, chat_id).ids
 
-@MWT(timeout=60*60)
 def getAdminUsernames(bot: Bot, chat_id: int, markdown: bool = False) -> List[str]:
-    admins = list()
-    for chat_member in bot.get_chat_administrators(chat_id):
-        if markdown:
-            if chat_member.user.id != bot.id:
-                admins.append(chat_member.user.mention_markdown(name=chat_member.user.name))
-        else:
-            if chat_member.user.username and chat_member.user.username != bot.username:
-                admins.append(chat_member.user.username)
-    return admins
+    snapshot = getAdmins(bot, chat_id)
+    return snapshot.mentions if markdown else snapshot.usernames
+
+@collect_error
+def chat_member_update(update: Update, context: CallbackContext) -> None:
+    '''
+        Apply promotions and demotions to the cached admin snapshot of the chat
+    '''
+    cmu: ChatMemberUpdated = update.chat_member or update.my_chat_member
+    if not cmu:
+        return
+    ADMIN_STATUS = (ChatMember.ADMINISTRATOR, ChatMember.CREATOR)
+    was_admin: bool = cmu.old_chat_member.status in ADMIN_STATUS
+    is_admin: bool = cmu.new_chat_member.status in ADMIN_STATUS
+    if not (was_admin or is_admin):
+        return
+    bot: Bot = context.bot
+    chat_id: int = cmu.chat.id
+    snapshot: AdminSnapshot = getAdmins.cache.peek(bot, chat_id)
+    if snapshot is not None:
+        getAdmins.cache.put(snapshot.updated(bot, cmu.new_chat_member.user, is_admin), bot, chat_id)
+        logger.debug(f"Admin snapshot of {chat_id} updated, {cmu.new_chat_member.user.id} {is_admin=}")
 
 @collect_error
 @filter_old_updates
@@ -180,6 +230,7 @@ def start(update: Update, context: CallbackContext) -> None:
     logger.debug(f"Start from {update.message.from_user.id}")
     if update.message.chat.type == 'private' and update.effective_user.id in PERMIT_RELOAD:
         reload(userfilter)
+        score_cache.clear()
         logger.info(f'[!] userfilter module reloaded by {update.effective_user.id}')
         update.message.reply_text('reloaded')
         return
@@ -247,13 +298,6 @@ class chatSettings:
         data = self.get(name)
         if type(data) is list:
             return choice(data)
-    def get_clg_accecpt_deny(self):
-        l = self.choice('CLG_QUESTIONS')
-        if l is None:
-            # Возвращаем значение по умолчанию, если нет вопросов
-            default_question = CHAT_SETTINGS_DEFAULT['CLG_QUESTIONS'][0]
-            return (default_question[0], default_question[1], default_question[2:])
-        return (l[0], l[1], l[2:])
     def __process(self, name: str, inputstr: str) -> str:
         if name == 'WELCOME_WORDS':
             uinput = [l[:4000] for l in inputstr.split('\n') if l]
@@ -272,7 +316,7 @@ class chatSettings:
         elif name in ('CHALLENGE_SUCCESS', 'PERMISSION_DENY'):
             uinput = [l[:30] for l in inputstr.split('\n') if l]
             self.__data[name] = uinput
-        elif name in ('CHALLENGE_TIMEOUT', 'MIN_CLG_TIME', 'UNBAN_TIMEOUT', 'FLOOD_LIMIT'):
+        elif name in ('CHALLENGE_TIMEOUT', 'MIN_CLG_TIME', 'UNBAN_TIMEOUT', 'FLOOD_LIMIT', 'RAID_LIMIT', 'RAID_LOCKDOWN'):
             try:
                 seconds = int(inputstr)
                 if name == 'CHALLENGE_TIMEOUT':
@@ -287,13 +331,19 @@ class chatSettings:
                 elif name == 'FLOOD_LIMIT':
                     if seconds < 0 or seconds > 1000:
                         seconds = 1
+                elif name == 'RAID_LIMIT':
+                    if seconds < 0 or seconds > 10000:
+                        raise ValueError
+                elif name == 'RAID_LOCKDOWN':
+                    if seconds < 60 or seconds > 86400:
+                        raise ValueError
                 else:
                     raise NotImplementedError(f"{name} is unknown")
             except ValueError:
                 return False
             else:
                 self.__data[name] = seconds
-        elif name in ('DEL_LEAVE_MSG', 'DEL_SERVICE_MSG'):
+        elif name in ('DEL_LEAVE_MSG', 'DEL_SERVICE_MSG', 'JOIN_REQUESTS'):
             self.__data[name] = not self.get(name)
         else:
             raise NotImplementedError(f"{name} is unknown")
@@ -315,70 +365,120 @@ class chatSettings:
     def to_dict(self) -> dict:
         return self.__data
 
-FLD_LOCKS = dict()
-class restUser:
-    def __init__(self, user_id: int, join_msgid: int, clg_msgid: int, uinvite_id: int, flooding: bool = False):
-        self.user_id = user_id
-        self.join_msgid = join_msgid
-        self.clg_msgid = clg_msgid
-        self.uinvite_id = uinvite_id
-        self.flooding = flooding
-        self.time = int(time())
-class UserManager:
-    def __init__(self, chat_id: int) -> None:
-        self._cver = self.ver
-        self._chat_id = chat_id
-        self._nfusers = dict()
-        self._fldusers = dict()
-
-        self.fldmsg_id = None
-        self.fldmsg_callbacks = [None, ]
-    @property
-    def ver(self):
-        return '0.0.2'
-    def add(self, ruser: restUser) -> None:
-        if self._nfusers.pop(ruser.user_id, None):
-            logger.debug(f'User {ruser.user_id} is already in nfusers, chat {self._chat_id}')
-        if self._fldusers.pop(ruser.user_id, None):
-            logger.debug(f'User {ruser.user_id} is already in fldusers, chat {self._chat_id}')
-        if ruser.flooding:
-            self._fldusers[ruser.user_id] = ruser
-        else:
-            self._nfusers[ruser.user_id] = ruser
-    def get(self, user_id: int) -> restUser:
-        return self.__get_pop(0, user_id)
-    def pop(self, user_id: int) -> restUser:
-        return self.__get_pop(1, user_id)
-    def __len__(self):
-        return len(self._nfusers) + len(self._fldusers)
-    def __get_pop(self, action: int, user_id: int) -> restUser:
-        us = (self._fldusers, self._nfusers)
-        if action == 0:
-            for u in us:
-                if (ret := u.get(user_id, None)):
-                    return ret
-        elif action == 1:
-            for u in us:
-                if (ret := u.pop(user_id, None)):
-                    return ret
-        return None
+# every chat is handled by a single shard thread, see shards.py
+# challenge timeouts, delayed deletions, flood captcha edits, lockdowns and join requests
+deadlines = DeadlineScheduler()
+# compiled chat_settings, read by the handlers instead of chatSettings
+chat_configs = ChatConfigs()
+(DL_CHALLENGE, DL_DELETE, DL_FLDEDIT, DL_LOCKDOWN, DL_JOINREQ, DL_SEND, DL_APPROVED) = \
+    ('challenge', 'delete', 'flood_edit', 'lockdown', 'join_request', 'challenge_send', 'join_approved')
+# counter updates of the shared flooding captcha within this many seconds become one edit
+FLOOD_EDIT_DELAY = 2
+# seconds a button click may wait for answerCallbackQuery
+ANSWER_TIMEOUT = 3
+# RAID_LIMIT joins within this many seconds lock the chat, see raid_lockdown
+RAID_WINDOW = 60
+# an approved join request lets its user in without a challenge for this many seconds
+JOIN_APPROVED_TIMEOUT = 10 * 60
 
-def challenge_gen_pw(user_id: int, join_msgid: int, real: bool = True) -> str:
-    if real:
-        action = 'pass'
-    else:
-        action = str(time())
-    pw = "{}{}{}{}".format(SALT, user_id, join_msgid, action)
-    pw_sha256 = sha256(pw.encode('utf-8', errors='ignore')).hexdigest()
-    pw_sha256_md5 = md5(pw_sha256.encode('utf-8', errors='ignore')).hexdigest()
-    # telegram limits callback_data to 64 bytes max, we need to be brief
-    callback = pw_sha256_md5[:8]
-    return callback
-
-def challange_hash(user_id: int, chat_id: int, join_msgid: int) -> str:
-    hashes = [str(hash(str(i))) for i in (user_id, chat_id, join_msgid)]
-    identity = hash(''.join(hashes))
-    return str(identity)
+class JoinRate:
+    '''
+        Sliding window of the join times of every chat. A chat is only
+        counted in its own shard, collect() runs in the job queue and may
+        drop a deque at any time, so it is only touched under the lock.
+    '''
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._joins: Dict[int, deque] = dict()
+        self._lock = Lock()
+    def add(self, chat_id: int, joins: int, now: float) -> int:
+        '''
+            returns the number of joins within the window
+        '''
+        with self._lock:
+            times = self._joins.setdefault(chat_id, deque())
+            times.extend([now] * joins)
+            while times and times[0] <= now - self.window:
+                times.popleft()
+            return len(times)
+    def collect(self, now: float) -> int:
+        with self._lock:
+            quiet = [c for (c, times) in self._joins.items() if not times or times[-1] <= now - self.window]
+            for chat_id in quiet:
+                del self._joins[chat_id]
+            return len(quiet)
+
+join_rate = JoinRate(RAID_WINDOW)
+# expiry index of pending users, looked at by the garbage collector
+gc_index = DeadlineScheduler(resolution=60)
+(GC_TICK, GC_CHATS_PER_TICK, USER_EXPIRY, DL_EXPIRE) = (60, 256, 2 * 60 * 60, 'expire')
+gc_backlog = deque()
+
+# messages are kept for deleting them later, for at most 2 hours
+MSG_STORE_AGE = 2 * 60 * 60
+# a chat without pending state is dropped from memory after this many seconds without updates
+CHAT_IDLE = MSG_STORE_AGE
+def stored_messages(chat_data: dict) -> MessageRing:
+    sto_msgs = chat_data.get('stored_messages', None)
+    if sto_msgs is None:
+        sto_msgs = chat_data.setdefault('stored_messages', MessageRing(STORE_CHAT_MESSAGES, MSG_STORE_AGE))
+    if not isinstance(sto_msgs, MessageRing):
+        # legacy list of (user_id, message_id, ts)
+        sto_msgs = chat_data['stored_messages'] = MessageRing(STORE_CHAT_MESSAGES, MSG_STORE_AGE)
+    return sto_msgs
+
+def challenge_key(chat_id: int, user_id: int, join_msgid: int) -> Tuple[str, int, int, int]:
+    '''
+        Key of a pending challenge in `deadlines`, it only depends on the ids
+        so it stays valid across restarts
+    '''
+    return (DL_CHALLENGE, chat_id, user_id, join_msgid)
+
+def restore_pending_challenges(worker: int = 0, workers: int = 1) -> None:
+    '''
+        The deadlines are not persisted, reschedule them from the stored u_mgr
+        of every chat with pending challenges. Overdue ones expire on the first tick.
+        In cluster mode a worker only restores its own chats.
+    '''
+    restored = 0
+    for chat_id in ppersistence.chats_with('u_mgr'):
+        if chat_id % workers != worker:
+            continue
+        chat_data = updater.dispatcher.chat_data[chat_id]
+        u_mgr: UserManager = chat_data.get('u_mgr', None)
+        if not u_mgr:
+            continue
+        config = chat_configs.get(chat_id, chat_data)
+        for rest_user in u_mgr.users():
+            deadline = getattr(rest_user, 'deadline', 0.0) or rest_user.time + config.CHALLENGE_TIMEOUT
+            deadlines.schedule(*challenge_key(chat_id, rest_user.user_id, rest_user.join_msgid), deadline)
+            if rest_user.clg_msgid is None:
+                # the captcha was not sent yet
+                deadlines.schedule(DL_SEND, chat_id, rest_user.user_id, rest_user.join_msgid, time())
+            gc_index.schedule(DL_EXPIRE, chat_id, rest_user.user_id, rest_user.join_msgid, rest_user.time + USER_EXPIRY)
+            restored += 1
+    for chat_id in ppersistence.chats_with('lockdown'):
+        if chat_id % workers != worker:
+            continue
+        lockdown = updater.dispatcher.chat_data[chat_id].get('lockdown', None)
+        if lockdown:
+            deadlines.schedule(DL_LOCKDOWN, chat_id, 0, 0, lockdown['until'])
+            logger.info(f'The group {chat_id} is still locked')
+    for chat_id in ppersistence.chats_with('join_requests'):
+        if chat_id % workers != worker:
+            continue
+        for (user_id, (_, deadline)) in updater.dispatcher.chat_data[chat_id].get('join_requests', dict()).items():
+            deadlines.schedule(DL_JOINREQ, chat_id, user_id, 0, deadline)
+            restored += 1
+    for chat_id in ppersistence.chats_with('join_approved'):
+        if chat_id % workers != worker:
+            continue
+        for (user_id, expiry) in updater.dispatcher.chat_data[chat_id].get('join_approved', dict()).items():
+            deadlines.schedule(DL_APPROVED, chat_id, user_id, 0, expiry)
+    logger.info(f'Restored {restored} pending challenges')
+
+# callback_data of the captcha buttons, signed with SALT so any shard or worker can check a click
+challenge_tokens = ChallengeTokens(SALT.encode())
 
 @collect_error
 def ban_user(update: Update, context: CallbackContext) -> None:
@@ -420,9 +520,14 @@ def ban_user(update: Update, context: CallbackContext) -> None:
                 (data := btn.callback_data) and
                 data.startswith('clg ')
             ):
-                data_parts = data.split(' ')
-                if len(data_parts) in (3, 4):
-                    user_ids = [int(data_parts[1])]
+                challenge = challenge_tokens.verify(data[len('clg '):])
+                if challenge and challenge.flags & ChallengeTokens.FLOODING:
+                    # the shared flooding captcha: everyone who still waits for it
+                    u_mgr: UserManager = context.chat_data.get('u_mgr', None)
+                    user_ids = [u.user_id for u in (u_mgr.users() if u_mgr else ())
+                                if u.flooding and u.clg_msgid == repl_msg.message_id]
+                elif challenge:
+                    user_ids = [challenge.user_id]
         except Exception:
             user_ids = []
             print_traceback(debug=DEBUG)
@@ -438,57 +543,40 @@ def ban_user(update: Update, context: CallbackContext) -> None:
     
     # Блокируем каждого пользователя в списке
     u_mgr = context.chat_data.setdefault('u_mgr', UserManager(chat_id))
-    fldlock = FLD_LOCKS.setdefault(chat_id, Lock())
     
     for user_id in user_ids:
         rest_user = u_mgr.get(user_id)
         
         if not rest_user:
             # Пользователь не имеет ожидающей проверки - просто блокируем
-            kick_user(context, chat_id, user_id, reason="explicitly kicked")
+            kick_user(context, chat_id, user_id, reason="explicitly kicked", block=False)
             
             # Удаляем его сообщения
-            sto_msgs = context.chat_data.get('stored_messages', [])
-            msgids_to_delete = set(u_m_t[1] for u_m_t in sto_msgs if u_m_t[0] == user_id)
+            msgids_to_delete = set(stored_messages(context.chat_data).of_user(user_id))
             msgids_to_delete.add(repl_msg.message_id)
             
-            for mid in msgids_to_delete:
-                delete_message(context, chat_id, mid)
+            delete_messages(context, chat_id, msgids_to_delete)
         else:
-            # Пользователь имеет ожидающую проверку - сначала удаляем задачу проверки
-            job_hash = challange_hash(rest_user.user_id, chat_id, rest_user.join_msgid)
-            mjobs = context.job_queue.get_jobs_by_name(job_hash)
-            
-            if mjobs:
-                for mjob in mjobs:
-                    mjob.schedule_removal()
-                
-                if len(mjobs) > 1:
-                    logger.error(f'Найдено {len(mjobs)} ожидающих задач для {rest_user.user_id} в группе {chat_id}')
-                    if DEBUG:
-                        print_traceback(debug=DEBUG)
+            # Пользователь имеет ожидающую проверку - сначала отменяем таймер проверки
+            deadlines.cancel(*challenge_key(chat_id, rest_user.user_id, rest_user.join_msgid))
             
             # Блокируем пользователя
-            kick_user(context, chat_id, user_id, reason="explicitly kicked before challenge")
+            kick_user(context, chat_id, user_id, reason="explicitly kicked before challenge", block=False)
             
             # Удаляем сообщения о присоединении и проверке
             u_mgr.pop(rest_user.user_id)
+            lockdown_release(context.chat_data, rest_user.user_id)
             
             if rest_user.flooding:
-                with fldlock:
-                    if len(u_mgr._fldusers) == 0 and u_mgr.fldmsg_id:
-                        delete_message(context, chat_id=chat_id, message_id=u_mgr.fldmsg_id)
-                        u_mgr.fldmsg_id = None
-            else:
+                if (fldmsg_id := flood_captcha_left(chat_id, u_mgr)):
+                    delete_message(context, chat_id=chat_id, message_id=fldmsg_id)
+            elif rest_user.clg_msgid:
                 delete_message(context, chat_id=chat_id, message_id=rest_user.clg_msgid)
             
             delete_message(context, chat_id=chat_id, message_id=rest_user.join_msgid)
     
     # Удаляем сообщение с командой через 2 секунды
-    def delete_notice(_: CallbackContext) -> None:
-        delete_message(context, chat_id=chat_id, message_id=update.message.message_id)
-    
-    context.job_queue.run_once(delete_notice, 2)
+    deadlines.schedule(DL_DELETE, chat_id, 0, update.message.message_id, time() + 2)
 
 @collect_error
 def challenge_verification(update: Update, context: CallbackContext) -> None:
@@ -497,43 +585,34 @@ def challenge_verification(update: Update, context: CallbackContext) -> None:
     user: User = update.callback_query.from_user
     message_id: int = update.callback_query.message.message_id
     data: str = update.callback_query.data
-    fldlock: Lock = FLD_LOCKS.setdefault(chat_id, Lock())
-    u_mgr: UserManager = context.chat_data.setdefault('u_mgr', UserManager(chat_id))
-    settings = chatSettings(context.chat_data.get('chat_settings', dict()))
-    if not data:
-        logger.error('Empty Inline challenge data.')
+    # forged and expired clicks are rejected before anything is looked up
+    challenge = challenge_tokens.verify(data[len('clg '):]) if data else None
+    if challenge is None:
+        logger.error(f'Bad challenge data {data}')
+        answer_callback(bot, update.callback_query, 'Fail')
         return
-    args: List[str] = data.split()
-    if args and len(args) == 3:
-        args.append('')
-    if not (args and len(args) == 4):
-        logger.error(f'Wrong Inline challenge data length. {data}')
+    if challenge.expiry < time():
+        answer_callback(bot, update.callback_query, 'Время проверки истекло.')
         return
-    (btn_callback, invite_ruid) = args[2:] # args: ['clg', r_user_id, btn_callback, invite_ruid]
-    # invite_ruid is '' if the restricted user is not a bot
-    if invite_ruid:
-        try:
-            r_user_id = int(invite_ruid)
-        except ValueError:
-            logger.error(f'Bad invite_uid, {data}')
-            bot.answer_callback_query(callback_query_id=update.callback_query.id, text="Fail")
-            return
-    else:
-        r_user_id = user.id
+    u_mgr: UserManager = context.chat_data.setdefault('u_mgr', UserManager(chat_id))
+    config = chat_configs.get(chat_id, context.chat_data)
+    # the shared flooding captcha is answered by every flooding user
+    flooding_captcha = bool(challenge.flags & ChallengeTokens.FLOODING)
+    r_user_id = user.id if flooding_captcha else challenge.user_id
     rest_user: restUser = u_mgr.get(r_user_id)
 
     naughty_user: bool = False
     flooding: bool = False
     wrong_captcha: bool = False
+    by_admin: bool = False
 
     if not rest_user:
         naughty_user = True
     else:
-        if invite_ruid:
-            if not rest_user.flooding:
-                flooding = False
-            else:
-                wrong_captcha = True # ??
+        if not flooding_captcha:
+            # a captcha of an earlier join is not valid for this one
+            if rest_user.flooding or challenge.ref != rest_user.join_msgid:
+                wrong_captcha = True
         else:
             if rest_user.flooding:
                 flooding = True
@@ -544,96 +623,164 @@ def challenge_verification(update: Update, context: CallbackContext) -> None:
             bot.answer_callback_query(callback_query_id=update.callback_query.id, text="Not your captcha")
             return
 
-        if flooding:
+        if flooding or user.id in (rest_user.uinvite_id, rest_user.user_id):
             naughty_user = False
         else:
-            if user.id in (rest_user.uinvite_id, rest_user.user_id, *(adminids := getAdminIds(bot, chat_id))):
-                naughty_user = False
-            else:
-                naughty_user = True
+            # only a stranger's click needs the admin list
+            by_admin = user.id in getAdminIds(bot, chat_id)
+            naughty_user = not by_admin
 
     if not naughty_user:
-        # Remove old job first, then take action
-        if settings.get('CHALLENGE_TIMEOUT') > 0:
-            mjobs: tuple = context.job_queue.get_jobs_by_name(challange_hash(rest_user.user_id, chat_id, rest_user.join_msgid))
-            if len(mjobs) == 1:
-                mjob: Job = mjobs[0]
-                mjob.schedule_removal()
-            else:
-                for mjob in mjobs:
-                    mjob.schedule_removal()
-                logger.error(f'There is {len(mjobs)} pending job(s) for {rest_user.user_id} in the group {chat_id}')
-                if DEBUG:
-                    try:
-                        raise Exception
-                    except Exception:
-                        print_traceback(debug=DEBUG)
-
-        # whether the captcha is correct or not
-        if data == u_mgr.fldmsg_callbacks[0]:
-            captcha_corrent = True
-        elif not flooding and btn_callback == challenge_gen_pw(rest_user.user_id, rest_user.join_msgid):
-            captcha_corrent = True
-        else:
-            captcha_corrent = False
-
-        if not captcha_corrent:
-            if (kick_by_admin := not flooding and user.id in adminids):
-                bot.answer_callback_query(callback_query_id=update.callback_query.id,
-                                          text=f'Banned for {UNBAN_TIMEOUT} seconds' \
-                                            if (UNBAN_TIMEOUT := settings.get('UNBAN_TIMEOUT')) > 0 else \
-                                            'Banned permanently',
-                                          show_alert=True)
-            kick_user(context, chat_id, r_user_id, 'Kicked by admin' if kick_by_admin else 'Challange failed')
-            def then_unban(_: CallbackContext) -> None:
-                unban_user(context, chat_id, r_user_id, reason='Unban timeout reached.')
-            if (UNBAN_TIMEOUT := settings.get('UNBAN_TIMEOUT')) > 0:
-                context.job_queue.run_once(then_unban, UNBAN_TIMEOUT, name='unban_job')
-        else:
-            unban_user(context, chat_id, r_user_id, reason='Challenge passed.')
-            bot.answer_callback_query(callback_query_id=update.callback_query.id,
-                                      text=settings.choice('CHALLENGE_SUCCESS'),
-                                      show_alert=True)
-        # delete messages
+        # Decide and answer first, everything else runs after the answer
+        if not deadlines.cancel(*challenge_key(chat_id, rest_user.user_id, rest_user.join_msgid)):
+            logger.error(f'There is no pending deadline for {rest_user.user_id} in the group {chat_id}')
         u_mgr.pop(rest_user.user_id)
-        if flooding:
-            fldlock.acquire()
-            try:
-                if len(u_mgr._fldusers) == 0 and u_mgr.fldmsg_id:
-                    delete_message(context, chat_id=chat_id, message_id=u_mgr.fldmsg_id)
-                    u_mgr.fldmsg_id = None
-            finally:
-                fldlock.release()
+
+        captcha_corrent = challenge.real
+
+        kick_by_admin = not captcha_corrent and by_admin
+        if captcha_corrent:
+            answer = choice(config.CHALLENGE_SUCCESS)
+        elif kick_by_admin:
+            answer = f'Banned for {UNBAN_TIMEOUT} seconds' if (UNBAN_TIMEOUT := config.UNBAN_TIMEOUT) > 0 \
+                     else 'Banned permanently'
         else:
-            delete_message(context, chat_id=chat_id, message_id=message_id)
-        if not captcha_corrent:
-            delete_message(context, chat_id=chat_id, message_id=rest_user.join_msgid)
+            answer = 'Проверка не пройдена.'
+        answer_callback(bot, update.callback_query, answer)
+        # permissions and cleanup queue behind the other work of the chat
+        updater.dispatcher.shards.submit(chat_id, challenge_consequences, context, chat_id, rest_user, message_id,
+                                         captcha_corrent, 'Kicked by admin' if kick_by_admin else 'Challange failed')
 
     else:
         logger.info((f"Naughty user {fName(user, markdown=False)} {user.id=} clicked a button"
                      f" from the group {chat_id}"))
         bot.answer_callback_query(callback_query_id=update.callback_query.id,
-                                  text=settings.choice('PERMISSION_DENY'),
+                                  text=choice(config.PERMISSION_DENY),
                                   show_alert=True)
 
-def simple_challenge(context, chat_id, user, invite_user, join_msgid) -> None:
-    bot: Bot = context.bot
-    fldlock: Lock = FLD_LOCKS.setdefault(chat_id, Lock())
-    u_mgr: UserManager = context.chat_data.setdefault('u_mgr', UserManager(chat_id))
-    settings = chatSettings(context.chat_data.get('chat_settings', dict()))
-    MIN_CLG_TIME = settings.get('MIN_CLG_TIME')
-    CLG_TIMEOUT  = settings.get('CHALLENGE_TIMEOUT')
+def answer_callback(bot: Bot, query: CallbackQuery, text: str) -> None:
+    '''
+        stops the spinner of the button, a failed answer does not stop the handler
+    '''
+    try:
+        bot.answer_callback_query(callback_query_id=query.id, text=text, show_alert=True, timeout=ANSWER_TIMEOUT)
+    except TelegramError as err:
+        logger.info(f'Cannot answer callback query {query.id}: {err}')
+
+@collect_error
+def challenge_consequences(context: CallbackContext, chat_id: int, rest_user: restUser, clg_msgid: int,
+                           passed: bool, reason: str) -> None:
+    '''
+        runs in the shard of chat_id after the callback query is answered
+    '''
+    chat_data: dict = updater.dispatcher.chat_data[chat_id]
+    config = chat_configs.get(chat_id, chat_data)
+    u_mgr: UserManager = chat_data.setdefault('u_mgr', UserManager(chat_id))
+    unrestricted = lockdown_release(chat_data, rest_user.user_id)
+    if not passed:
+        # the ban expires on the server after UNBAN_TIMEOUT
+        kick_user(context, chat_id, rest_user.user_id, reason, duration=config.UNBAN_TIMEOUT, block=False)
+    elif not unrestricted:
+        unban_user(context, chat_id, rest_user.user_id, reason='Challenge passed.', block=False)
+    # delete messages
+    if rest_user.flooding:
+        if (fldmsg_id := flood_captcha_left(chat_id, u_mgr)):
+            delete_message(context, chat_id=chat_id, message_id=fldmsg_id)
+    else:
+        delete_message(context, chat_id=chat_id, message_id=clg_msgid)
+    if not passed:
+        delete_message(context, chat_id=chat_id, message_id=rest_user.join_msgid)
+
+def organize_btns(buttons: List[InlineKeyboardButton], widths: Tuple[int, ...] = None) -> List[List[InlineKeyboardButton]]:
+    '''
+        Shuffle buttons and put them into a 2d array,
+        widths are the measured button_width of the texts if known
+    '''
+    order = list(range(len(buttons)))
+    shuffle(order)
+    output = [list(),]
+    LENGTH_PER_LINE = 20
+    MAXIMUM_PER_LINE = 4
+    clength = LENGTH_PER_LINE
+    for n in order:
+        btn = buttons[n]
+        l = widths[n] if widths is not None else button_width(btn.text)
+        clength -= l
+        if clength < 0 or len(output[-1]) >= MAXIMUM_PER_LINE:
+            clength = LENGTH_PER_LINE - l
+            output.append([btn])
+        else:
+            output[-1].append(btn)
+    return output
+
+def save_settings(chat_id: int, chat_data: dict, settings: chatSettings) -> None:
+    '''
+        the compiled config of the chat is replaced at once
+    '''
+    chat_configs.save(chat_id, chat_data, settings.to_dict())
+    ppersistence.update_chat_data(chat_id, chat_data)
+
+def challenge_buttons(template: ChallengeTemplate, tokens: List[str], prefix: str) -> List[List[InlineKeyboardButton]]:
+    '''
+        the only work per join: tokens of challenge_tokens.buttons and a shuffle
+    '''
+    return organize_btns([InlineKeyboardButton(text=text, callback_data=f"{prefix} {token}")
+                          for (text, token) in zip(template.answers, tokens)], template.widths)
+
+def simple_challenge(context, chat_id, user, invite_user, join_msgid, lockdown: dict = None) -> None:
+    '''
+        runs in the shard of chat_id. The restriction waits in the action queue,
+        the shard goes on with the challenge once it is done, see challenge_restricted
+    '''
+    config = chat_configs.get(chat_id, context.chat_data)
+    MIN_CLG_TIME = config.MIN_CLG_TIME
+    CLG_TIMEOUT  = config.CHALLENGE_TIMEOUT
     try:
         RCLG_TIMEOUT = (lambda score: \
                         (userfilter.MAX_SCORE-score)/userfilter.MAX_SCORE*(CLG_TIMEOUT-MIN_CLG_TIME)+MIN_CLG_TIME) \
-                       (userfilter.spam_score(user.full_name))
+                       (score_cache.score(user.id, user.full_name))
         RCLG_TIMEOUT = int(RCLG_TIMEOUT)
     except Exception:
         RCLG_TIMEOUT = CLG_TIMEOUT
         print_traceback(debug=DEBUG)
-    (CLG_QUESTION, CLG_ACCEPT, CLG_DENY) = settings.get_clg_accecpt_deny()
+    deadline = time() + max(RCLG_TIMEOUT, 0)
+    if lockdown is not None:
+        # nobody can write in a locked chat
+        challenge_restricted(context, chat_id, user, invite_user, join_msgid, deadline, lockdown)
+        return
+    restricted = restrict_user(context, chat_id=chat_id, user_id=user.id, extra=' [bot]' if user.is_bot else '',
+                               block=False)
+    restricted.add_done_callback(lambda done: updater.dispatcher.shards.submit(
+        chat_id, challenge_restricted, context, chat_id, user, invite_user, join_msgid, deadline, None, done))
+
+@collect_error
+def challenge_restricted(context: CallbackContext, chat_id: int, user: User, invite_user: User, join_msgid: int,
+                         deadline: float, lockdown: dict = None, restricted: Future = None) -> None:
+    '''
+        runs in the shard of chat_id once the new member cannot write,
+        the user is pending from now on
+    '''
+    chat_data: dict = updater.dispatcher.chat_data[chat_id]
+    if restricted is not None and isinstance(restricted.exception(), CircuitOpenError):
+        # the Bot API is degraded, it is not the rights of the bot
+        logger.warning(f'Bot API unavailable, {user.id} is not challenged in the group {chat_id}')
+        return
+    if restricted is not None and (restricted.exception() is not None or not restricted.result()):
+        if delayed_message.reserve_now(chat_id) == 0:
+            try:
+                context.bot.send_message(chat_id=chat_id,
+                        text="Обнаружен новый участник: {0}, но бот не является администратором и не может выполнить необходимые действия. "
+                             "Пожалуйста, назначьте бота администратором и предоставьте права на блокировку пользователей.".format(fName(user, markdown=True)),
+                        parse_mode="Markdown", reserved=True)
+            except TelegramError:
+                print_traceback(debug=DEBUG)
+        logger.error((f"Cannot restrict {user.id} and {invite_user.id} in "
+                      f"the group {chat_id}{' [bot]' if user.is_bot else ''}"))
+        return
+    u_mgr: UserManager = chat_data.setdefault('u_mgr', UserManager(chat_id))
+    config = chat_configs.get(chat_id, chat_data)
     # flooding protection
-    FLOOD_LIMIT = settings.get('FLOOD_LIMIT')
+    FLOOD_LIMIT = config.FLOOD_LIMIT
     if FLOOD_LIMIT == 0:
         flag_flooding = False
     elif FLOOD_LIMIT == 1:
@@ -643,107 +790,372 @@ def simple_challenge(context, chat_id, user, invite_user, join_msgid) -> None:
             flag_flooding = True
         else:
             flag_flooding = False
-    flag_flooding = flag_flooding and not user.is_bot
-    def organize_btns(buttons: List[InlineKeyboardButton]) -> List[List[InlineKeyboardButton]]:
-        '''
-            Shuffle buttons and put them into a 2d array
-        '''
-        shuffle(buttons)
-        output = [list(),]
-        LENGTH_PER_LINE = 20
-        MAXIMUM_PER_LINE = 4
-        clength = LENGTH_PER_LINE
-        for btn in buttons:
-            l = len(btn.text) + len(find_cjk_letters(btn.text)) # cjk letters has a length of 2
-            clength -= l
-            if clength < 0 or len(output[-1]) >= MAXIMUM_PER_LINE:
-                clength = LENGTH_PER_LINE - l
-                output.append([btn])
-            else:
-                output[-1].append(btn)
-        return output
+    # a locked chat gets the shared captcha too
+    flag_flooding = (flag_flooding or lockdown is not None) and not user.is_bot
+    if lockdown is not None:
+        # the restriction is saved
+        lockdown['users'].add(user.id)
+    rest_user = restUser(user.id, join_msgid, None, None if flag_flooding else invite_user.id, flooding=flag_flooding,
+                         deadline=deadline)
+    u_mgr.add(rest_user)
+    if (delay := send_challenge(context, chat_id, rest_user)):
+        deadlines.schedule(DL_SEND, chat_id, user.id, join_msgid, time() + delay)
+    # User restricted, now search for this user's previous messages and delete them
+    msgids_to_delete: Set[int] = set(stored_messages(chat_data).of_user(user.id, after_msgid=int(join_msgid)))
+    delete_messages(context, chat_id, msgids_to_delete)
+    # kick them after timeout
+    deadlines.schedule(*challenge_key(chat_id, user.id, join_msgid), deadline)
+    gc_index.schedule(DL_EXPIRE, chat_id, user.id, join_msgid, time() + USER_EXPIRY)
+
+def send_challenge(context: CallbackContext, chat_id: int, rest_user: restUser) -> float:
+    '''
+        Gives a pending user their captcha, the shard never waits for the message budget:
+        returns the seconds until the next attempt if it cannot be sent now, otherwise 0
+    '''
+    chat_data: dict = updater.dispatcher.chat_data[chat_id]
+    u_mgr: UserManager = chat_data['u_mgr']
+    if rest_user.flooding and u_mgr.fldmsg_id and u_mgr.fldmsg_keyboard and \
+       flood_captcha_expiry(u_mgr) >= rest_user.deadline:
+        # everyone answers the shared captcha, only its counter changes
+        rest_user.clg_msgid = u_mgr.fldmsg_id
+        schedule_flood_edit(chat_id, u_mgr)
+        return 0
+    if (delay := delayed_message.reserve_now(chat_id)) > 0:
+        return delay
+    config = chat_configs.get(chat_id, chat_data)
+    # the shared flooding captcha stays valid as long as its users may be pending
+    template = config.template()
+    fakes = len(template.answers) - 1
+    tokens = challenge_tokens.buttons(rest_user.user_id, rest_user.join_msgid, time() + USER_EXPIRY, fakes,
+                                      ChallengeTokens.FLOODING) if rest_user.flooding else \
+             challenge_tokens.buttons(rest_user.user_id, rest_user.join_msgid, rest_user.deadline, fakes)
+    buttons = challenge_buttons(template, tokens, 'clg')
+    clg_text = config.welcome(max(int(rest_user.deadline - time()), 0)) + f"\n{template.question}"
     try:
-        if restrict_user(context, chat_id=chat_id, user_id=user.id, extra=((' [flooding]' if flag_flooding else '') + \
-                                                                           (' [bot]' if user.is_bot else ''))):
-            if flag_flooding:
-                fldlock.acquire()
-            try:
-                if u_mgr.fldmsg_id and flag_flooding:
-                    logger.debug(f'Deleting flooding captcha {u_mgr.fldmsg_id} in {chat_id}')
-                    delete_message(context, chat_id, u_mgr.fldmsg_id)
-                buttons = [
-                    InlineKeyboardButton(text=CLG_ACCEPT, callback_data = (\
-                        f"clg {user.id} {challenge_gen_pw(user.id, join_msgid)}" + \
-                    (f" {user.id}" if not flag_flooding else ''))),
-                    *[InlineKeyboardButton(text=fake_btn_text, callback_data = (\
-                        f"clg {user.id} {challenge_gen_pw(user.id, join_msgid, real=False)}" + \
-                    (f" {user.id}" if not flag_flooding else '')))
-                    for fake_btn_text in CLG_DENY]
-                ]
-                callback_datalist = [btn.callback_data for btn in buttons]
-                buttons = organize_btns(buttons)
-                for _ in range(3):
-                    try:
-                        msg: Message = bot.send_message(chat_id=chat_id,
-                                        reply_to_message_id=join_msgid,
-                                        text=('' if not flag_flooding else \
-                                                    f'Ожидающих проверки пользователей: {len(u_mgr)+1}\n') + \
-                                                settings.choice('WELCOME_WORDS').replace(
-                                                '%time%', f"{RCLG_TIMEOUT}") + \
-                                                f"\n{CLG_QUESTION}",
-                                        reply_markup=InlineKeyboardMarkup(buttons),
-                                        disable_notification=True) # These messages are essential and should not be delayed.
-                    except TelegramError:
-                        pass
-                    else:
-                        break
-                else:
-                    raise TelegramError(f'Send challenge message failed 3 times for {user.id}')
-                if flag_flooding:
-                    u_mgr.fldmsg_id = msg.message_id
-                    u_mgr.fldmsg_callbacks = callback_datalist
-                bot_invite_uid = None if flag_flooding else invite_user.id
-                u_mgr.add(restUser(user.id, join_msgid, msg.message_id, bot_invite_uid, flooding=flag_flooding))
-            finally:
-                if flag_flooding:
-                    fldlock.release()
-            # User restricted and buttons sent, now search for this user's previous messages and delete them
-            sto_msgs: List[Tuple[int, int, int]] = context.chat_data.get('stored_messages', list())
-            msgids_to_delete: Set[int] = set([u_m_t[1] for u_m_t in sto_msgs if u_m_t[0] == user.id and int(u_m_t[1]) > int(join_msgid)])
-            for _mid in msgids_to_delete:
-                delete_message(context, chat_id, _mid)
-            # kick them after timeout
-            def kick_then_unban(_: CallbackContext) -> None:
-                def then_unban(_: CallbackContext) -> None:
-                    unban_user(context, chat_id, user.id, reason='Unban timeout reached.')
-                if kick_user(context, chat_id, user.id, reason='Challange timeout.'):
-                    if (UNBAN_TIMEOUT := settings.get('UNBAN_TIMEOUT')) > 0:
-                        context.job_queue.run_once(then_unban, UNBAN_TIMEOUT, name='unban_job')
-                u_mgr.pop(user.id)
-                # delete messages
-                if flag_flooding:
-                    fldlock.acquire()
-                    try:
-                        if len(u_mgr) == 0 and u_mgr.fldmsg_id:
-                            delete_message(context, chat_id=chat_id, message_id=u_mgr.fldmsg_id)
-                            u_mgr.fldmsg_id = None
-                    finally:
-                        fldlock.release()
-                else:
-                    delete_message(context, chat_id=chat_id, message_id=msg.message_id)
-                delete_message(context, chat_id=chat_id, message_id=join_msgid)
-            context.job_queue.run_once(kick_then_unban, RCLG_TIMEOUT if RCLG_TIMEOUT > 0 else 0,
-                                       name=challange_hash(user.id, chat_id, join_msgid))
+        msg: Message = context.bot.send_message(chat_id=chat_id,
+                        reply_to_message_id=rest_user.join_msgid,
+                        text=clg_text if not rest_user.flooding else flood_captcha_text(len(u_mgr), clg_text),
+                        reply_markup=InlineKeyboardMarkup(buttons),
+                        disable_notification=True, # These messages are essential and should not be delayed.
+                        reserved=True)
+    except RetryAfter as err:
+        # flood control, the chat is penalized by MQBot meanwhile
+        return err.retry_after
+    except CircuitOpenError:
+        return circuit_breaker.cooldown
+    except TelegramError as err:
+        logger.info(f'Cannot send the challenge of {rest_user.user_id} in the group {chat_id}, {err}')
+        return backoff_delay(2)
+    if rest_user.flooding:
+        if u_mgr.fldmsg_id:
+            logger.debug(f'Deleting flooding captcha {u_mgr.fldmsg_id} in {chat_id}')
+            delete_message(context, chat_id, u_mgr.fldmsg_id)
+        u_mgr.fldmsg_id = msg.message_id
+        u_mgr.fldmsg_text = clg_text
+        u_mgr.fldmsg_keyboard = tuple(tuple((btn.text, btn.callback_data) for btn in row) for row in buttons)
+        u_mgr.fldmsg_shown = len(u_mgr)
+    rest_user.clg_msgid = msg.message_id
+    return 0
+
+def challenge_sends(context: CallbackContext, chat_id: int, records: List[Deadline]) -> None:
+    '''
+        captchas which could not be sent right after the restriction
+    '''
+    chat_data: dict = updater.dispatcher.chat_data[chat_id]
+    u_mgr: UserManager = chat_data.get('u_mgr', None)
+    if not u_mgr:
+        return
+    for rec in records:
+        rest_user: restUser = u_mgr.get(rec.user_id)
+        if not rest_user or rest_user.join_msgid != rec.join_msgid or rest_user.clg_msgid is not None:
+            continue
+        if (delay := send_challenge(context, chat_id, rest_user)):
+            deadlines.schedule(DL_SEND, chat_id, rec.user_id, rec.join_msgid, time() + delay)
+    ppersistence.update_chat_data(chat_id, chat_data)
+
+
+def flood_captcha_text(pending: int, text: str) -> str:
+    return f'Ожидающих проверки пользователей: {pending}\n' + text
+
+def schedule_flood_edit(chat_id: int, u_mgr: UserManager) -> None:
+    '''
+        debounced: changes of the counter within FLOOD_EDIT_DELAY become one edit
+    '''
+    key = (DL_FLDEDIT, chat_id, 0, u_mgr.fldmsg_id)
+    if not deadlines.get(*key):
+        deadlines.schedule(*key, time() + FLOOD_EDIT_DELAY)
+
+def flood_captcha_expiry(u_mgr: UserManager) -> int:
+    challenge = challenge_tokens.verify(u_mgr.fldmsg_keyboard[0][0][1][len('clg '):])
+    return challenge.expiry if challenge else 0
+
+def flood_captcha_left(chat_id: int, u_mgr: UserManager) -> Optional[int]:
+    '''
+        after a flooding user left: returns the shared captcha if nobody waits
+        for it anymore, it should be deleted, otherwise its counter is updated
+    '''
+    if not u_mgr.fldmsg_id:
+        return None
+    if u_mgr.flooding == 0:
+        (fldmsg_id, u_mgr.fldmsg_id) = (u_mgr.fldmsg_id, None)
+        return fldmsg_id
+    if u_mgr.fldmsg_keyboard:
+        schedule_flood_edit(chat_id, u_mgr)
+    return None
+
+def flood_captcha_edits(context: CallbackContext, chat_id: int, records: List[Deadline]) -> None:
+    u_mgr: UserManager = updater.dispatcher.chat_data[chat_id].get('u_mgr')
+    for rec in records:
+        # the captcha may have been deleted or replaced meanwhile
+        if not u_mgr or u_mgr.fldmsg_id != rec.join_msgid or len(u_mgr) == u_mgr.fldmsg_shown:
+            continue
+        pending = len(u_mgr)
+        keyboard = [[InlineKeyboardButton(text=text, callback_data=data) for (text, data) in row]
+                    for row in u_mgr.fldmsg_keyboard]
+        try:
+            context.bot.edit_message_text(flood_captcha_text(pending, u_mgr.fldmsg_text), chat_id=chat_id,
+                                          message_id=rec.join_msgid, reply_markup=InlineKeyboardMarkup(keyboard))
+        except BadRequest as err:
+            logger.debug(f'Cannot edit flooding captcha {rec.join_msgid} in {chat_id}: {err}')
+        except TelegramError:
+            print_traceback(debug=DEBUG)
         else:
-            raise TelegramError('')
-    except TelegramError:
-        bot.send_message(chat_id=chat_id,
-                text="Обнаружен новый участник: {0}, но бот не является администратором и не может выполнить необходимые действия. "
-                     "Пожалуйста, назначьте бота администратором и предоставьте права на блокировку пользователей.".format(fName(user, markdown=True)),
-                parse_mode="Markdown")
-        logger.error((f"Cannot restrict {user.id} and {invite_user.id} in "
-                      f"the group {chat_id}{' [bot]' if user.is_bot else ''}"))
+            u_mgr.fldmsg_shown = pending
 
+def raid_lockdown(context: CallbackContext, chat_id: int, joins: int) -> Optional[dict]:
+    '''
+        Counts the joins of a chat. RAID_LIMIT joins within RAID_WINDOW seconds lock
+        the whole chat with one call instead of a restriction per user, it is unlocked
+        after RAID_LOCKDOWN seconds without joins. Returns the lockdown if the chat is locked.
+    '''
+    config = chat_configs.get(chat_id, context.chat_data)
+    now = time()
+    lockdown: dict = context.chat_data.get('lockdown', None)
+    if not lockdown:
+        RAID_LIMIT = config.RAID_LIMIT
+        if not RAID_LIMIT or join_rate.add(chat_id, joins, now) < RAID_LIMIT:
+            return None
+        if context.chat_data.get('lock_retry', 0) > now:
+            # the last attempt failed, the joins are restricted one by one meanwhile
+            return None
+        try:
+            permissions = lock_chat(context, chat_id)
+        except TelegramError:
+            permissions = False
+        if permissions is False:
+            context.chat_data['lock_retry'] = now + RAID_WINDOW
+            return None
+        context.chat_data.pop('lock_retry', None)
+        lockdown = context.chat_data['lockdown'] = {'permissions': permissions, 'until': now,
+                                                    'users': set(), 'msgid': None}
+        logger.warning(f'Raid in the group {chat_id}, locked')
+        try:
+            msg: Message = context.bot.send_message(chat_id=chat_id, disable_notification=True,
+                text="Обнаружено массовое вступление участников, чат временно закрыт. "
+                     f"Он откроется автоматически, если {config.RAID_LOCKDOWN} секунд никто не будет вступать.")
+            lockdown['msgid'] = msg.message_id
+        except TelegramError:
+            print_traceback(debug=DEBUG)
+    lockdown['until'] = now + config.RAID_LOCKDOWN
+    if not deadlines.get(DL_LOCKDOWN, chat_id, 0, 0):
+        deadlines.schedule(DL_LOCKDOWN, chat_id, 0, 0, lockdown['until'])
+    return lockdown
+
+def lockdown_release(chat_data: dict, user_id: int) -> bool:
+    '''
+        a pending user leaves the lockdown, True if they were never restricted
+    '''
+    lockdown = chat_data.get('lockdown', None)
+    if lockdown and user_id in lockdown['users']:
+        lockdown['users'].discard(user_id)
+        return True
+    return False
+
+def lockdown_timeouts(context: CallbackContext, chat_id: int, records: List[Deadline]) -> None:
+    chat_data: dict = updater.dispatcher.chat_data[chat_id]
+    lockdown: dict = chat_data.get('lockdown', None)
+    if not lockdown:
+        return
+    u_mgr: UserManager = chat_data.get('u_mgr', None)
+    # users who joined meanwhile are not restricted, wait until their challenges end
+    until = max([lockdown['until'], *(u.deadline + deadlines.resolution for uid in lockdown['users']
+                                      if u_mgr and (u := u_mgr.get(uid)))])
+    if until > time():
+        deadlines.schedule(DL_LOCKDOWN, chat_id, 0, 0, until)
+        return
+    if not unlock_chat(context, chat_id, lockdown['permissions']):
+        deadlines.schedule(DL_LOCKDOWN, chat_id, 0, 0, time() + RAID_WINDOW)
+        return
+    chat_data.pop('lockdown', None)
+    if lockdown['msgid']:
+        delete_message(context, chat_id, lockdown['msgid'])
+    ppersistence.update_chat_data(chat_id, chat_data)
+    logger.info(f'Raid in the group {chat_id} is over, unlocked')
+
+def challenge_timeouts(context: CallbackContext, chat_id: int, records: List[Deadline]) -> None:
+    chat_data: dict = updater.dispatcher.chat_data[chat_id]
+    u_mgr: UserManager = chat_data.get('u_mgr', None)
+    if not u_mgr:
+        return
+    config = chat_configs.get(chat_id, chat_data)
+    UNBAN_TIMEOUT = config.UNBAN_TIMEOUT
+    msgids_to_delete: Set[int] = set()
+    flooding: bool = False
+    for rec in records:
+        rest_user: restUser = u_mgr.get(rec.user_id)
+        if not rest_user or rest_user.join_msgid != rec.join_msgid:
+            continue
+        kick_user(context, chat_id, rec.user_id, reason='Challange timeout.', duration=UNBAN_TIMEOUT, block=False)
+        u_mgr.pop(rec.user_id)
+        lockdown_release(chat_data, rec.user_id)
+        # delete messages
+        if rest_user.flooding:
+            flooding = True
+        elif rest_user.clg_msgid:
+            msgids_to_delete.add(rest_user.clg_msgid)
+        msgids_to_delete.add(rec.join_msgid)
+    if flooding:
+        if (fldmsg_id := flood_captcha_left(chat_id, u_mgr)):
+            msgids_to_delete.add(fldmsg_id)
+    delete_messages(context, chat_id, msgids_to_delete)
+    ppersistence.update_chat_data(chat_id, chat_data)
+
+def delayed_deletions(context: CallbackContext, chat_id: int, records: List[Deadline]) -> None:
+    delete_messages(context, chat_id, [rec.join_msgid for rec in records])
+
+@collect_error
+@filter_old_updates
+def join_request(update: Update, context: CallbackContext) -> None:
+    '''
+        The challenge of a join request is sent to the user in private, the request
+        is approved or declined afterwards. Nobody has to be restricted or kicked
+        and there is nothing to clean up in the group.
+    '''
+    request: ChatJoinRequest = update.chat_join_request
+    chat_id: int = request.chat.id
+    user: User = request.from_user
+    config = chat_configs.get(chat_id, context.chat_data)
+    if not config.JOIN_REQUESTS:
+        return
+    template = config.template()
+    CLG_TIMEOUT = config.CHALLENGE_TIMEOUT
+    deadline = time() + CLG_TIMEOUT
+    # the answer comes from the private chat, it carries the group
+    buttons = challenge_buttons(template, challenge_tokens.buttons(user.id, chat_id, deadline, len(template.answers) - 1),
+                                f"jrq {chat_id}")
+    try:
+        msg: Message = context.bot.send_message(chat_id=user.id,
+                        text=f"{request.chat.title}\n" + \
+                             config.welcome(CLG_TIMEOUT) + f"\n{template.question}",
+                        reply_markup=InlineKeyboardMarkup(buttons))
+    except TelegramError as err:
+        # the request stays for the admins
+        logger.info(f'Cannot send the challenge of the join request of {user.id} to {chat_id}: {err}')
+        return
+    context.chat_data.setdefault('join_requests', dict())[user.id] = (msg.message_id, deadline)
+    deadlines.schedule(DL_JOINREQ, chat_id, user.id, 0, deadline)
+    logger.info(f'Join request of {user.id} to the group {chat_id} is challenged')
+
+@collect_error
+def join_request_answer(update: Update, context: CallbackContext) -> None:
+    query: CallbackQuery = update.callback_query
+    args: List[str] = query.data.split()
+    try:
+        chat_id = int(args[1])
+        challenge = challenge_tokens.verify(args[2])
+    except (IndexError, ValueError):
+        challenge = None
+    if challenge is None or challenge.ref != chat_id or challenge.user_id != query.from_user.id:
+        logger.error(f'Wrong join request challenge data {query.data}')
+        answer_callback(context.bot, query, 'Fail')
+        return
+    if challenge.expiry < time():
+        answer_callback(context.bot, query, 'Время проверки истекло.')
+        return
+    # pending requests are kept by the shard of the group, see also cluster.raw_chat_id
+    updater.dispatcher.shards.submit_urgent(chat_id, join_request_verdict, context, chat_id, query, challenge.real)
+
+@collect_error
+def join_request_verdict(context: CallbackContext, chat_id: int, query: CallbackQuery, passed: bool) -> None:
+    chat_data: dict = updater.dispatcher.chat_data[chat_id]
+    config = chat_configs.get(chat_id, chat_data)
+    user_id: int = query.from_user.id
+    if (pending := chat_data.get('join_requests', dict()).pop(user_id, None)) is None:
+        answer_callback(context.bot, query, choice(config.PERMISSION_DENY))
+        return
+    deadlines.cancel(DL_JOINREQ, chat_id, user_id, 0)
+    if not chat_data['join_requests']:
+        chat_data.pop('join_requests', None)
+    answer_callback(context.bot, query, choice(config.CHALLENGE_SUCCESS) if passed else 'Проверка не пройдена.')
+    try:
+        if passed:
+            chat_data.setdefault('join_approved', dict())[user_id] = time() + JOIN_APPROVED_TIMEOUT
+            deadlines.schedule(DL_APPROVED, chat_id, user_id, 0, time() + JOIN_APPROVED_TIMEOUT)
+            context.bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id)
+        else:
+            context.bot.decline_chat_join_request(chat_id=chat_id, user_id=user_id)
+    except TelegramError as err:
+        logger.error(f'Cannot {"approve" if passed else "decline"} the join request of {user_id} to {chat_id}, {err}')
+    else:
+        logger.info(f'Join request of {user_id} to the group {chat_id} {"approved" if passed else "declined"}')
+    close_join_request(context.bot, user_id, pending[0],
+                       'Проверка пройдена, заявка одобрена.' if passed else 'Проверка не пройдена, заявка отклонена.')
+    ppersistence.update_chat_data(chat_id, chat_data)
+
+def close_join_request(bot: Bot, user_id: int, message_id: int, text: str) -> None:
+    '''
+        the buttons of a decided join request are replaced by the verdict
+    '''
+    try:
+        bot.edit_message_text(text, chat_id=user_id, message_id=message_id)
+    except TelegramError as err:
+        logger.info(f'Cannot close the join request challenge {message_id} of {user_id}, {err}')
+
+def join_request_timeouts(context: CallbackContext, chat_id: int, records: List[Deadline]) -> None:
+    chat_data: dict = updater.dispatcher.chat_data[chat_id]
+    pending: dict = chat_data.get('join_requests', dict())
+    for rec in records:
+        if (request := pending.pop(rec.user_id, None)) is None:
+            continue
+        try:
+            context.bot.decline_chat_join_request(chat_id=chat_id, user_id=rec.user_id)
+        except TelegramError as err:
+            logger.info(f'Cannot decline the join request of {rec.user_id} to {chat_id}, {err}')
+        else:
+            logger.info(f'Join request of {rec.user_id} to the group {chat_id} declined, challenge timeout')
+        close_join_request(context.bot, rec.user_id, request[0], 'Время проверки истекло, заявка отклонена.')
+    if not pending:
+        chat_data.pop('join_requests', None)
+    ppersistence.update_chat_data(chat_id, chat_data)
+
+def join_approvals_expired(context: CallbackContext, chat_id: int, records: List[Deadline]) -> None:
+    '''
+        the user of an approved join request did not join, a later join is challenged
+    '''
+    chat_data: dict = updater.dispatcher.chat_data[chat_id]
+    approved: dict = chat_data.get('join_approved', dict())
+    for rec in records:
+        approved.pop(rec.user_id, None)
+    if not approved:
+        chat_data.pop('join_approved', None)
+    ppersistence.update_chat_data(chat_id, chat_data)
+
+DEADLINE_HANDLERS = {
+    DL_CHALLENGE: challenge_timeouts,
+    DL_DELETE: delayed_deletions,
+    DL_FLDEDIT: flood_captcha_edits,
+    DL_LOCKDOWN: lockdown_timeouts,
+    DL_JOINREQ: join_request_timeouts,
+    DL_SEND: challenge_sends,
+    DL_APPROVED: join_approvals_expired,
+}
+
+def run_deadlines(context: CallbackContext) -> None:
+    '''
+        expired deadlines of the same kind in the same chat are handled as one batch
+    '''
+    for ((kind, chat_id), records) in deadlines.advance(time()).items():
+        updater.dispatcher.shards.submit(chat_id, DEADLINE_HANDLERS[kind], context, chat_id, records)
 
 @collect_error
 @filter_old_updates
@@ -756,12 +1168,8 @@ def at_admins(update: Update, context: CallbackContext) -> None:
     last_at_admins: float = context.chat_data.setdefault('last_at_admins', 0.0)
     if time() - last_at_admins < AT_ADMINS_RATELIMIT:
         notice: Message = update.message.reply_text(f"Пожалуйста, подождите {AT_ADMINS_RATELIMIT - (time() - last_at_admins): .3f} секунд")
-        def delete_notice(_: CallbackContext) -> None:
-            for _msg_id in (update.message.message_id, notice.message_id):
-                delete_message(context, chat_id=chat_id, message_id=_msg_id)
-            logger.debug((f"Deleted at_admin spam messages {update.message.message_id} and "
-                          f"{notice.message_id} from {update.message.from_user.id}"))
-        context.job_queue.run_once(delete_notice, 5)
+        for _msg_id in (update.message.message_id, notice.message_id):
+            deadlines.schedule(DL_DELETE, chat_id, 0, _msg_id, time() + 5)
     else:
         admins: List[str] = getAdminUsernames(bot, chat_id, markdown=True)
         if admins:
@@ -801,8 +1209,7 @@ def write_settings(update: Update, context: CallbackContext) -> None:
     context.chat_data['settings_call'] = None
     if ret:
         settings_menu(update, context, additional_text="Настройки успешно сохранены\n\n")
-        context.chat_data['chat_settings'] = settings.to_dict()
-        ppersistence.flush()
+        save_settings(update.message.chat.id, context.chat_data, settings)
     else:
         settings_menu(update, context, additional_text="Ваш ввод некорректен, попробуйте еще раз\n\n")
 
@@ -880,8 +1287,7 @@ def settings_callback(update: Update, context: CallbackContext) -> None:
             if len(args) == 3 and args[2] == 'default':
                 callback_answered = True
                 if settings.put(item, ''):
-                    context.chat_data['chat_settings'] = settings.to_dict()
-                    ppersistence.flush()
+                    save_settings(chat_id, context.chat_data, settings)
                     update.callback_query.answer('Успешно', show_alert=True)
                     # refresh
                     settings = chatSettings(context.chat_data.get('chat_settings', dict()))
@@ -899,8 +1305,7 @@ def settings_callback(update: Update, context: CallbackContext) -> None:
                         return
                     callback_answered = True
                     if settings.delete_clg_question(index):
-                        context.chat_data['chat_settings'] = settings.to_dict()
-                        ppersistence.flush()
+                        save_settings(chat_id, context.chat_data, settings)
                         update.callback_query.answer('Успешно', show_alert=True)
                         # refresh
                         settings = chatSettings(context.chat_data.get('chat_settings', dict()))
@@ -939,8 +1344,7 @@ def settings_callback(update: Update, context: CallbackContext) -> None:
                 if setting_type == "bool":
                     callback_answered = True
                     if settings.put(item, 'dummy'):
-                        context.chat_data['chat_settings'] = settings.to_dict()
-                        ppersistence.flush()
+                        save_settings(chat_id, context.chat_data, settings)
                         update.callback_query.answer('Успешно', show_alert=True)
                         # refresh
                         settings = chatSettings(context.chat_data.get('chat_settings', dict()))
@@ -975,10 +1379,8 @@ def new_messages(update: Update, context: CallbackContext) -> None:
     chat_type: str = update.effective_message.chat.type
     if chat_type in ('private', 'channel'):
         return
-    sto_msgs: List[Tuple[int, int, int]] = context.chat_data.setdefault('stored_messages', list())
-    sto_msgs.append((update.effective_user.id, update.effective_message.message_id, int(time())))
-    while len(sto_msgs) > STORE_CHAT_MESSAGES:
-        sto_msgs.pop(0)
+    sto_msgs = stored_messages(context.chat_data)
+    sto_msgs.append(update.effective_user.id, update.effective_message.message_id)
     # --- СПАМ/РЕКЛАМА ---
     msg = update.effective_message
     admin_ids = getAdminIds(context.bot, msg.chat_id)
@@ -987,10 +1389,11 @@ def new_messages(update: Update, context: CallbackContext) -> None:
     suspect = False
     reason = ''
     if not is_admin:
-        # Проверка текста сообщения
-        if msg and msg.text and is_spam_message(msg.text):
+        # Проверка текста сообщения, все признаки спама за один проход
+        features = scan_spam_features(msg.text) if msg and msg.text else None
+        if features and features.is_spam:
             suspect = True
-            reason = 'spam text'
+            reason = f'spam text: {features}'
         # Проверка имени пользователя
         elif is_suspect_user(update.effective_user):
             suspect = True
@@ -998,22 +1401,19 @@ def new_messages(update: Update, context: CallbackContext) -> None:
     if suspect:
         logger.info(f"Spam detected from user {user_id} in chat {msg.chat_id} ({reason})")
         # Удаляем все сообщения пользователя за последние 2 часа
-        now = int(time())
-        MSG_DELETE_WINDOW = 2 * 60 * 60  # 2 часа
-        msgids_to_delete = [m_id for u_id, m_id, t in sto_msgs if u_id == user_id and now - t < MSG_DELETE_WINDOW]
+        msgids_to_delete = sto_msgs.of_user(user_id, window=MSG_STORE_AGE)
         msgids_to_delete.append(msg.message_id)
-        for mid in set(msgids_to_delete):
-            delete_message(context, msg.chat_id, mid)
+        delete_messages(context, msg.chat_id, set(msgids_to_delete))
         # Учёт нарушений
         spam_violations = context.chat_data.setdefault('spam_violations', dict())
         spam_violations[user_id] = spam_violations.get(user_id, 0) + 1
         # Баним при повторном нарушении
         if spam_violations[user_id] >= 2:
-            restrict_user(context, msg.chat_id, user_id, extra=' [spam ban]')
-            kick_user(context, msg.chat_id, user_id, reason='Repeated spam')
+            restrict_user(context, msg.chat_id, user_id, extra=' [spam ban]', block=False)
+            kick_user(context, msg.chat_id, user_id, reason='Repeated spam', block=False)
             logger.info(f"User {user_id} banned for repeated spam in chat {msg.chat_id}")
         else:
-            restrict_user(context, msg.chat_id, user_id, extra=' [spam detected]')
+            restrict_user(context, msg.chat_id, user_id, extra=' [spam detected]', block=False)
         return
     # --- END СПАМ ---
     if update.message and update.message.text:
@@ -1029,8 +1429,8 @@ def left_member(update: Update, context: CallbackContext) -> None:
         return
     chat_id: int = update.message.chat_id
     msg_id: int = update.message.message_id
-    settings = chatSettings(context.chat_data.get('chat_settings', dict()))
-    DEL_LEAVE_MSG = settings.get('DEL_LEAVE_MSG')
+    config = chat_configs.get(chat_id, context.chat_data)
+    DEL_LEAVE_MSG = config.DEL_LEAVE_MSG
     if DEL_LEAVE_MSG:
         logger.debug(f'Deleted left_member message {msg_id} for {chat_id}')
         delete_message(context, chat_id, msg_id)
@@ -1051,85 +1451,119 @@ def new_members(update: Update, context: CallbackContext) -> None:
     assert update.message.new_chat_members
     users: List[User] = update.message.new_chat_members
     invite_user: User = update.message.from_user
+    lockdown = raid_lockdown(context, chat_id, len([u for u in users if u.id != bot.id]))
     for user in users:
         if user.id == bot.id:
             logger.info(f"Myself joined the group {chat_id}")
         else:
             logger.debug(f"{user.id} joined the group {chat_id}")
-            if invite_user.id != user.id and invite_user.id in getAdminIds(bot, chat_id):
+            if user.id in context.chat_data.get('join_approved', ()):
+                # answered the challenge of their join request
+                context.chat_data['join_approved'].pop(user.id)
+                deadlines.cancel(DL_APPROVED, chat_id, user.id, 0)
+            elif invite_user.id != user.id and invite_user.id in getAdminIds(bot, chat_id):
                 # An admin invited him.
                 logger.info((f"{'bot ' if user.is_bot else ''}{user.id} invited by admin "
                                 f"{invite_user.id} into the group {chat_id}"))
             else:
-                simple_challenge(context, chat_id, user, invite_user, update.effective_message.message_id)
+                simple_challenge(context, chat_id, user, invite_user, update.effective_message.message_id, lockdown)
+
+def migrate_chat_data(chat_id: int, chat_data: dict) -> None:
+    """
+    Обновление старых форматов данных, выполняется один раз при загрузке чата.
+    """
+    for key in ('my_msg', 'rest_users'):
+        if key in chat_data:
+            d = chat_data.pop(key, None)
+            logger.warning(f'Обновление формата данных: Удален {{{key}: {d}}} для чата {chat_id}')
+    if isinstance(chat_data.get('join_approved'), set):
+        # approvals without expiry
+        chat_data['join_approved'] = dict.fromkeys(chat_data['join_approved'], time() + JOIN_APPROVED_TIMEOUT)
+    u_mgr = chat_data.get('u_mgr')
+    if u_mgr and u_mgr._cver != u_mgr.ver:
+        chat_data.pop('u_mgr', None)
+        logger.warning(f'Обновление u_mgr: реинициализация с {u_mgr._cver} до {u_mgr.ver} для чата {chat_id}')
+
+def expire_pending_users(chat_id: int, records: List[Deadline]) -> Tuple[int, int]:
+    '''
+        runs in the shard of chat_id, returns (users freed, bytes freed)
+    '''
+    u_freed = bytes_freed = 0
+    u_mgr = updater.dispatcher.chat_data[chat_id].get('u_mgr')
+    if not u_mgr:
+        return (0, 0)
+    for rec in records:
+        rest_user = u_mgr.get(rec.user_id)
+        # the user may have joined again meanwhile
+        if rest_user and rest_user.join_msgid == rec.join_msgid:
+            u_mgr.pop(rec.user_id)
+            lockdown_release(updater.dispatcher.chat_data[chat_id], rec.user_id)
+            u_freed += 1
+            bytes_freed += sys.getsizeof(rest_user)
+    return (u_freed, bytes_freed)
+
+def forget_idle_chat(chat_id: int) -> None:
+    '''
+        runs in the shard of chat_id, the chat is read from the database
+        again on its next update. Chats with pending state are kept.
+    '''
+    chat_data: dict = updater.dispatcher.chat_data[chat_id]
+    u_mgr: UserManager = chat_data.get('u_mgr', None)
+    if (u_mgr and len(u_mgr)) or chat_data.get('lockdown', None) or chat_data.get('join_requests', None):
+        return
+    ppersistence.forget_chat(chat_id)
+
+class GCTick:
+    '''
+        The results of one tick are summed up by the shards as they finish,
+        the job thread does not wait for them. The last one logs the tick.
+    '''
+    def __init__(self, chats: int, start: float) -> None:
+        self.chats = self.remaining = chats
+        self.start = start
+        self.u_freed = self.bytes_freed = 0
+        self._lock = Lock()
+    def done(self, future: Future) -> None:
+        with self._lock:
+            if future.exception() is None:
+                (u, b) = future.result()
+                self.u_freed += u
+                self.bytes_freed += b
+            self.remaining -= 1
+            if self.remaining:
+                return
+        logger.info(f'Очистка памяти: {self.chats} чатов за {(time() - self.start) * 1000:.1f} мс, '
+                    f'освобождено {self.u_freed} пользователей ({self.bytes_freed} байт), в очереди {len(gc_backlog)} чатов.')
 
 def do_garbage_collection(context: CallbackContext) -> None:
     """
-    Периодическая очистка устаревших данных в памяти бота.
-    Удаляет старые сообщения и пользователей из хранилища для экономии памяти.
+    Инкрементальная очистка памяти: за один тик обрабатывается не более
+    GC_CHATS_PER_TICK чатов, в которых по gc_index есть устаревшие пользователи.
+    Остальные чаты ждут следующего тика в gc_backlog.
     """
-    u_freed = m_freed = u_checked = m_checked = 0
-    current_time = int(time())
-    expiry_time = 7200  # 2 часа в секундах
-    
-    all_chat_data = updater.dispatcher.chat_data
-    logger.debug('Начало очистки памяти: проверка устаревших ключей')
-    
-    # Удаление устаревших ключей
-    for chat_id in all_chat_data:
-        chat_data = all_chat_data[chat_id]
-        
-        # Удаление старых форматов данных
-        for key in ('my_msg', 'rest_users'):
-            if key in chat_data:
-                d = chat_data.pop(key, None)
-                logger.warning(f'Обновление формата данных: Удален {{{key}: {d}}} для чата {chat_id}')
-        
-        # Проверка версии UserManager
-        u_mgr = chat_data.get('u_mgr')
-        if u_mgr and u_mgr._cver != u_mgr.ver:
-            chat_data.pop('u_mgr', None)
-            logger.warning(f'Обновление u_mgr: реинициализация с {u_mgr._cver} до {u_mgr.ver} для чата {chat_id}')
-            del u_mgr
-        
-        # Очистка старых пользователей
-        u_mgr = chat_data.get('u_mgr')
-        if u_mgr:
-            for user_list in (u_mgr._nfusers, u_mgr._fldusers):
-                users_to_remove = []
-                
-                # Проверка всех пользователей
-                for user_id, user_data in user_list.items():
-                    u_checked += 1
-                    if user_data and current_time - user_data.time > expiry_time:
-                        users_to_remove.append(user_id)
-                
-                # Удаление отмеченных пользователей
-                for user_id in users_to_remove:
-                    user_list.pop(user_id, None)
-                    u_freed += 1
-        
-        # Очистка старых сообщений
-        sto_msgs = chat_data.get('stored_messages')
-        if isinstance(sto_msgs, list):
-            msgs_to_remove = []
-            try:
-                for item in sto_msgs:
-                    m_checked += 1
-                    if len(item) == 3 and current_time - item[2] > expiry_time:
-                        msgs_to_remove.append(item)
-                        
-                # Удаление отмеченных сообщений
-                for item in msgs_to_remove:
-                    sto_msgs.remove(item)
-                    m_freed += 1
-            except Exception:
-                print_traceback(debug=DEBUG)
-    
-    logger.info(
-        f'Очистка памяти: проверено {u_checked} пользователей, {m_checked} сообщений; '
-        f'освобождено {u_freed} пользователей, {m_freed} сообщений.'
-    )
+    start = time()
+    gc_backlog.extend(gc_index.advance(start).items())
+    join_rate.collect(start)
+    for chat_id in ppersistence.idle_chats(CHAT_IDLE)[:GC_CHATS_PER_TICK]:
+        updater.dispatcher.shards.submit(chat_id, forget_idle_chat, chat_id)
+    chats = min(len(gc_backlog), GC_CHATS_PER_TICK)
+    if not chats:
+        return
+    tick = GCTick(chats, start)
+    for _ in range(chats):
+        ((_, chat_id), records) = gc_backlog.popleft()
+        updater.dispatcher.shards.submit(chat_id, expire_pending_users, chat_id, records).add_done_callback(tick.done)
+
+def log_stats(context: CallbackContext) -> None:
+    logger.info(f'Кэш оценок имён: {score_cache.stats()}')
+    logger.info(f'Кэш администраторов: {getAdmins.cache.stats()}')
+    logger.info(f'Очередь действий: {action_queue.stats()}')
+    logger.info(f'Circuit breaker: {circuit_breaker.stats()}')
+    logger.info(f'Очистка памяти: {len(gc_index)} в индексе, {len(gc_backlog)} чатов в очереди')
+    logger.info(f'Шарды: {updater.dispatcher.shards.stats()}')
+    logger.info(f'Настройки чатов: {len(chat_configs)} скомпилировано')
+    logger.info(f'Чатов в памяти: {len(updater.dispatcher.chat_data)}')
+    getAdmins.cache.collect()
 
 @collect_error
 @filter_old_updates
@@ -1143,41 +1577,51 @@ def service_message(update: Update, context: CallbackContext) -> None:
     
     chat_id: int = update.message.chat_id
     msg_id: int = update.message.message_id
-    settings = chatSettings(context.chat_data.get('chat_settings', dict()))
+    config = chat_configs.get(chat_id, context.chat_data)
     
     # Проверяем настройку DEL_SERVICE_MSG
-    if settings.get('DEL_SERVICE_MSG'):
+    if config.DEL_SERVICE_MSG:
         logger.debug(f'Deleted service message {msg_id} for {chat_id}')
         delete_message(context, chat_id, msg_id)
     else:
         logger.debug(f'Not deleting service message {msg_id} for {chat_id}')
 
 if __name__ == '__main__':
-    ppersistence = PicklePersistence(filename=PICKLE_FILE, store_user_data=False, on_flush=True)
-    updater = Updater(bot=mqbot, workers=WORKERS, persistence=ppersistence, use_context=True)
+    ppersistence = SQLitePersistence(SQLITE_FILE, import_pickle=PICKLE_FILE, on_load=migrate_chat_data)
+    # every update of a chat goes to the same one of WORKERS shards, handlers are not run_async
+    job_queue = JobQueue()
+    dispatcher = ShardedDispatcher(mqbot, Queue(), job_queue=job_queue,
+                                   persistence=ppersistence, use_context=True, shards=WORKERS)
+    job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None)
 
     if USER_BOT_BACKEND:
-        from userbot_backend import (kick_user, restrict_user, unban_user, delete_message,
-                                     userbot_updater)
+        from userbot_backend import (kick_user, restrict_user, unban_user, delete_message, delete_messages,
+                                     lock_chat, unlock_chat, userbot_updater)
     else:
-        from bot_backend import kick_user, restrict_user, unban_user, delete_message
-    updater.job_queue.start()
-    updater.job_queue.run_repeating(do_garbage_collection, GARBAGE_COLLECTION_INTERVAL, first=5)
+        from bot_backend import (kick_user, restrict_user, unban_user, delete_message, delete_messages,
+                                 lock_chat, unlock_chat)
+    updater.job_queue.run_repeating(do_garbage_collection, GC_TICK, first=GC_TICK)
+    updater.job_queue.run_repeating(log_stats, GARBAGE_COLLECTION_INTERVAL, first=5)
+    updater.job_queue.run_repeating(run_deadlines, deadlines.resolution, first=deadlines.resolution)
     updater.dispatcher.add_error_handler(error_callback)
-    updater.dispatcher.add_handler(CommandHandler('start', start, run_async=True))
-    updater.dispatcher.add_handler(CommandHandler('help', help_command, run_async=True))
-    updater.dispatcher.add_handler(CommandHandler('source', source, run_async=True))
-    updater.dispatcher.add_handler(CommandHandler('admins', at_admins, run_async=True))
-    updater.dispatcher.add_handler(CommandHandler('admin', at_admins, run_async=True))
-    updater.dispatcher.add_handler(CommandHandler('settings', settings_menu, run_async=True))
-    updater.dispatcher.add_handler(CommandHandler('cancel', settings_cancel, run_async=True))
-    updater.dispatcher.add_handler(CommandHandler('ban', ban_user, run_async=True))
-    updater.dispatcher.add_handler(CallbackQueryHandler(challenge_verification, pattern=r'clg', run_async=True))
-    updater.dispatcher.add_handler(CallbackQueryHandler(settings_callback, pattern=r'settings', run_async=True))
+    updater.dispatcher.add_handler(CommandHandler('start', start))
+    updater.dispatcher.add_handler(CommandHandler('help', help_command))
+    updater.dispatcher.add_handler(CommandHandler('source', source))
+    updater.dispatcher.add_handler(CommandHandler('admins', at_admins))
+    updater.dispatcher.add_handler(CommandHandler('admin', at_admins))
+    updater.dispatcher.add_handler(CommandHandler('settings', settings_menu))
+    updater.dispatcher.add_handler(CommandHandler('cancel', settings_cancel))
+    updater.dispatcher.add_handler(CommandHandler('ban', ban_user))
+    updater.dispatcher.add_handler(CallbackQueryHandler(challenge_verification, pattern=r'clg'))
+    updater.dispatcher.add_handler(CallbackQueryHandler(join_request_answer, pattern=r'jrq'))
+    updater.dispatcher.add_handler(ChatJoinRequestHandler(join_request))
+    updater.dispatcher.add_handler(CallbackQueryHandler(settings_callback, pattern=r'settings'))
+    updater.dispatcher.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.ANY_CHAT_MEMBER))
     
     # Обработчики системных сообщений
-    updater.dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members, new_members, run_async=True))
-    updater.dispatcher.add_handler(MessageHandler(Filters.status_update.left_chat_member, left_member, run_async=True))
+    updater.dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members, new_members))
+    updater.dispatcher.add_handler(MessageHandler(Filters.status_update.left_chat_member, left_member))
 
     # Объединенный обработчик всех остальных типов системных сообщений
     service_message_filter = (
@@ -1195,20 +1639,45 @@ if __name__ == '__main__':
         Filters.status_update.voice_chat_ended |
         Filters.status_update.voice_chat_participants_invited
     )
-    updater.dispatcher.add_handler(MessageHandler(service_message_filter, service_message, run_async=True))
+    updater.dispatcher.add_handler(MessageHandler(service_message_filter, service_message))
 
     # Обработчик обычных сообщений должен быть последним
     updater.dispatcher.add_handler(MessageHandler(InvertedFilter(Filters.status_update & \
-                                                  Filters.update.channel_posts), new_messages, run_async=True))
+                                                  Filters.update.channel_posts), new_messages))
+
+    def start_worker(worker: int = 0, workers: int = 1) -> None:
+        updater.job_queue.start()
+        restore_pending_challenges(worker, workers)
+
     if USER_BOT_BACKEND:
         logger.info('Antispambot started with userbot backend.')
+        start_worker()
         try:
             userbot_updater.start()
-            updater.start_polling()
+            updater.start_polling(allowed_updates=ALLOWED_UPDATES)
             updater.idle()
         finally:
             userbot_updater.stop()
+    elif CLUSTER_PROCESSES > 1:
+        # nothing may start a thread or touch the network before the fork
+        from cluster import run_cluster
+        logger.info(f'Antispambot started with {CLUSTER_PROCESSES} worker processes.')
+        share_budget()
+        webhook = None
+        if WEBHOOK_URL:
+            webhook = {'url': WEBHOOK_URL, 'listen': WEBHOOK_LISTEN, 'port': WEBHOOK_PORT,
+                       'path': webhook_path(WEBHOOK_URL), 'secret': secret_token(SALT, TOKEN)}
+        run_cluster(updater, CLUSTER_PROCESSES, start_worker, allowed_updates=ALLOWED_UPDATES,
+                    persistence=ppersistence, webhook=webhook)
+    elif WEBHOOK_URL:
+        logger.info(f'Antispambot started with webhook {WEBHOOK_URL}.')
+        start_worker()
+        receiver = WebhookReceiver(WEBHOOK_LISTEN, WEBHOOK_PORT, webhook_path(WEBHOOK_URL), secret_token(SALT, TOKEN),
+                                   on_update=lambda data: updater.update_queue.put(Update.de_json(data, updater.bot)))
+        set_webhook(updater.bot, WEBHOOK_URL, secret_token(SALT, TOKEN), ALLOWED_UPDATES)
+        serve(updater, receiver)
     else:
         logger.info('Antispambot started.')
-        updater.start_polling()
+        start_worker()
+        updater.start_polling(allowed_updates=ALLOWED_UPDATES)
         updater.idle()
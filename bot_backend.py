@@ -1,25 +1,85 @@
-# This is the bot api backend of kick_user, restrict_user, unban_user, delete_message
+# This is the bot api backend of kick_user, restrict_user, unban_user, delete_message, lock_chat, unlock_chat
 import logging
 logger = logging.getLogger('antispambot.backend')
 
-from typing import List, Callable
+from typing import List, Dict, Iterable, Callable, Union
+from concurrent.futures import Future
+from functools import partial
+from collections import OrderedDict
+from threading import Lock
+from time import sleep
 from telegram import Bot, ChatPermissions
 from telegram.ext import CallbackContext
-from telegram.error import (TelegramError, Unauthorized, BadRequest,
-                            TimedOut, ChatMigrated, NetworkError)
+from telegram.error import TelegramError, BadRequest, NetworkError, RetryAfter
 
 from utils import print_traceback
 from datetime import datetime, timedelta
 
 from config import DEBUG
+from ratelimited import action_queue, backoff_delay, CircuitOpenError, PRIO_CHAT, PRIO_RESTRICT, PRIO_KICK, PRIO_DELETE
 
-def kick_user(context: CallbackContext, chat_id: int, kick_id: int, reason: str = '') -> bool:
+def queued(priority: int, block: bool = True) -> Callable:
+    '''
+        Run the action in ratelimited.action_queue.
+        The wrapped function accepts an extra `block` argument:
+        True waits for the result, False returns a Future of it.
+    '''
+    def decorator(func: Callable) -> Callable:
+        def wrapped(context: CallbackContext, chat_id: int, *args, block: bool = block, **kwargs) -> Union[bool, Future]:
+            future = action_queue.submit(priority, chat_id, func, context, chat_id, *args, **kwargs)
+            return future.result() if block else future
+        wrapped.__name__ = func.__name__
+        return wrapped
+    return decorator
+
+def retry_on_network_error(func: Callable) -> Callable:
+    '''
+        Retry transient network errors with jittered exponential backoff.
+        RetryAfter is raised to the action queue, which puts the action back
+        and holds the budget for retry_after. Nothing is retried while the
+        circuit breaker is open.
+    '''
+    NET_RETRY = 3
+    def wrapped(*args, **kwargs) -> bool:
+        for t in range(NET_RETRY):
+            try:
+                return func(*args, **kwargs)
+            except BadRequest as err:
+                # BadRequest is a NetworkError, but retrying will not help
+                logger.error(f"Bad request {err} in {func.__name__}")
+                return False
+            except RetryAfter:
+                raise
+            except NetworkError as err:
+                logger.info(f"Network issue {err} in {func.__name__}")
+                if t + 1 < NET_RETRY:
+                    sleep(backoff_delay(t))
+        else:
+            logger.warning(f"Aborting, failed {t+1} times in {func.__name__}")
+            return False
+    return wrapped
+
+def until_date(duration: int = 0) -> datetime:
+    '''
+        Telegram lifts a ban or restriction by itself at until_date.
+        0 is forever, as is anything shorter than 30 seconds or longer than 366 days.
+    '''
+    if duration > 0:
+        return datetime.utcnow() + timedelta(seconds=max(duration, 30))
+    return datetime.utcnow() + timedelta(days=367)
+
+@queued(PRIO_KICK)
+@retry_on_network_error
+def kick_user(context: CallbackContext, chat_id: int, kick_id: int, reason: str = '', duration: int = 0) -> bool:
     bot: Bot = context.bot
     try:
-        if bot.kick_chat_member(chat_id=chat_id, user_id=kick_id, until_date=datetime.utcnow()+timedelta(days=367)):
-            logger.info(f"Kicked {kick_id} in the group {chat_id}{', reason: ' if reason else ''}{reason}")
+        if bot.kick_chat_member(chat_id=chat_id, user_id=kick_id, until_date=until_date(duration)):
+            logger.info(f"Kicked {kick_id} in the group {chat_id}{f' for {duration}s' if duration > 0 else ''}"
+                        f"{', reason: ' if reason else ''}{reason}")
         else:
             raise TelegramError('kick_chat_member returned bad status')
+    except (NetworkError, RetryAfter):
+        raise
     except TelegramError as err:
         logger.error(f"Cannot kick {kick_id} in the group {chat_id}, {err}")
     except Exception:
@@ -49,30 +109,18 @@ def _export_chat_permissions() -> List[ChatPermissions]:
 (CHAT_PERMISSION_RO, CHAT_PERMISSION_RW) = _export_chat_permissions()
 
 
-def retry_on_network_error(func: Callable) -> Callable:
-    NET_RETRY = 3
-    def wrapped(*args, **kwargs) -> bool:
-        for t in range(NET_RETRY):
-            try:
-                return func(*args, **kwargs)
-            except NetworkError as err:
-                logger.info(f"Network issue {err} in {func.__name__}")
-                continue
-        else:
-            logger.warning(f"Aborting, failed {t+1} times in {func.__name__}")
-            return False
-    return wrapped
-
+@queued(PRIO_RESTRICT)
 @retry_on_network_error
-def restrict_user(context: CallbackContext, chat_id: int, user_id: int, extra: str = '') -> bool:
+def restrict_user(context: CallbackContext, chat_id: int, user_id: int, extra: str = '', duration: int = 0) -> bool:
     try:
         if context.bot.restrict_chat_member(chat_id=chat_id, user_id=user_id,
                                 permissions = CHAT_PERMISSION_RO,
-                                until_date=datetime.utcnow()+timedelta(days=367)):
+                                until_date=until_date(duration)):
             logger.info(f"Restricted {user_id} in the group {chat_id}{extra}")
         else:
             raise TelegramError('restrict_chat_member returned bad status')
-    except NetworkError:
+    except (NetworkError, RetryAfter, CircuitOpenError):
+        # an open circuit says nothing about the rights of the bot, the caller decides
         raise
     except TelegramError as err:
         logger.error(f"Cannot restrict {user_id} in the group {chat_id}, {err}")
@@ -82,16 +130,17 @@ def restrict_user(context: CallbackContext, chat_id: int, user_id: int, extra: s
         return True
     return False
 
+@queued(PRIO_RESTRICT)
 @retry_on_network_error
 def unban_user(context: CallbackContext, chat_id: int, user_id: int, reason: str = '') -> bool:
     try:
         if context.bot.restrict_chat_member(chat_id=chat_id, user_id=user_id,
                                 permissions = CHAT_PERMISSION_RW,
-                                until_date=datetime.utcnow()+timedelta(days=367)):
+                                until_date=until_date()):
             logger.info(f"Unbanned {user_id} in the group {chat_id}{', reason: ' if reason else ''}{reason}")
         else:
             raise TelegramError('restrict_chat_member returned bad status')
-    except NetworkError:
+    except (NetworkError, RetryAfter):
         raise
     except TelegramError as err:
         logger.error(f"Cannot unban {user_id} in the group {chat_id}, {err}")
@@ -101,8 +150,49 @@ def unban_user(context: CallbackContext, chat_id: int, user_id: int, reason: str
         return True
     return False
 
+@queued(PRIO_CHAT)
+@retry_on_network_error
+def lock_chat(context: CallbackContext, chat_id: int) -> Union[dict, bool]:
+    '''
+        Nobody but admins can send messages, returns the previous
+        permissions of the chat for unlock_chat, False on failure
+    '''
+    try:
+        permissions: ChatPermissions = context.bot.get_chat(chat_id).permissions or CHAT_PERMISSION_RW
+        if context.bot.set_chat_permissions(chat_id=chat_id, permissions=CHAT_PERMISSION_RO):
+            logger.info(f"Locked the group {chat_id}")
+        else:
+            raise TelegramError('set_chat_permissions returned bad status')
+    except (NetworkError, RetryAfter):
+        raise
+    except TelegramError as err:
+        logger.error(f"Cannot lock the group {chat_id}, {err}")
+    except Exception:
+        print_traceback(DEBUG)
+    else:
+        return permissions.to_dict()
+    return False
+
+@queued(PRIO_CHAT)
+@retry_on_network_error
+def unlock_chat(context: CallbackContext, chat_id: int, permissions: dict) -> bool:
+    try:
+        if context.bot.set_chat_permissions(chat_id=chat_id, permissions=ChatPermissions(**permissions)):
+            logger.info(f"Unlocked the group {chat_id}")
+        else:
+            raise TelegramError('set_chat_permissions returned bad status')
+    except (NetworkError, RetryAfter):
+        raise
+    except TelegramError as err:
+        logger.error(f"Cannot unlock the group {chat_id}, {err}")
+    except Exception:
+        print_traceback(DEBUG)
+    else:
+        return True
+    return False
+
 @retry_on_network_error
-def delete_message(context: CallbackContext, chat_id: int, message_id: int) -> bool:
+def _delete_message(context: CallbackContext, chat_id: int, message_id: int) -> bool:
     try:
         # Проверка: не удалять слишком старые сообщения (старше 2 суток)
         # Telegram API не позволяет удалять очень старые сообщения
@@ -117,7 +207,7 @@ def delete_message(context: CallbackContext, chat_id: int, message_id: int) -> b
             return False
         else:
             logger.error(f"Cannot delete message {message_id} in the group {chat_id}, {err}")
-    except NetworkError:
+    except (NetworkError, RetryAfter):
         raise
     except TelegramError as err:
         logger.error(f"Cannot delete message {message_id} in the group {chat_id}, {err}")
@@ -126,3 +216,97 @@ def delete_message(context: CallbackContext, chat_id: int, message_id: int) -> b
     else:
         return True
     return False
+
+@retry_on_network_error
+def _delete_message_batch(context: CallbackContext, chat_id: int, message_ids: List[int]) -> bool:
+    try:
+        # messages which cannot be found are skipped by telegram
+        if context.bot.delete_messages(chat_id=chat_id, message_ids=message_ids):
+            logger.debug(f"Deleted messages {message_ids} in the group {chat_id}")
+        else:
+            raise TelegramError('delete_messages returned bad status')
+    except (NetworkError, RetryAfter):
+        raise
+    except TelegramError as err:
+        logger.info(f"Cannot delete {len(message_ids)} messages at once in the group {chat_id}, {err}")
+    except Exception:
+        print_traceback(DEBUG)
+    else:
+        return True
+    return False
+
+# Deletions are coalesced per chat: ids which arrive while a chat's flush
+# waits in the action queue are sent along with it, up to 100 per request.
+MAX_DELETE_BATCH = 100
+_pending_deletes: Dict[int, OrderedDict] = dict()  # chat_id: {message_id: [Future]}
+_pending_deletes_lock = Lock()
+
+def _set_results(futures: List[Future], done: Future) -> None:
+    result = done.result() if done.exception() is None else False
+    for future in futures:
+        future.set_result(result)
+
+def _flush_deletes(context: CallbackContext, chat_id: int) -> None:
+    with _pending_deletes_lock:
+        pending = _pending_deletes[chat_id]
+        batch = [pending.popitem(last=False) for _ in range(min(len(pending), MAX_DELETE_BATCH))]
+        if pending:
+            action_queue.submit(PRIO_DELETE, chat_id, _flush_deletes, context, chat_id)
+        else:
+            del _pending_deletes[chat_id]
+    message_ids = [mid for (mid, _) in batch]
+    try:
+        if len(batch) == 1:
+            results = {message_ids[0]: _delete_message(context, chat_id, message_ids[0])}
+        elif _delete_message_batch(context, chat_id, message_ids):
+            results = {mid: True for mid in message_ids}
+        else:
+            # find out which of them failed, every id waits for the budget on its own
+            for (mid, futures) in batch:
+                action_queue.submit(PRIO_DELETE, chat_id, _delete_message, context, chat_id, mid) \
+                    .add_done_callback(partial(_set_results, futures))
+            return
+    except RetryAfter:
+        # the action budget is held by MQBot._post, the batch goes first in the next flush
+        with _pending_deletes_lock:
+            pending = _pending_deletes.get(chat_id, None)
+            new_flush = pending is None
+            if new_flush:
+                pending = _pending_deletes[chat_id] = OrderedDict()
+            for (mid, futures) in reversed(batch):
+                pending.setdefault(mid, list()).extend(futures)
+                pending.move_to_end(mid, last=False)
+        if new_flush:
+            action_queue.submit(PRIO_DELETE, chat_id, _flush_deletes, context, chat_id)
+        return
+    for (mid, futures) in batch:
+        for future in futures:
+            future.set_result(results[mid])
+
+def delete_messages(context: CallbackContext, chat_id: int, message_ids: Iterable[int],
+                    block: bool = False) -> Dict[int, Union[bool, Future]]:
+    '''
+        Delete messages of a chat, returns {message_id: result},
+        a Future of the result unless `block` is set.
+    '''
+    futures = dict()
+    with _pending_deletes_lock:
+        pending = _pending_deletes.get(chat_id, None)
+        new_flush = pending is None
+        if new_flush:
+            pending = _pending_deletes[chat_id] = OrderedDict()
+        for mid in message_ids:
+            mid = int(mid)
+            futures[mid] = future = Future()
+            pending.setdefault(mid, list()).append(future)
+        if new_flush and not pending:
+            del _pending_deletes[chat_id]
+            new_flush = False
+    if new_flush:
+        action_queue.submit(PRIO_DELETE, chat_id, _flush_deletes, context, chat_id)
+    if block:
+        return {mid: future.result() for (mid, future) in futures.items()}
+    return futures
+
+def delete_message(context: CallbackContext, chat_id: int, message_id: int, block: bool = False) -> Union[bool, Future]:
+    return delete_messages(context, chat_id, (message_id,), block=block)[int(message_id)]
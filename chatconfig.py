@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Compiled chat settings: one immutable snapshot per chat and settings version,
+# the handlers read attributes instead of resolving defaults on every update
+from collections import OrderedDict
+from random import choice
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from chatsettings import CHAT_SETTINGS as CHAT_SETTINGS_DEFAULT
+from utils import find_cjk_letters
+
+def button_width(text: str) -> int:
+    return len(text) + len(find_cjk_letters(text)) # cjk letters has a length of 2
+
+class ChallengeTemplate(NamedTuple):
+    question: str
+    answers: Tuple[str, ...]  # the correct one first
+    widths: Tuple[int, ...]   # button_width of the answers
+
+def build_templates(questions: List[List[str]]) -> Tuple[ChallengeTemplate, ...]:
+    return tuple(ChallengeTemplate(q[0], tuple(q[1:]), tuple(button_width(a) for a in q[1:])) for q in questions)
+
+class ChatConfig(NamedTuple):
+    '''
+        chat_settings with the defaults of chatsettings.py filled in,
+        lists are tuples and CLG_QUESTIONS are measured challenge templates
+    '''
+    ver: int
+    WELCOME_WORDS: Tuple[str, ...]
+    CLG_QUESTIONS: Tuple[ChallengeTemplate, ...]
+    CHALLENGE_SUCCESS: Tuple[str, ...]
+    PERMISSION_DENY: Tuple[str, ...]
+    CHALLENGE_TIMEOUT: int
+    MIN_CLG_TIME: int
+    UNBAN_TIMEOUT: int
+    FLOOD_LIMIT: int
+    RAID_LIMIT: int
+    RAID_LOCKDOWN: int
+    JOIN_REQUESTS: bool
+    DEL_LEAVE_MSG: bool
+    DEL_SERVICE_MSG: bool
+
+    def template(self) -> ChallengeTemplate:
+        return choice(self.CLG_QUESTIONS)
+    def welcome(self, timeout: int) -> str:
+        return choice(self.WELCOME_WORDS).replace('%time%', f"{timeout}")
+assert ChatConfig._fields[1:] == tuple(CHAT_SETTINGS_DEFAULT)
+
+def _compile(name: str, value):
+    if name == 'CLG_QUESTIONS':
+        return build_templates(value)
+    default = CHAT_SETTINGS_DEFAULT[name]
+    if isinstance(default, bool):
+        return bool(value)
+    if isinstance(default, int):
+        return int(value)
+    return tuple(value)
+
+DEFAULT_CONFIG = ChatConfig(0, *(_compile(k, v) for (k, v) in CHAT_SETTINGS_DEFAULT.items()))
+
+def compile_config(ver: int, data: Optional[dict]) -> ChatConfig:
+    '''
+        unset (None) and empty values fall back to the defaults, which are compiled once
+    '''
+    if not data:
+        return DEFAULT_CONFIG if ver == 0 else DEFAULT_CONFIG._replace(ver=ver)
+    values = [ver]
+    for (name, default) in zip(ChatConfig._fields[1:], DEFAULT_CONFIG[1:]):
+        value = data.get(name, None)
+        values.append(default if value is None or value == [] else _compile(name, value))
+    return ChatConfig(*values)
+
+class ChatConfigs:
+    '''
+        The ChatConfig of every chat, replaced as a whole when its settings are saved.
+        chat_data['settings_ver'] tells whether a config is still current, e.g. after
+        chat_data was reloaded. At most maxsize configs are kept, the least recently
+        used ones are compiled again on their next update.
+    '''
+    def __init__(self, maxsize: int = 4096) -> None:
+        self.maxsize = maxsize
+        self._configs: Dict[int, ChatConfig] = OrderedDict()
+        self._lock = Lock()
+
+    def _put(self, chat_id: int, config: ChatConfig) -> None:
+        with self._lock:
+            self._configs[chat_id] = config
+            self._configs.move_to_end(chat_id)
+            while len(self._configs) > self.maxsize:
+                self._configs.popitem(last=False)
+
+    def get(self, chat_id: int, chat_data: dict) -> ChatConfig:
+        ver = chat_data.get('settings_ver', 0)
+        with self._lock:
+            config = self._configs.get(chat_id, None)
+            if config is not None and config.ver == ver:
+                self._configs.move_to_end(chat_id)
+                return config
+        config = compile_config(ver, chat_data.get('chat_settings', None))
+        self._put(chat_id, config)
+        return config
+
+    def save(self, chat_id: int, chat_data: dict, data: dict) -> ChatConfig:
+        '''
+            store new chat_settings, the config is compiled before it is swapped in
+        '''
+        ver = chat_data.get('settings_ver', 0) + 1
+        config = compile_config(ver, data)
+        chat_data['chat_settings'] = data
+        chat_data['settings_ver'] = ver
+        self._put(chat_id, config)
+        return config
+
+    def __len__(self) -> int:
+        return len(self._configs)
+
+if __name__ == "__main__":
+    # dispatch benchmark: python3 chatconfig.py [updates]
+    # the settings reads of a join (simple_challenge) and of a service message
+    import sys
+    from time import perf_counter
+    from random import shuffle
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    class chatSettings:
+        # before compiled configs, as in bot.py
+        def __init__(self, datadict):
+            self.__data = dict()
+            for k in CHAT_SETTINGS_DEFAULT:
+                d = datadict.get(k, None)
+                self.__data[k] = d
+        def get(self, name):
+            if name in CHAT_SETTINGS_DEFAULT:
+                ret = self.__data.get(name, None)
+                if ret is None:
+                    return CHAT_SETTINGS_DEFAULT[name]
+                else:
+                    return ret
+        def choice(self, name):
+            data = self.get(name)
+            if type(data) is list:
+                return choice(data)
+
+    def legacy_join(chat_id: int, chat_data: dict) -> None:
+        settings = chatSettings(chat_data.get('chat_settings', dict()))
+        (settings.get('MIN_CLG_TIME'), settings.get('CHALLENGE_TIMEOUT'), settings.get('FLOOD_LIMIT'))
+        question = settings.choice('CLG_QUESTIONS')
+        answers = question[1:]
+        shuffle(answers)
+        [len(a) + len(find_cjk_letters(a)) for a in answers]
+        settings.choice('WELCOME_WORDS').replace('%time%', '60')
+    def legacy_service(chat_id: int, chat_data: dict) -> None:
+        chatSettings(chat_data.get('chat_settings', dict())).get('DEL_SERVICE_MSG')
+
+    configs = ChatConfigs()
+    def join(chat_id: int, chat_data: dict) -> None:
+        config = configs.get(chat_id, chat_data)
+        (config.MIN_CLG_TIME, config.CHALLENGE_TIMEOUT, config.FLOOD_LIMIT)
+        template = config.template()
+        order = list(range(len(template.answers)))
+        shuffle(order)
+        [template.widths[n] for n in order]
+        config.welcome(60)
+    def service(chat_id: int, chat_data: dict) -> None:
+        configs.get(chat_id, chat_data).DEL_SERVICE_MSG
+
+    chats = [(-1000000000000 - n, dict()) for n in range(1000)]
+    for (n, (chat_id, chat_data)) in enumerate(chats):
+        if n % 2:
+            # half of the chats have their own settings
+            configs.save(chat_id, chat_data, {'CLG_QUESTIONS': [['2+2?', '4', '3', '5', '22']], 'FLOOD_LIMIT': 10,
+                                              'WELCOME_WORDS': ['Ответьте за %time% секунд']})
+    def bench(name: str, func) -> None:
+        start = perf_counter()
+        for n in range(total):
+            func(*chats[n % len(chats)])
+        elapsed = perf_counter() - start
+        print(f"{name:>24}: {total / elapsed:12,.0f}/s, {elapsed / total * 1e6:6.2f} us")
+    bench('join, chatSettings', legacy_join)
+    bench('join, ChatConfig', join)
+    bench('service, chatSettings', legacy_service)
+    bench('service, ChatConfig', service)
@@ -26,6 +26,9 @@ CHAT_SETTINGS = {
     'MIN_CLG_TIME': 15,
     'UNBAN_TIMEOUT': 5*60,
     'FLOOD_LIMIT': 5,
+    'RAID_LIMIT': 20,
+    'RAID_LOCKDOWN': 10*60,
+    'JOIN_REQUESTS': False,
     'DEL_LEAVE_MSG': True,
     'DEL_SERVICE_MSG': True,
 }
@@ -39,6 +42,9 @@ CHAT_SETTINGS_HELP = {
     'MIN_CLG_TIME': ("Минимальное динамическое время проверки", "Минимальное значение динамического времени проверки в секундах, диапазон от 0 до времени ожидания проверки", "int"),
     'UNBAN_TIMEOUT': ("Время разбана", "Время разбана после истечения времени ожидания или неудачной проверки, в секундах. Установите 0 или более 86400 для постоянного бана", "int"),
     'FLOOD_LIMIT': ("Защита от флуда", "При большом количестве новых участников за короткое время активируется защита от флуда. Установите 0 для отключения, 1 для постоянного включения", "int"),
+    'RAID_LIMIT': ("Защита от рейдов", "Если за минуту вступает столько участников, чат закрывается для всех, кроме администраторов, а новые участники проходят общую проверку без отдельных ограничений. Установите 0 для отключения", "int"),
+    'RAID_LOCKDOWN': ("Длительность закрытия при рейде", "Чат открывается автоматически, если за это время (в секундах) не было новых вступлений, диапазон от 60 до 86400", "int"),
+    'JOIN_REQUESTS': ("Проверка заявок на вступление", "Если в группе включено одобрение новых участников, бот задаёт вопрос проверки в личных сообщениях и сам одобряет или отклоняет заявку", "bool"),
     'DEL_LEAVE_MSG': ("Удаление сообщений о выходе", "Удалять сообщения о выходе или удалении пользователей", "bool"),
     'DEL_SERVICE_MSG': ("Удаление системных сообщений", "Удалять все системные сообщения Telegram (изменения названия, фото группы, закрепленные сообщения и т.д.)", "bool"),
 }
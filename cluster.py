@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Multi-process mode: one receiver fetches updates and fans them out by chat_id
+# to worker processes, every worker owns the chats with chat_id % processes == n
+import logging
+logger = logging.getLogger('antispambot.cluster')
+
+import os
+import signal
+import multiprocessing
+from threading import Thread
+from time import sleep
+from typing import Callable, List
+
+from telegram import Update
+from telegram.error import TelegramError, RetryAfter
+from telegram.ext import Updater
+
+from ratelimited import backoff_delay
+from webhook import WebhookReceiver, is_stale, set_webhook
+
+# update types which carry a chat, checked in this order
+CHAT_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+               'my_chat_member', 'chat_member', 'chat_join_request')
+
+def raw_chat_id(update: dict) -> int:
+    '''
+        chat_id of an update as received from the Bot API, without building an Update.
+        Updates without a chat go by user id.
+    '''
+    for field in CHAT_FIELDS:
+        obj = update.get(field, None)
+        if obj is not None:
+            return obj['chat']['id']
+    query = update.get('callback_query', None)
+    if query is not None:
+        # the challenge of a join request is answered in private, it belongs to the group
+        if query.get('data', '').startswith('jrq '):
+            try:
+                return int(query['data'].split()[1])
+            except (IndexError, ValueError):
+                pass
+        if 'message' in query:
+            return query['message']['chat']['id']
+        return query['from']['id']
+    for obj in update.values():
+        if isinstance(obj, dict) and 'from' in obj:
+            return obj['from']['id']
+    return 0
+
+def receive(updater: Updater, inboxes: List[multiprocessing.Queue], allowed_updates: List[str] = None,
+            poll_timeout: int = 10, stop: Callable[[], bool] = lambda: False) -> None:
+    '''
+        long polling in the receiver process, updates stay raw dicts
+    '''
+    bot = updater.bot
+    offset = None
+    errors = 0
+    while not stop():
+        data = {'timeout': poll_timeout}
+        if offset is not None:
+            data['offset'] = offset
+        if allowed_updates is not None:
+            data['allowed_updates'] = allowed_updates
+        try:
+            updates = bot._post('getUpdates', data, timeout=poll_timeout + 5)
+        except RetryAfter as err:
+            sleep(err.retry_after)
+            continue
+        except TelegramError as err:
+            logger.warning(f'getUpdates failed: {err}')
+            sleep(backoff_delay(errors))
+            errors += 1
+            continue
+        errors = 0
+        batches = [list() for _ in inboxes]
+        for update in updates:
+            offset = update['update_id'] + 1
+            if not is_stale(update):
+                batches[raw_chat_id(update) % len(inboxes)].append(update)
+        # one message per worker and poll
+        for (inbox, batch) in zip(inboxes, batches):
+            if batch:
+                inbox.put(batch)
+
+def work(updater: Updater, inbox: multiprocessing.Queue) -> None:
+    '''
+        main loop of a worker process, parses the updates of its own chats
+    '''
+    dispatcher = updater.dispatcher
+    Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            break
+        for data in batch:
+            try:
+                dispatcher.update_queue.put(Update.de_json(data, updater.bot))
+            except Exception:
+                logger.exception(f'Bad update {data}')
+
+def run_cluster(updater: Updater, processes: int, start_worker: Callable[[int, int], None],
+                allowed_updates: List[str] = None, persistence=None, webhook: dict = None) -> None:
+    '''
+        Fork `processes` workers and receive updates in this process, by long polling
+        or by a WebhookReceiver built from `webhook` (url and its arguments except on_update).
+        start_worker(n, processes) is called in every worker before it takes updates,
+        persistence is reconnected after the fork.
+    '''
+    ctx = multiprocessing.get_context('fork')
+    inboxes = [ctx.Queue() for _ in range(processes)]
+    if persistence is not None:
+        persistence.close()
+
+    def child(n: int) -> None:
+        signal.signal(signal.SIGTERM, lambda *_: inboxes[n].put(None))
+        if persistence is not None:
+            persistence.connect()
+        start_worker(n, processes)
+        try:
+            work(updater, inboxes[n])
+        finally:
+            updater.dispatcher.stop()
+            updater.job_queue.stop()
+            if persistence is not None:
+                persistence.flush()
+            logger.info(f'Worker {n} ({os.getpid()}) stopped')
+
+    workers = [ctx.Process(target=child, args=(n,), name=f'worker-{n}', daemon=True) for n in range(processes)]
+    for p in workers:
+        p.start()
+    logger.info(f'Receiver {os.getpid()} started {processes} workers')
+    alive = lambda: all(p.is_alive() for p in workers)
+    receiver = None
+    try:
+        if webhook is None:
+            receive(updater, inboxes, allowed_updates, stop=lambda: not alive())
+        else:
+            webhook = dict(webhook)
+            url = webhook.pop('url')
+            receiver = WebhookReceiver(on_update=lambda u: inboxes[raw_chat_id(u) % processes].put([u]), **webhook)
+            receiver.start()
+            set_webhook(updater.bot, url, webhook['secret'], allowed_updates)
+            while alive():
+                sleep(1)
+        logger.error('A worker died, stopping')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if receiver is not None:
+            receiver.stop()
+        for q in inboxes:
+            q.put(None)
+        for p in workers:
+            p.join(timeout=30)
+            if p.is_alive():
+                p.terminate()
+
+if __name__ == "__main__":
+    # scaling benchmark: python3 cluster.py [updates] [chats]
+    # the receiver fans out fake updates, workers parse them and run the spam checks of new_messages
+    import sys
+    from time import perf_counter
+    from fakeapi import FakeBotAPI
+    from utils import is_spam_message, is_suspect_user
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    chats = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    api = FakeBotAPI(rate=total, chats=chats)
+    api._generated_until -= 1
+    api.MAX_PENDING = total
+    api._generate()
+    updates = api._pending
+
+    def check(inbox: multiprocessing.Queue) -> None:
+        while (batch := inbox.get()) is not None:
+            for data in batch:
+                update = Update.de_json(data, None)
+                is_spam_message(update.effective_message.text) or is_suspect_user(update.effective_user)
+
+    ctx = multiprocessing.get_context('fork')
+    counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    base = None
+    for processes in counts:
+        inboxes = [ctx.Queue() for _ in range(processes)]
+        workers = [ctx.Process(target=check, args=(q,)) for q in inboxes]
+        for p in workers:
+            p.start()
+        start = perf_counter()
+        for n in range(0, len(updates), 100):
+            batches = [list() for _ in inboxes]
+            for update in updates[n:n + 100]:
+                batches[raw_chat_id(update) % processes].append(update)
+            for (inbox, batch) in zip(inboxes, batches):
+                if batch:
+                    inbox.put(batch)
+        for q in inboxes:
+            q.put(None)
+        for p in workers:
+            p.join()
+        rate = len(updates) / (perf_counter() - start)
+        base = base or rate
+        print(f"{processes:>3} processes: {rate:10,.0f} updates/s, x{rate / base:.2f}")
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Hashed timing wheel for challenge timeouts, unbans and delayed deletions
+import logging
+logger = logging.getLogger('antispambot.deadlines')
+
+from math import ceil
+from threading import Lock
+from typing import Dict, List, Tuple, Optional
+
+class Deadline:
+    '''
+        A compact record, kind is one of the handlers registered in the scheduler
+    '''
+    __slots__ = ('kind', 'chat_id', 'user_id', 'join_msgid', 'deadline', 'tick')
+
+    def __init__(self, kind: str, chat_id: int, user_id: int, join_msgid: int, deadline: float) -> None:
+        self.kind = kind
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.join_msgid = join_msgid
+        self.deadline = deadline
+        self.tick = 0
+    @property
+    def key(self) -> Tuple[str, int, int, int]:
+        return (self.kind, self.chat_id, self.user_id, self.join_msgid)
+    def __repr__(self) -> str:
+        return f'Deadline{self.key + (self.deadline,)}'
+
+class DeadlineScheduler:
+    '''
+        Deadlines are put into slot (deadline // resolution) % slots and kept in
+        an index by key, so schedule and cancel are O(1). Every tick only visits
+        the slots which became due and returns the expired records grouped by
+        (kind, chat_id), to be processed as one batch per chat. The first tick
+        sweeps all slots, records restored before it may be overdue.
+    '''
+    def __init__(self, resolution: float = 1.0, slots: int = 4096) -> None:
+        self.resolution = resolution
+        self._slots: List[Dict[tuple, Deadline]] = [dict() for _ in range(slots)]
+        self._index: Dict[tuple, Deadline] = dict()
+        self._current: Optional[int] = None  # last processed tick
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def schedule(self, kind: str, chat_id: int, user_id: int, join_msgid: int, deadline: float) -> Deadline:
+        rec = Deadline(kind, chat_id, user_id, join_msgid, deadline)
+        rec.tick = ceil(deadline / self.resolution)
+        with self._lock:
+            if self._current is not None and rec.tick <= self._current:
+                rec.tick = self._current + 1
+            old = self._index.pop(rec.key, None)
+            if old is not None:
+                self._slots[old.tick % len(self._slots)].pop(old.key, None)
+            self._index[rec.key] = rec
+            self._slots[rec.tick % len(self._slots)][rec.key] = rec
+        return rec
+
+    def cancel(self, kind: str, chat_id: int, user_id: int, join_msgid: int) -> Optional[Deadline]:
+        key = (kind, chat_id, user_id, join_msgid)
+        with self._lock:
+            rec = self._index.pop(key, None)
+            if rec is not None:
+                self._slots[rec.tick % len(self._slots)].pop(key, None)
+        return rec
+
+    def get(self, kind: str, chat_id: int, user_id: int, join_msgid: int) -> Optional[Deadline]:
+        return self._index.get((kind, chat_id, user_id, join_msgid), None)
+
+    def advance(self, now: float) -> Dict[Tuple[str, int], List[Deadline]]:
+        '''
+            remove and return everything due at `now`
+        '''
+        target = int(now // self.resolution)
+        due = dict()
+        with self._lock:
+            if self._current is None:
+                # records scheduled before the first tick may be overdue in any slot
+                first = target - len(self._slots) + 1
+                self._current = target
+            else:
+                first = max(self._current + 1, target - len(self._slots) + 1)
+            for tick in range(first, target + 1):
+                slot = self._slots[tick % len(self._slots)]
+                if not slot:
+                    continue
+                for key in [k for (k, r) in slot.items() if r.tick <= target]:
+                    rec = slot.pop(key)
+                    del self._index[key]
+                    due.setdefault((rec.kind, rec.chat_id), list()).append(rec)
+            self._current = max(self._current, target)
+        return due
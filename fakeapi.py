@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# A local fake Bot API server for testing the bot (and cluster mode) on one box.
+# python3 fakeapi.py [port] [updates per second] [chats] [raid size] [requests]
+# then set BOT_API_URL = 'http://127.0.0.1:8081/bot' in config.py and start bot.py
+import json
+import logging
+from base64 import urlsafe_b64decode
+from collections import Counter
+from random import randrange, random
+from threading import Lock, Thread
+from time import time, sleep
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tokens import ChallengeTokens
+logger = logging.getLogger('antispambot.fakeapi')
+
+TEXTS = ('hello everyone', 'what time is the meeting tomorrow?', 'thanks!',
+         'earn 500$ a day, write me in private', 'join our crypto channel t.me/cryptopump',
+         'привет всем, как дела?', 'заработок от 1000 рублей в день, пиши в лс')
+
+class FakeBotAPI:
+    '''
+        Generates text messages from random users in `chats` groups at `rate`
+        updates per second and answers every other method with a plausible result.
+        With answer_captchas a random button of every sent keyboard is clicked.
+    '''
+    MAX_PENDING = 100000
+
+    def __init__(self, rate: float = 1000, chats: int = 1000, users: int = 100000) -> None:
+        self.rate = rate
+        self.chats = chats
+        self.users = users
+        self.calls = Counter()
+        self._lock = Lock()
+        self._next_update = 1
+        self._next_message = 1
+        self._generated_until = time()
+        self._pending = list()
+        self.fetched = 0  # confirmed by the offset of the next getUpdates
+        self.joins = 0
+        self.answer_captchas = False
+        self.permissions = dict()  # set by setChatPermissions
+
+    def _message(self, chat_id: int, user_id: int, text: str = None) -> dict:
+        '''
+            called with _lock held
+        '''
+        message_id = self._next_message
+        self._next_message += 1
+        msg = {'message_id': message_id, 'date': int(time()),
+               'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'group {chat_id}'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}}
+        if text is not None:
+            msg['text'] = text
+        return msg
+
+    def _generate(self) -> None:
+        now = time()
+        count = int((now - self._generated_until) * self.rate)
+        if count <= 0:
+            return
+        self._generated_until += count / self.rate
+        # nobody is polling, do not grow without bounds
+        count = min(count, self.MAX_PENDING - len(self._pending))
+        for _ in range(count):
+            chat_id = -1000000000000 - randrange(self.chats)
+            text = TEXTS[randrange(len(TEXTS))] + (' ' * randrange(40)) + 'x' * int(random() * 200)
+            self._pending.append({'update_id': self._next_update,
+                                  'message': self._message(chat_id, 1000 + randrange(self.users), text)})
+            self._next_update += 1
+
+    def raid(self, chat_id: int, joins: int, requests: bool = False) -> None:
+        '''
+            a burst of `joins` new members in one chat, each join is its own update,
+            with `requests` they ask to join instead
+        '''
+        with self._lock:
+            for n in range(joins):
+                msg = self._message(chat_id, 900000000 + self._next_update)
+                if requests:
+                    update = {'chat_join_request': {'chat': msg['chat'], 'from': msg['from'], 'date': msg['date']}}
+                else:
+                    msg['new_chat_members'] = [msg['from']]
+                    update = {'message': msg}
+                update['update_id'] = self._next_update
+                self._pending.append(update)
+                self._next_update += 1
+                self.joins += 1
+
+    def _answer(self, msg: dict, markup) -> None:
+        '''
+            called with _lock held, clicks a button of a sent captcha
+        '''
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        buttons = [b['callback_data'] for row in (markup or dict()).get('inline_keyboard', ()) for b in row
+                   if 'callback_data' in b]
+        if not buttons:
+            return
+        data = buttons[randrange(len(buttons))]
+        args = data.split()
+        # a join request is answered in private, the token of a group captcha names its user
+        user_id = msg['chat']['id'] if args[0] == 'jrq' else \
+                  ChallengeTokens.LAYOUT.unpack_from(urlsafe_b64decode(args[1]))[0]
+        self._pending.append({'update_id': self._next_update, 'callback_query': {
+            'id': str(self._next_update), 'chat_instance': str(msg['chat']['id']), 'data': data, 'message': msg,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}}})
+        self._next_update += 1
+
+    def get_updates(self, offset: int = None, limit: int = 100, timeout: float = 0) -> list:
+        deadline = time() + min(timeout, 1)
+        while True:
+            with self._lock:
+                if offset is not None:
+                    self.fetched = max(self.fetched, offset - 1)
+                    self._pending = [u for u in self._pending if u['update_id'] >= offset]
+                self._generate()
+                if self._pending or time() >= deadline:
+                    return self._pending[:limit]
+            sleep(0.01)
+
+    def call(self, method: str, data: dict):
+        with self._lock:
+            self.calls[method] += 1
+        if method == 'getUpdates':
+            # python-telegram-bot sends every parameter as a string
+            offset = data.get('offset', None)
+            return self.get_updates(None if offset is None else int(offset), int(data.get('limit', 100)),
+                                    float(data.get('timeout', 0)))
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fakebot'}
+        if method == 'getChatAdministrators':
+            return [{'status': 'creator', 'is_anonymous': False,
+                     'user': {'id': 1, 'is_bot': False, 'first_name': 'admin', 'username': 'admin'}}]
+        if method == 'getChat':
+            chat_id = int(data.get('chat_id', 0))
+            with self._lock:
+                permissions = self.permissions.get(chat_id, None)
+            return {'id': chat_id, 'type': 'supergroup', 'title': f'group {chat_id}',
+                    'permissions': permissions or {'can_send_messages': True, 'can_send_media_messages': True,
+                                                   'can_send_other_messages': True, 'can_invite_users': True}}
+        if method == 'setChatPermissions':
+            permissions = data.get('permissions', dict())
+            with self._lock:
+                self.permissions[int(data.get('chat_id', 0))] = \
+                    json.loads(permissions) if isinstance(permissions, str) else permissions
+            return True
+        if method in ('sendMessage', 'editMessageText'):
+            with self._lock:
+                msg = self._message(int(data.get('chat_id', 0)), 1, data.get('text', ''))
+                if self.answer_captchas and method == 'sendMessage':
+                    self._answer(msg, data.get('reply_markup', None))
+                return msg
+        return True
+
+    def handler(self) -> type:
+        api = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)) or 0)
+                try:
+                    data = json.loads(body) if body else dict()
+                except ValueError:
+                    data = dict()
+                method = self.path.rsplit('/', 1)[-1]
+                reply = json.dumps({'ok': True, 'result': api.call(method, data)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+            do_GET = do_POST
+            def log_message(self, *args) -> None:
+                pass
+        return Handler
+
+    def serve(self, port: int = 8081) -> ThreadingHTTPServer:
+        server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    chats = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    # every 10s a raid in the first chat, compare sendMessage + deleteMessage with editMessageText
+    raid = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    # the raid sends join requests, every captcha is answered and API calls per join are logged
+    requests = len(sys.argv) > 5 and sys.argv[5] == 'requests'
+    api = FakeBotAPI(rate, chats)
+    api.answer_captchas = bool(raid)
+    api.serve(port)
+    logger.info(f'Fake Bot API on http://127.0.0.1:{port}/bot, {rate:.0f} updates/s in {chats} chats')
+    (last, fetched) = (Counter(), 0)
+    while True:
+        if raid:
+            api.raid(-1000000000000, raid, requests)
+        sleep(10)
+        calls = api.calls.copy()
+        logger.info(f'{(api.fetched - fetched) / 10:.0f} updates/s fetched, calls in the last 10s: '
+                    f'{dict(calls - last)}, not fetched yet {len(api._pending)}')
+        if api.joins:
+            per_join = {m: round(n / api.joins, 2) for (m, n) in calls.items() if m not in ('getUpdates', 'getMe')}
+            logger.info(f'{api.joins} joins so far, calls per join {per_join}')
+        (last, fetched) = (calls, api.fetched)
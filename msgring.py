@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Fixed-capacity ring buffer of recent chat messages with a per-user index
+from array import array
+from threading import Lock
+from time import time
+from typing import Dict, Iterator, List, Tuple
+
+class MessageRing:
+    '''
+        The last `capacity` messages of a chat as (user_id, message_id, timestamp),
+        stored in typed arrays. Every slot also holds the sequence number of the
+        previous message of the same user and `_last` maps a user to its newest one,
+        so looking up a user walks back only through that user's recent messages.
+        Entries older than `max_age` are never returned and just get overwritten,
+        there is nothing to garbage collect.
+    '''
+    def __init__(self, capacity: int, max_age: int = 7200) -> None:
+        self.capacity = max(int(capacity), 1)
+        self.max_age = max_age
+        self._uids = array('q', bytes(8 * self.capacity))
+        self._mids = array('q', bytes(8 * self.capacity))
+        self._ts = array('q', bytes(8 * self.capacity))
+        self._prev = array('q', bytes(8 * self.capacity))  # -1: first message of the user
+        self._seq = 0  # sequence number of the next message
+        self._last: Dict[int, int] = dict()
+        self._lock = Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return min(self._seq, self.capacity)
+
+    def append(self, user_id: int, message_id: int, ts: int = None) -> None:
+        ts = int(time()) if ts is None else int(ts)
+        with self._lock:
+            seq = self._seq
+            slot = seq % self.capacity
+            if seq >= self.capacity:
+                # forget users whose newest message is overwritten
+                old = self._uids[slot]
+                if self._last.get(old, None) == seq - self.capacity:
+                    del self._last[old]
+            self._uids[slot] = user_id
+            self._mids[slot] = message_id
+            self._ts[slot] = ts
+            self._prev[slot] = self._last.get(user_id, -1)
+            self._last[user_id] = seq
+            self._seq = seq + 1
+
+    def of_user(self, user_id: int, window: int = None, after_msgid: int = 0, now: int = None) -> List[int]:
+        '''
+            message ids of `user_id` sent within the last `window` seconds
+            (at most max_age) with an id greater than `after_msgid`, newest first
+        '''
+        now = int(time()) if now is None else now
+        window = self.max_age if window is None else min(window, self.max_age)
+        since = now - window
+        ret = list()
+        with self._lock:
+            oldest = self._seq - self.capacity
+            seq = self._last.get(user_id, -1)
+            while seq >= 0 and seq >= oldest:
+                slot = seq % self.capacity
+                if self._ts[slot] < since:
+                    break
+                if self._mids[slot] > after_msgid:
+                    ret.append(self._mids[slot])
+                seq = self._prev[slot]
+        return ret
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int]]:
+        with self._lock:
+            first = max(self._seq - self.capacity, 0)
+            items = [(self._uids[s % self.capacity], self._mids[s % self.capacity], self._ts[s % self.capacity])
+                     for s in range(first, self._seq)]
+        return iter(items)
+
+if __name__ == "__main__":
+    # benchmark against the plain list: python3 msgring.py [capacity] [messages] [users]
+    import sys
+    import tracemalloc
+    from random import randrange
+    from time import perf_counter
+    capacity = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    users = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    now = int(time())
+    stream = [(randrange(users), n, now - messages + n) for n in range(messages)]
+    lookups = [randrange(users) for _ in range(messages // 10)]
+
+    def bench_list() -> tuple:
+        sto_msgs = list()
+        t = perf_counter()
+        for (u, m, ts) in stream:
+            sto_msgs.append((u, m, ts))
+            while len(sto_msgs) > capacity:
+                sto_msgs.pop(0)
+        t_append = perf_counter() - t
+        t = perf_counter()
+        for uid in lookups:
+            [m for (u, m, ts) in sto_msgs if u == uid and now - ts < 7200]
+        return (sto_msgs, t_append, perf_counter() - t)
+
+    def bench_ring() -> tuple:
+        ring = MessageRing(capacity)
+        t = perf_counter()
+        for (u, m, ts) in stream:
+            ring.append(u, m, ts)
+        t_append = perf_counter() - t
+        t = perf_counter()
+        for uid in lookups:
+            ring.of_user(uid, now=now)
+        return (ring, t_append, perf_counter() - t)
+
+    for (name, bench) in (('list', bench_list), ('ring', bench_ring)):
+        (_, t_append, t_lookup) = bench()
+        tracemalloc.start()
+        (obj, _, _) = bench()
+        (size, _) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del obj
+        print(f"{name}: {messages / t_append:,.0f} appends/s, "
+              f"{t_lookup / len(lookups) * 1e6:.2f}us per user lookup, {size / 1024:.1f} KiB retained")
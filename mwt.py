@@ -1,41 +1,149 @@
 #!/usr/bin/env python3
-# Source: http://code.activestate.com/recipes/325905-memoize-decorator-with-timeout/#c1
+# Memoize With Timeout
+# Originally based on: http://code.activestate.com/recipes/325905-memoize-decorator-with-timeout/#c1
+# now bounded (LRU), thread-safe and single-flight
 
 import time
+from threading import Lock, Event, Thread
+from collections import OrderedDict
+
+class _Flight:
+    '''
+        An upstream call in progress, concurrent misses on the same key wait for it
+    '''
+    def __init__(self) -> None:
+        self.done = Event()
+        self.value = None
+        self.error = None
 
 class MWT(object):
     """Memoize With Timeout"""
-    _caches = {}
-    _timeouts = {}
 
-    def __init__(self,timeout=2):
+    def __init__(self, timeout=2, maxsize=1024, stale=0):
+        '''
+            timeout: seconds before an entry expires
+            maxsize: maximum number of entries, least recently used ones are evicted
+            stale:   seconds after expiry during which the old value is still returned
+                     while it is refreshed in the background (stale-while-revalidate)
+        '''
         self.timeout = timeout
+        self.maxsize = maxsize
+        self.stale = stale
+        self.cache = OrderedDict()  # key: (value, timestamp)
+        self._flights = dict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.upstream_calls = 0
+        self.upstream_time = 0.0
 
     def collect(self):
         """Clear cache of results which have timed out"""
-        for func in self._caches:
-            cache = {}
-            for key in self._caches[func]:
-                if (time.time() - self._caches[func][key][1]) < self._timeouts[func]:
-                    cache[key] = self._caches[func][key]
-            self._caches[func] = cache
+        now = time.time()
+        with self._lock:
+            for key in [k for k, v in self.cache.items() if now - v[1] >= self.timeout + self.stale]:
+                del self.cache[key]
 
-    def __call__(self, f):
-        self.cache = self._caches[f] = {}
-        self._timeouts[f] = self.timeout
+    def peek(self, *args, **kwargs):
+        '''
+            Return the cached value (even if stale) or None, without any upstream call
+        '''
+        with self._lock:
+            v = self.cache.get(self._key(args, kwargs), None)
+        return None if v is None else v[0]
+
+    def put(self, value, *args, **kwargs):
+        '''
+            Replace the cached value, e.g. when it is known to have changed
+        '''
+        key = self._key(args, kwargs)
+        with self._lock:
+            self.cache[key] = (value, time.time())
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *args, **kwargs):
+        with self._lock:
+            self.cache.pop(self._key(args, kwargs), None)
+
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
 
+    def stats(self) -> dict:
+        return {'size': len(self.cache), 'hits': self.hits, 'misses': self.misses,
+                'stale_hits': self.stale_hits, 'evictions': self.evictions,
+                'upstream_calls': self.upstream_calls,
+                'upstream_avg_ms': (self.upstream_time / self.upstream_calls * 1000) if self.upstream_calls else 0.0}
+
+    @staticmethod
+    def _key(args, kwargs):
+        return (args, tuple(sorted(kwargs.items())))
+
+    def _fetch(self, f, key, flight, args, kwargs):
+        '''
+            Run the upstream call for the flight leader and wake up the followers
+        '''
+        start = time.time()
+        try:
+            value = f(*args, **kwargs)
+        except Exception as err:
+            flight.error = err
+        else:
+            flight.value = value
+        end = time.time()
+        with self._lock:
+            self.upstream_calls += 1
+            self.upstream_time += end - start
+            if flight.error is None:
+                self.cache[key] = (flight.value, end)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+                    self.evictions += 1
+            self._flights.pop(key, None)
+        flight.done.set()
+
+    def __call__(self, f):
         def func(*args, **kwargs):
-            kw = sorted(kwargs.items())
-            key = (args, tuple(kw))
-            try:
-                v = self.cache[key]
-                #print("cache")
-                if (time.time() - v[1]) > self.timeout:
-                    raise KeyError
-            except KeyError:
-                #print("new")
-                v = self.cache[key] = f(*args,**kwargs),time.time()
-            return v[0]
+            key = self._key(args, kwargs)
+            refresh = False
+            with self._lock:
+                v = self.cache.get(key, None)
+                if v is not None:
+                    age = time.time() - v[1]
+                    if age <= self.timeout:
+                        self.cache.move_to_end(key)
+                        self.hits += 1
+                        return v[0]
+                    elif age <= self.timeout + self.stale:
+                        self.stale_hits += 1
+                        refresh = True
+                    else:
+                        del self.cache[key]
+                        v = None
+                if v is None:
+                    self.misses += 1
+                flight = self._flights.get(key, None)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+            if refresh:
+                if leader:
+                    Thread(target=self._fetch, args=(f, key, flight, args, kwargs), daemon=True).start()
+                return v[0]
+            if leader:
+                self._fetch(f, key, flight, args, kwargs)
+            else:
+                flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
         func.func_name = f.__name__
+        func.cache = self
 
-        return func
\ No newline at end of file
+        return func
@@ -2,13 +2,77 @@
 
 from telegram import Bot
 from telegram.utils.request import Request
-from time import time, sleep
-from threading import Lock
+from telegram.error import TelegramError, NetworkError, BadRequest, RetryAfter
+from time import monotonic, sleep
+from random import uniform
+import logging
+from threading import Lock, Condition, Thread
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 
 from config import TOKEN, WORKERS
+import config
+BOT_API_URL: str = getattr(config, 'BOT_API_URL', 'https://api.telegram.org/bot')
+logger = logging.getLogger('antispambot.ratelimited')
 
 
 
+class TokenBucket:
+    '''
+        O(1) token bucket, kept as a theoretical arrival time (GCRA).
+        Callers reserve a slot and are told how long to wait for it.
+    '''
+    __slots__ = ('interval', 'tolerance', 'tat')
+
+    def __init__(self, burst_limit: int, time_limit: float) -> None:
+        self.interval = time_limit / burst_limit      # one token every interval seconds
+        self.tolerance = time_limit - self.interval   # burst_limit tokens may be taken at once
+        self.tat = 0.0
+    def reserve(self, at: float) -> float:
+        '''
+            take one token at or after `at`, returns the time the token is available
+        '''
+        start = max(at, self.tat - self.tolerance)
+        self.tat = max(self.tat, start) + self.interval
+        return start
+    def available(self, at: float) -> float:
+        return max(at, self.tat - self.tolerance)
+    def penalize(self, until: float) -> None:
+        '''
+            no tokens before `until`
+        '''
+        self.tat = max(self.tat, until + self.tolerance)
+    def idle(self, at: float) -> bool:
+        '''
+            a full bucket, forgetting it loses nothing
+        '''
+        return self.tat <= at
+
+class SharedTokenBucket(TokenBucket):
+    '''
+        TokenBucket whose state lives in shared memory, for a rate budget
+        used by several forked processes. monotonic() is system-wide on Linux.
+    '''
+    __slots__ = ('_shared',)
+
+    def __init__(self, bucket: TokenBucket) -> None:
+        import multiprocessing
+        self.interval = bucket.interval
+        self.tolerance = bucket.tolerance
+        self._shared = multiprocessing.Value('d', bucket.tat)
+    @property
+    def tat(self) -> float:
+        return self._shared.value
+    @tat.setter
+    def tat(self, value: float) -> None:
+        self._shared.value = value
+    def reserve(self, at: float) -> float:
+        with self._shared.get_lock():
+            return super().reserve(at)
+    def penalize(self, until: float) -> None:
+        with self._shared.get_lock():
+            super().penalize(until)
+
 class Delayed:
     '''
         I want my return code back
@@ -18,27 +82,18 @@ class Delayed:
     def __init__(self, burst_limit=30, time_limit_ms=1000):
         self.burst_limit = burst_limit
         self.time_limit = time_limit_ms / 1000
-        self._times = []
+        self._bucket = TokenBucket(burst_limit, self.time_limit)
         self._lock = Lock()
     def __call__(self, func, *args, **kwargs):
-        try:
-            self._lock.acquire()
-            # delay routine
-            now = time()
-            t_delta = now - self.time_limit  # calculate early to improve perf.
-            if self._times and t_delta > self._times[-1]:
-                # if last call was before the limit time-window
-                # used to impr. perf. in long-interval calls case
-                self._times = [now]
-            else:
-                # collect last in current limit time-window
-                self._times = [t for t in self._times if t >= t_delta]
-                self._times.append(now)
-        finally:
-            self._lock.release()  # to prevent dead lock
-        if len(self._times) >= self.burst_limit:  # if throughput limit was hit
-            sleep(self._times[1] - t_delta)
+        with self._lock:
+            now = monotonic()
+            delay = self._bucket.reserve(now) - now
+        if delay > 0:  # if throughput limit was hit
+            sleep(delay)
         return func(*args, **kwargs)
+    def wait_time(self) -> float:
+        now = monotonic()
+        return self._bucket.available(now) - now
     def delayed(self, func):
         '''
             @Delayed().delayed
@@ -48,46 +103,366 @@ class Delayed:
         return wrapped
 
 class DelayedMessage:
+    '''
+        A global budget for all chats plus an independent budget per chat_id,
+        groups (negative chat_id) and private chats have different limits.
+    '''
+    PRUNE_EVERY = 1024
+
     def __init__(self,
                  all_burst_limit=30,
                  all_time_limit_ms=1000,
                  group_burst_limit=20,
-                 group_time_limit_ms=60000):
-        self._all_delay = Delayed(all_burst_limit, all_time_limit_ms)
-        self._group_delay = Delayed(group_burst_limit, group_time_limit_ms)
+                 group_time_limit_ms=60000,
+                 private_burst_limit=1,
+                 private_time_limit_ms=1000):
+        self._all_bucket = TokenBucket(all_burst_limit, all_time_limit_ms / 1000)
+        self._group_limit = (group_burst_limit, group_time_limit_ms / 1000)
+        self._private_limit = (private_burst_limit, private_time_limit_ms / 1000)
+        self._chat_buckets = dict()
+        self._new_buckets = 0
+        self._lock = Lock()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id, None)
+        if bucket is None:
+            self._new_buckets += 1
+            if self._new_buckets >= self.PRUNE_EVERY:
+                self._new_buckets = 0
+                now = monotonic()
+                for cid in [cid for cid, b in self._chat_buckets.items() if b.idle(now)]:
+                    del self._chat_buckets[cid]
+            limit = self._group_limit if chat_id < 0 else self._private_limit
+            bucket = self._chat_buckets[chat_id] = TokenBucket(*limit)
+        return bucket
+
+    def wait(self, chat_id: int = None) -> float:
+        '''
+            sleeps until a message may be sent to chat_id, returns the seconds waited.
+            The global token is only taken once the slot of the chat is due,
+            so the backlog of a busy chat does not hold back the other chats.
+        '''
+        waited = 0.0
+        if chat_id is not None:
+            with self._lock:
+                now = monotonic()
+                waited = self._chat_bucket(chat_id).reserve(now) - now
+            if waited > 0:
+                sleep(waited)
+        with self._lock:
+            now = monotonic()
+            delay = self._all_bucket.reserve(now) - now
+        if delay > 0:
+            sleep(delay)
+            waited += delay
+        return waited
+
+    def reserve_now(self, chat_id: int = None) -> float:
+        '''
+            for callers which must not sleep: takes the slot of chat_id and the
+            global token only if both are due now and returns 0, otherwise takes
+            nothing and returns the seconds until they are. The message is then
+            sent with reserved=True.
+        '''
+        with self._lock:
+            now = monotonic()
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            at = self._all_bucket.available(bucket.available(now) if bucket else now)
+            if at > now:
+                return at - now
+            if bucket:
+                bucket.reserve(now)
+            # with a SharedTokenBucket another process may have taken the token meanwhile
+            return max(self._all_bucket.reserve(now) - now, 0.0)
+
+    def penalize(self, seconds: float, chat_id: int = None) -> None:
+        '''
+            flood control: nothing is sent to chat_id (or to anyone) for `seconds`
+        '''
+        with self._lock:
+            until = monotonic() + seconds
+            if chat_id is None:
+                self._all_bucket.penalize(until)
+            else:
+                self._chat_bucket(chat_id).penalize(until)
+
+    def wait_time(self, chat_id: int = None) -> float:
+        with self._lock:
+            now = monotonic()
+            at = now
+            if chat_id is not None and (bucket := self._chat_buckets.get(chat_id, None)):
+                at = bucket.available(now)
+            return self._all_bucket.available(at) - now
 
     def delayed(self, func):
         '''
             @DelayedMessage().delayed
+            reserved=True skips the wait, the slot was taken by reserve_now
         '''
         def wrapped(*args, **kwargs):
-            dl = self._group_delay if kwargs.pop('isgroup', True) else self._all_delay
-            return dl(func, *args, **kwargs)
+            kwargs.pop('isgroup', None)  # decided by chat_id now
+            if not kwargs.pop('reserved', False):
+                chat_id = kwargs.get('chat_id', args[1] if len(args) > 1 else None)
+                try:
+                    chat_id = int(chat_id)
+                except (TypeError, ValueError):
+                    chat_id = None  # @channelusername
+                self.wait(chat_id)
+            return func(*args, **kwargs)
         return wrapped
 
+
+# priority classes of ActionQueue, lower goes first
+PRIO_CHAT = 0      # chat-wide permissions, one call protects the whole chat
+PRIO_RESTRICT = 1  # restrict/unban, these stop spam
+PRIO_KICK = 2
+PRIO_DELETE = 3    # cosmetic
+
+class ActionQueue:
+    '''
+        Outbound Bot API actions share one rate budget and are dispatched by
+        priority class, round-robin across chats inside a class, so a raided
+        chat cannot starve the others. Callers get a Future instead of sleeping.
+        An action hit by flood control (RetryAfter) is put back in front of its
+        chat and the whole budget waits, no thread sleeps for it.
+    '''
+    CLASSES = ('chat', 'restrict', 'kick', 'delete')
+    MAX_RETRY_AFTER = 3
+
+    def __init__(self, burst_limit=10, time_limit_ms=10000, threads=4):
+        self._bucket = TokenBucket(burst_limit, time_limit_ms / 1000)
+        self._queues = [OrderedDict() for _ in self.CLASSES]  # chat_id: deque of pending actions
+        self._depth = [0 for _ in self.CLASSES]
+        self._waited = [0.0 for _ in self.CLASSES]
+        self._dispatched = [0 for _ in self.CLASSES]
+        self._cond = Condition()
+        self._nthreads = threads
+        self._threads = list()
+
+    def submit(self, priority: int, chat_id: int, func, *args, **kwargs) -> Future:
+        future = Future()
+        with self._cond:
+            if not self._threads:
+                for n in range(self._nthreads):
+                    tr = Thread(target=self._run, name=f'ActionQueue-{n}', daemon=True)
+                    tr.start()
+                    self._threads.append(tr)
+            self._queues[priority].setdefault(chat_id, deque()).append((future, monotonic(), func, args, kwargs, 0))
+            self._depth[priority] += 1
+            self._cond.notify()
+        return future
+
+    def _requeue(self, priority: int, chat_id: int, item: tuple) -> None:
+        with self._cond:
+            self._queues[priority].setdefault(chat_id, deque()).appendleft(item)
+            self._depth[priority] += 1
+            self._cond.notify()
+
+    def _take(self) -> tuple:
+        with self._cond:
+            while True:
+                if not any(self._depth):
+                    self._cond.wait()
+                    continue
+                now = monotonic()
+                delay = self._bucket.available(now) - now
+                if delay > 0:
+                    # a more important action may arrive meanwhile
+                    self._cond.wait(delay)
+                    continue
+                # with a SharedTokenBucket another process may have taken the token meanwhile
+                start = self._bucket.reserve(now)
+                while start > now:
+                    self._cond.wait(start - now)
+                    now = monotonic()
+                if not any(self._depth):
+                    continue
+                for prio, chats in enumerate(self._queues):
+                    if chats:
+                        break
+                chat_id, pending = next(iter(chats.items()))
+                item = pending.popleft()
+                if pending:
+                    chats.move_to_end(chat_id)
+                else:
+                    del chats[chat_id]
+                self._depth[prio] -= 1
+                self._waited[prio] += now - item[1]
+                self._dispatched[prio] += 1
+                return (prio, chat_id, item)
+
+    def _run(self) -> None:
+        while True:
+            (prio, chat_id, item) = self._take()
+            (future, enqueued, func, args, kwargs, retries) = item
+            if not retries and not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except RetryAfter as err:
+                if retries >= self.MAX_RETRY_AFTER:
+                    future.set_exception(err)
+                    continue
+                self.penalize(err.retry_after)
+                self._requeue(prio, chat_id, (future, enqueued, func, args, kwargs, retries + 1))
+            except BaseException as err:
+                future.set_exception(err)
+
+    def penalize(self, seconds: float) -> None:
+        with self._cond:
+            self._bucket.penalize(monotonic() + seconds)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {name: {'depth': self._depth[i],
+                           'avg_wait': self._waited[i] / self._dispatched[i] if self._dispatched[i] else 0.0}
+                    for (i, name) in enumerate(self.CLASSES)}
+
+
+class CircuitOpenError(TelegramError):
+    '''
+        Raised instead of calling the Bot API while it is considered degraded
+    '''
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    '''
+        exponential backoff with full jitter, attempt starts from 0
+    '''
+    return uniform(0, min(cap, base * 2 ** attempt))
+
+class CircuitBreaker:
+    '''
+        Opens after `threshold` consecutive network failures and fails fast for
+        `cooldown` seconds, then lets a single probe call through (half-open).
+    '''
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.transitions = {self.CLOSED: 0, self.OPEN: 0, self.HALF_OPEN: 0}
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = Lock()
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f'Bot API circuit breaker {self.state} -> {state}')
+            self.state = state
+            self.transitions[state] += 1
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == self.OPEN:
+                if monotonic() - self._opened_at < self.cooldown:
+                    raise CircuitOpenError('Bot API circuit breaker is open')
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    raise CircuitOpenError('Bot API circuit breaker is half-open')
+                self._probing = True
+    def success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+                self._opened_at = monotonic()
+                self._set_state(self.OPEN)
+    def stats(self) -> dict:
+        return {'state': self.state, 'failures': self._failures, 'transitions': dict(self.transitions)}
+
 delayed_message = DelayedMessage()
-delayed_actions = Delayed(burst_limit=10, time_limit_ms=10000)
+circuit_breaker = CircuitBreaker()
+action_queue = ActionQueue(burst_limit=10, time_limit_ms=10000)
+
+def share_budget() -> None:
+    '''
+        Call before forking worker processes: the global message budget and the
+        action budget are then shared by all of them, per chat budgets are not
+        since every chat belongs to one process.
+    '''
+    with delayed_message._lock:
+        delayed_message._all_bucket = SharedTokenBucket(delayed_message._all_bucket)
+    with action_queue._cond:
+        action_queue._bucket = SharedTokenBucket(action_queue._bucket)
+
 class MQBot(Bot):
-    '''A subclass of Bot which delegates send method handling to MQ'''
+    '''A subclass of Bot which delegates send method handling to MQ
+    kick/restrict/delete are queued by the backend through action_queue'''
+    # endpoints queued by the backend through action_queue
+    ACTION_ENDPOINTS = ('kickChatMember', 'banChatMember', 'restrictChatMember', 'deleteMessage', 'deleteMessages')
+
     def __init__(self, *args, **kwargs):
         super(MQBot, self).__init__(*args, **kwargs)
 
+    def _post(self, endpoint, data=None, *args, **kwargs):
+        '''Every API call passes here: circuit breaker and flood control'''
+        if endpoint == 'getUpdates':
+            # long polling has its own retry loop in the updater
+            return super(MQBot, self)._post(endpoint, data, *args, **kwargs)
+        circuit_breaker.before_call()
+        try:
+            result = super(MQBot, self)._post(endpoint, data, *args, **kwargs)
+        except RetryAfter as err:
+            circuit_breaker.success()
+            if endpoint in self.ACTION_ENDPOINTS:
+                action_queue.penalize(err.retry_after)
+            else:
+                try:
+                    chat_id = int(data.get('chat_id')) if data else None
+                except (TypeError, ValueError):
+                    chat_id = None
+                delayed_message.penalize(err.retry_after, chat_id)
+            logger.warning(f'Flood control on {endpoint}, retry after {err.retry_after}s')
+            raise
+        except BadRequest:
+            # the request reached telegram
+            circuit_breaker.success()
+            raise
+        except NetworkError:
+            circuit_breaker.failure()
+            raise
+        except TelegramError:
+            circuit_breaker.success()
+            raise
+        circuit_breaker.success()
+        return result
+
     @delayed_message.delayed
     def send_message(self, *args, **kwargs):
-        '''Wrapped method would accept new `queued` and `isgroup`
+        '''Wrapped method would accept new `reserved` and `isgroup`
         OPTIONAL arguments'''
         return super(MQBot, self).send_message(*args, **kwargs)
 
-    @delayed_actions.delayed
-    def kick_chat_member(self, *args, **kwargs):
-        return super(MQBot, self).kick_chat_member(*args, **kwargs)
-
-    @delayed_actions.delayed
-    def restrict_chat_member(self, *args, **kwargs):
-        return super(MQBot, self).restrict_chat_member(*args, **kwargs)
+    def delete_messages(self, chat_id, message_ids, timeout=None, api_kwargs=None):
+        '''deleteMessages, up to 100 message_ids in one request'''
+        data = {'chat_id': chat_id, 'message_ids': list(message_ids)}
+        return self._post('deleteMessages', data, timeout=timeout, api_kwargs=api_kwargs)
 
-    @delayed_actions.delayed
-    def delete_message(self, *args, **kwargs):
-        return super(MQBot, self).delete_message(*args, **kwargs)
+mqbot = MQBot(TOKEN, base_url=BOT_API_URL, request=Request(con_pool_size=WORKERS+4))
 
-mqbot = MQBot(TOKEN, request=Request(con_pool_size=WORKERS+4))
+if __name__ == "__main__":
+    # contention benchmark: python3 ratelimited.py [workers] [chats] [seconds]
+    import sys
+    from random import randrange
+    workers, chats, seconds = (int(a) for a in (sys.argv[1:4] + ['32', '1000', '5'][len(sys.argv[1:4]):]))
+    limiter = DelayedMessage()
+    sent = [0] * workers
+    start = monotonic()
+    stop_at = start + seconds
+    def worker(n: int) -> None:
+        while monotonic() < stop_at:
+            limiter.wait(-randrange(1, chats + 1))
+            sent[n] += 1
+    threads = [Thread(target=worker, args=(n,)) for n in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(f"{workers} workers, {chats} chats: {sum(sent) / (monotonic() - start):.1f} messages/sec "
+          f"(global budget {1 / limiter._all_bucket.interval:.0f}/sec)")
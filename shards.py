@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Per-chat serial execution: every chat is handled by exactly one worker thread
+import logging
+logger = logging.getLogger('antispambot.shards')
+
+from collections import Counter
+from concurrent.futures import Future
+from itertools import count
+from queue import PriorityQueue
+from threading import Thread, Lock
+from typing import Callable, List, Optional
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+class ChatShards:
+    '''
+        N worker threads with one queue each, a chat always goes to shard chat_id % N.
+        Work for the same chat runs in order and never concurrently, so per-chat
+        state needs no lock. Unrelated chats on different shards run in parallel.
+        Urgent work, such as answering a button, overtakes the rest of its shard.
+    '''
+    (URGENT, NORMAL) = (0, 1)
+
+    def __init__(self, shards: int = 32) -> None:
+        self._queues: List[PriorityQueue] = [PriorityQueue() for _ in range(max(shards, 1))]
+        self._seq = count()  # keeps the order within a priority
+        self._pending: List[Counter] = [Counter() for _ in self._queues]  # chat_id: queued or running
+        self._processed = [0] * len(self._queues)
+        self._lock = Lock()
+        self._started = False  # threads are started on first use, so the process can still fork
+
+    def __len__(self) -> int:
+        return len(self._queues)
+
+    def shard_of(self, chat_id: int) -> int:
+        return chat_id % len(self._queues)
+
+    def submit(self, chat_id: int, func: Callable, *args, **kwargs) -> Future:
+        return self._submit(self.NORMAL, chat_id, func, args, kwargs)
+
+    def submit_urgent(self, chat_id: int, func: Callable, *args, **kwargs) -> Future:
+        return self._submit(self.URGENT, chat_id, func, args, kwargs)
+
+    def _submit(self, priority: int, chat_id: int, func: Callable, args: tuple, kwargs: dict) -> Future:
+        future = Future()
+        n = self.shard_of(chat_id)
+        with self._lock:
+            if not self._started:
+                self._started = True
+                for (i, q) in enumerate(self._queues):
+                    Thread(target=self._worker, args=(i, q), name=f'shard-{i}', daemon=True).start()
+            self._pending[n][chat_id] += 1
+            seq = next(self._seq)
+        self._queues[n].put((priority, seq, future, chat_id, func, args, kwargs))
+        return future
+
+    def _worker(self, n: int, q: PriorityQueue) -> None:
+        while True:
+            (_, _, future, chat_id, func, args, kwargs) = q.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except Exception as err:
+                    logger.exception(f'Error in shard {n} for chat {chat_id}')
+                    future.set_exception(err)
+            with self._lock:
+                pending = self._pending[n]
+                pending[chat_id] -= 1
+                if pending[chat_id] <= 0:
+                    del pending[chat_id]
+                self._processed[n] += 1
+
+    def stats(self) -> dict:
+        '''
+            queue depth of every shard and the chats with most pending work
+        '''
+        with self._lock:
+            depth = [sum(p.values()) for p in self._pending]
+            hot = Counter()
+            for p in self._pending:
+                hot.update(p)
+            return {'depth': depth, 'max_depth': max(depth), 'processed': sum(self._processed),
+                    'hot_chats': hot.most_common(5)}
+
+def update_chat_id(update: object) -> Optional[int]:
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
+
+class ShardedDispatcher(Dispatcher):
+    '''
+        Dispatcher which hands every update over to the shard of its chat,
+        handlers should be added without run_async.
+        Button clicks are urgent, somebody waits for the answer.
+        Updates without a chat are processed in the dispatcher thread.
+    '''
+    def __init__(self, *args, shards: int = 32, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.shards = ChatShards(shards)
+
+    def process_update(self, update: object) -> None:
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            super().process_update(update)
+        elif update.callback_query is not None:
+            self.shards.submit_urgent(chat_id, super().process_update, update)
+        else:
+            self.shards.submit(chat_id, super().process_update, update)
+
+if __name__ == "__main__":
+    # click-to-answer latency against fakeapi.py: python3 shards.py [clicks] [shards]
+    # every shard is busy with joins whose Bot API calls take join_wait
+    import sys
+    import json
+    import http.client
+    from random import randrange
+    from statistics import median
+    from threading import local, Event
+    from time import perf_counter, sleep
+    from fakeapi import FakeBotAPI
+    clicks = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    nshards = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    (chats, join_wait, click_rate) = (200, 0.05, 100)
+
+    api = FakeBotAPI(rate=0)
+    server = api.serve(18082)
+    conns = local()
+    def call(method: str, **data) -> object:
+        if not hasattr(conns, 'conn'):
+            conns.conn = http.client.HTTPConnection('127.0.0.1', 18082)
+        conns.conn.request('POST', f'/botX/{method}', json.dumps(data), {'Content-Type': 'application/json'})
+        return json.loads(conns.conn.getresponse().read())['result']
+
+    def join(chat_id: int) -> None:
+        sleep(join_wait)  # a slow Bot API
+        call('sendMessage', chat_id=chat_id, text='captcha')
+    def click_answer_last(chat_id: int, clicked: float, latencies: list) -> None:
+        call('getChatAdministrators', chat_id=chat_id)
+        call('restrictChatMember', chat_id=chat_id, user_id=1)
+        call('answerCallbackQuery', callback_query_id='1', text='ok')
+        latencies.append(perf_counter() - clicked)
+        call('deleteMessage', chat_id=chat_id, message_id=1)
+    def consequences(chat_id: int) -> None:
+        call('restrictChatMember', chat_id=chat_id, user_id=1)
+        call('deleteMessage', chat_id=chat_id, message_id=1)
+    def click_answer_first(chat_id: int, clicked: float, latencies: list) -> None:
+        call('answerCallbackQuery', callback_query_id='1', text='ok')
+        latencies.append(perf_counter() - clicked)
+        shards.submit(chat_id, consequences, chat_id)
+
+    for (name, urgent, click) in (('fifo, answer last', False, click_answer_last),
+                                  ('urgent, answer first', True, click_answer_first)):
+        shards = ChatShards(nshards)
+        latencies = list()
+        stop = Event()
+        def load() -> None:
+            # keep every shard about 20 joins deep
+            while not stop.is_set():
+                if sum(shards.stats()['depth']) < 20 * nshards:
+                    chat_id = -1000000000000 - randrange(chats)
+                    shards.submit(chat_id, join, chat_id)
+                else:
+                    sleep(0.001)
+        loader = Thread(target=load, daemon=True)
+        loader.start()
+        sleep(0.5)
+        futures = list()
+        for n in range(clicks):
+            chat_id = -1000000000000 - randrange(chats)
+            submit = shards.submit_urgent if urgent else shards.submit
+            futures.append(submit(chat_id, click, chat_id, perf_counter(), latencies))
+            sleep(1 / click_rate)
+        for f in futures:
+            f.result()
+        stop.set()
+        loader.join()
+        lat = sorted(latencies)
+        print(f"{name:>22}: click to answer median {median(lat) * 1000:7.1f} ms, "
+              f"p99 {lat[int(len(lat) * 0.99)] * 1000:7.1f} ms")
+    server.shutdown()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# SQLite persistence for python-telegram-bot, one row per (chat, key)
+import logging
+logger = logging.getLogger('antispambot.persistence')
+
+import os
+import pickle
+import sqlite3
+from collections import defaultdict
+from threading import Lock, RLock
+from time import monotonic
+from typing import Callable, Dict, List, Set, Tuple, Optional
+
+from telegram.ext import BasePersistence
+
+# never written to disk, they are rebuilt from new updates
+EPHEMERAL_KEYS = ('stored_messages',)
+
+class ChatData(dict):
+    '''
+        chat_data of one chat, remembers the keys which were set, removed or read
+        since the last write. A value which was read may have been changed in place,
+        any other key is unchanged and need not be pickled again.
+    '''
+    __slots__ = ('_touched',)
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._touched: Set[str] = set()
+    def touch(self, key: str) -> None:
+        self._touched.add(key)
+    def touched(self) -> Set[str]:
+        '''
+            the keys to write, forgotten until they are touched again
+        '''
+        (keys, self._touched) = (self._touched, set())
+        return keys
+    def __getitem__(self, key):
+        self._touched.add(key)
+        return super().__getitem__(key)
+    def get(self, key, default=None):
+        self._touched.add(key)
+        return super().get(key, default)
+    def setdefault(self, key, default=None):
+        self._touched.add(key)
+        return super().setdefault(key, default)
+    def __setitem__(self, key, value) -> None:
+        self._touched.add(key)
+        super().__setitem__(key, value)
+    def __delitem__(self, key) -> None:
+        self._touched.add(key)
+        super().__delitem__(key)
+    def pop(self, key, *default):
+        self._touched.add(key)
+        return super().pop(key, *default)
+    def popitem(self) -> tuple:
+        (key, value) = super().popitem()
+        self._touched.add(key)
+        return (key, value)
+    def update(self, *args, **kwargs) -> None:
+        other = dict(*args, **kwargs)
+        self._touched.update(other)
+        super().update(other)
+    def clear(self) -> None:
+        self._touched.update(self.keys())
+        super().clear()
+
+class LazyChatData(defaultdict):
+    '''
+        chat_data of the dispatcher, a chat is read from the database on first access
+    '''
+    def __init__(self, persistence: 'SQLitePersistence') -> None:
+        super().__init__(ChatData)
+        self._persistence = persistence
+        self._lock = RLock()
+        self._seen: Dict[int, float] = dict()  # chat_id: last access
+    def __getitem__(self, chat_id: int) -> ChatData:
+        self._seen[chat_id] = monotonic()
+        return super().__getitem__(chat_id)
+    def idle(self, seconds: float) -> List[int]:
+        '''
+            loaded chats which were not accessed for `seconds`
+        '''
+        since = monotonic() - seconds
+        return [chat_id for (chat_id, seen) in list(self._seen.items()) if seen < since]
+    def __missing__(self, chat_id: int) -> dict:
+        with self._lock:
+            if dict.__contains__(self, chat_id):
+                return dict.__getitem__(self, chat_id)
+            data = self._persistence.load_chat(chat_id)
+            dict.__setitem__(self, chat_id, data)
+            return data
+
+class SQLitePersistence(BasePersistence):
+    '''
+        Writes only the durable keys of a chat which actually changed,
+        in WAL mode. Chats are loaded lazily, see LazyChatData.
+        user_data, bot_data and conversations are not stored.
+        on_load(chat_id, data) is called once for every chat read from the database.
+    '''
+    def __init__(self, filename: str, import_pickle: str = None,
+                 on_load: Callable[[int, dict], None] = None) -> None:
+        super().__init__(store_user_data=False, store_chat_data=True, store_bot_data=False)
+        self.filename = filename
+        self.on_load = on_load
+        self._lock = Lock()
+        self.connect()
+        self._written: Dict[int, Dict[str, bytes]] = dict()  # what the database holds for loaded chats
+        self.chat_data: Optional[LazyChatData] = None
+        if import_pickle and os.path.exists(import_pickle):
+            self._import_pickle(import_pickle)
+
+    def connect(self) -> None:
+        '''
+            (re)open the database, a forked process must call close() before
+            the fork and connect() after it
+        '''
+        with self._lock:
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            # other processes may hold the write lock for a moment
+            self._conn.execute('PRAGMA busy_timeout=5000')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS chat_data ('
+                               'chat_id INTEGER NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, '
+                               'PRIMARY KEY (chat_id, key)) WITHOUT ROWID')
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _import_pickle(self, filename: str) -> None:
+        '''
+            one-time migration from PicklePersistence
+        '''
+        with self._lock:
+            if self._conn.execute('SELECT 1 FROM chat_data LIMIT 1').fetchone():
+                return
+        try:
+            with open(filename, 'rb') as f:
+                chat_data = pickle.load(f).get('chat_data', dict())
+        except Exception as err:
+            logger.error(f'Cannot import {filename}: {err}')
+            return
+        for chat_id, data in chat_data.items():
+            self.update_chat_data(chat_id, data)
+            self._written.pop(chat_id, None)
+        logger.warning(f'Imported {len(chat_data)} chats from {filename}')
+
+    def load_chat(self, chat_id: int) -> ChatData:
+        data = ChatData()
+        written = dict()
+        with self._lock:
+            rows = self._conn.execute('SELECT key, value FROM chat_data WHERE chat_id = ?', (chat_id,)).fetchall()
+        for (key, value) in rows:
+            try:
+                data[key] = pickle.loads(value)
+            except Exception as err:
+                logger.error(f'Cannot load {key} of chat {chat_id}: {err}')
+            else:
+                written[key] = value
+        with self._lock:
+            self._written[chat_id] = written
+        if self.on_load:
+            try:
+                self.on_load(chat_id, data)
+            except Exception as err:
+                logger.error(f'on_load failed for chat {chat_id}: {err}')
+        return data
+
+    def _dump(self, data: dict, keys: Optional[Set[str]] = None) -> Dict[str, bytes]:
+        dumped = dict()
+        for key in (list(data) if keys is None else keys):
+            if key in EPHEMERAL_KEYS:
+                continue
+            try:
+                dumped[key] = pickle.dumps(dict.__getitem__(data, key), protocol=pickle.HIGHEST_PROTOCOL)
+            except KeyError:
+                # removed
+                pass
+            except RuntimeError:
+                # changed by another thread meanwhile, the next update writes it
+                if keys is not None:
+                    data.touch(key)
+        return dumped
+
+    def chats_with(self, key: str) -> List[int]:
+        '''
+            ids of the stored chats which have `key`, without loading them
+        '''
+        with self._lock:
+            return [row[0] for row in self._conn.execute('SELECT chat_id FROM chat_data WHERE key = ?', (key,))]
+
+    def get_chat_data(self) -> LazyChatData:
+        if self.chat_data is None:
+            self.chat_data = LazyChatData(self)
+        return self.chat_data
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        '''
+            called after every update of the chat: only the keys a ChatData
+            was touched at are pickled, any other dict is compared in full
+        '''
+        keys = data.touched() if isinstance(data, ChatData) else None
+        dumped = self._dump(data, keys)
+        with self._lock:
+            written = self._written.setdefault(chat_id, dict())
+            changed = [(chat_id, k, v) for (k, v) in dumped.items() if written.get(k, None) != v]
+            # a key which could not be pickled this time is still there
+            removed = [(chat_id, k) for k in written
+                       if (keys is None or k in keys) and k not in data and k not in EPHEMERAL_KEYS]
+            if not (changed or removed):
+                return
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany('INSERT OR REPLACE INTO chat_data (chat_id, key, value) VALUES (?, ?, ?)', changed)
+                self._conn.executemany('DELETE FROM chat_data WHERE chat_id = ? AND key = ?', removed)
+            for (_, k, v) in changed:
+                written[k] = v
+            for (_, k) in removed:
+                del written[k]
+
+    def idle_chats(self, seconds: float) -> List[int]:
+        return self.chat_data.idle(seconds) if self.chat_data is not None else list()
+
+    def forget_chat(self, chat_id: int) -> None:
+        '''
+            drop a loaded chat from memory, it is loaded again on next access
+        '''
+        if self.chat_data is not None:
+            with self.chat_data._lock:
+                data = self.chat_data.pop(chat_id, None)
+                self.chat_data._seen.pop(chat_id, None)
+            if data is not None:
+                self.update_chat_data(chat_id, data)
+        with self._lock:
+            self._written.pop(chat_id, None)
+
+    def flush(self) -> None:
+        if self.chat_data is not None:
+            for chat_id in list(self.chat_data):
+                self.update_chat_data(chat_id, self.chat_data[chat_id])
+        with self._lock:
+            self._conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    # chat_data holds no Bot, it is stored as it is instead of a deep copy per update
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        return obj
+    def insert_bot(self, obj: object) -> object:
+        return obj
+
+    # not stored
+    def get_user_data(self) -> defaultdict:
+        return defaultdict(dict)
+    def get_bot_data(self) -> dict:
+        return dict()
+    def get_conversations(self, name: str) -> dict:
+        return dict()
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        pass
+    def update_bot_data(self, data: dict) -> None:
+        pass
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        pass
+
+if __name__ == "__main__":
+    # benchmark: python3 sqlitepersistence.py [chats]
+    import sys
+    import resource
+    from time import perf_counter
+    from tempfile import TemporaryDirectory
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    def chat(n: int) -> dict:
+        return {'chat_settings': {'CHALLENGE_TIMEOUT': 300, 'WELCOME_WORDS': [f'hello {n}']},
+                'last_at_admins': float(n), 'spam_violations': {n: 1},
+                'stored_messages': [(n, m, 0) for m in range(100)]}
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.sqlite')
+        p = SQLitePersistence(path)
+        data = p.get_chat_data()
+        t = perf_counter()
+        for n in range(chats):
+            data[-n].update(chat(n))
+            p.update_chat_data(-n, data[-n])
+        print(f"initial save of {chats} chats: {perf_counter() - t:.3f}s")
+        data[-1]['chat_settings']['CHALLENGE_TIMEOUT'] = 60
+        t = perf_counter()
+        p.update_chat_data(-1, data[-1])
+        print(f"save after one setting changed: {(perf_counter() - t) * 1000:.3f}ms")
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        p = SQLitePersistence(path)
+        data = p.get_chat_data()
+        t = perf_counter()
+        data[-1]
+        print(f"lazy load of one chat: {(perf_counter() - t) * 1000:.3f}ms")
+        t = perf_counter()
+        for n in range(chats):
+            data[-n]
+        print(f"load of all {chats} chats: {perf_counter() - t:.3f}s")
+        print(f"max RSS: {rss / 1024:.1f} MiB, database: {os.path.getsize(path) / 1024:.0f} KiB")
@@ -0,0 +1,16 @@
+# the modules import config.py, which is not in the repository: use the example
+import os
+import sys
+import importlib.util
+from importlib.machinery import SourceFileLoader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if importlib.util.find_spec('config') is None:
+    loader = SourceFileLoader('config', os.path.join(ROOT, 'config.py.example'))
+    spec = importlib.util.spec_from_loader('config', loader)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    config.TOKEN = '123456:test-token'  # Bot() checks the format
+    sys.modules['config'] = config
@@ -0,0 +1,16 @@
+from chatconfig import ChatConfigs, DEFAULT_CONFIG
+
+def test_least_recently_used_configs_are_evicted():
+    configs = ChatConfigs(maxsize=3)
+    chats = {-n: dict() for n in range(1, 5)}
+    configs.save(-1, chats[-1], {'FLOOD_LIMIT': 10})
+    for chat_id in (-2, -3, -1, -4):
+        configs.get(chat_id, chats[chat_id])
+    assert len(configs) == 3
+    assert -2 not in configs._configs
+    assert configs.get(-2, chats[-2]) is DEFAULT_CONFIG
+    # the saved settings are compiled again from chat_data
+    configs = ChatConfigs(maxsize=1)
+    configs.save(-1, chats[-1], chats[-1]['chat_settings'])
+    configs.get(-2, chats[-2])
+    assert configs.get(-1, chats[-1]).FLOOD_LIMIT == 10
@@ -0,0 +1,21 @@
+from deadlines import DeadlineScheduler
+
+def test_overdue_before_first_tick():
+    wheel = DeadlineScheduler()
+    now = 100000.0
+    wheel.schedule('challenge', -1, 1, 10, now - 300)
+    wheel.schedule('challenge', -1, 2, 11, now - 1)
+    wheel.schedule('challenge', -1, 3, 12, now + 30)
+    due = wheel.advance(now)
+    assert sorted(rec.user_id for rec in due[('challenge', -1)]) == [1, 2]
+    assert len(wheel) == 1
+    assert wheel.advance(now + 29) == dict()
+    assert [rec.user_id for rec in wheel.advance(now + 30)[('challenge', -1)]] == [3]
+
+def test_overdue_after_first_tick():
+    wheel = DeadlineScheduler()
+    now = 100000.0
+    wheel.advance(now)
+    wheel.schedule('delete', -1, 1, 10, now - 60)
+    assert wheel.advance(now) == dict()
+    assert [rec.user_id for rec in wheel.advance(now + 1)[('delete', -1)]] == [1]
@@ -0,0 +1,124 @@
+import os
+import subprocess
+import sys
+from time import sleep, time
+
+import pytest
+
+from fakeapi import FakeBotAPI
+from sqlitepersistence import SQLitePersistence
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAT_ID = -1000000000000
+JOINS = 10
+
+@pytest.fixture
+def run_bot(tmp_path):
+    '''
+        bot.py in a subprocess against a FakeBotAPI without background traffic,
+        the chat starts with the given chat_settings
+    '''
+    procs = list()
+    def start(chat_settings: dict) -> FakeBotAPI:
+        api = FakeBotAPI(rate=0, chats=1)
+        server = api.serve(0)
+        procs.append(server)
+        # every bot has its own directory
+        workdir = tmp_path / str(len(procs))
+        workdir.mkdir()
+        sqlite_file = str(workdir / 'antispambot.sqlite')
+        with open(os.path.join(ROOT, 'config.py.example')) as f:
+            config = f.read()
+        (workdir / 'config.py').write_text(config + f'''
+TOKEN = '123456:test-token'
+WORKERS = 4
+SQLITE_FILE = {sqlite_file!r}
+PICKLE_FILE = ''
+BOT_API_URL = 'http://127.0.0.1:{server.server_address[1]}/bot'
+''')
+        persistence = SQLitePersistence(sqlite_file)
+        persistence.update_chat_data(CHAT_ID, {'chat_settings': chat_settings, 'settings_ver': 1})
+        persistence.close()
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (str(workdir), os.environ.get('PYTHONPATH'))
+                                                          if p))
+        procs.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'bot.py')], cwd=str(workdir), env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        return api
+    yield start
+    for proc in procs:
+        if isinstance(proc, subprocess.Popen):
+            proc.kill()
+            proc.wait()
+        else:
+            proc.shutdown()
+
+def wait_for(api: FakeBotAPI, done, timeout: float = 30) -> None:
+    deadline = time() + timeout
+    while not done(api.calls):
+        assert time() < deadline, f'calls so far: {dict(api.calls)}'
+        sleep(0.1)
+
+def test_raid_edits_one_flood_captcha(run_bot):
+    # every join is flooding, the chat is not locked
+    api = run_bot({'FLOOD_LIMIT': 1, 'RAID_LIMIT': 0})
+    wait_for(api, lambda calls: calls['getUpdates'] > 0)
+    api.raid(CHAT_ID, JOINS)
+    wait_for(api, lambda calls: calls['restrictChatMember'] == JOINS)
+    # the last counter update is debounced by FLOOD_EDIT_DELAY
+    sleep(4)
+    assert api.calls['sendMessage'] == 1
+    assert 1 <= api.calls['editMessageText'] < JOINS
+    assert api.calls['deleteMessage'] == api.calls['deleteMessages'] == 0
+
+def test_join_requests_are_approved_or_declined(run_bot):
+    api = run_bot({'JOIN_REQUESTS': True})
+    api.answer_captchas = True
+    wait_for(api, lambda calls: calls['getUpdates'] > 0)
+    api.raid(CHAT_ID, JOINS, requests=True)
+    wait_for(api, lambda calls: calls['approveChatJoinRequest'] + calls['declineChatJoinRequest'] >= JOINS)
+    sleep(1)
+    assert api.calls['approveChatJoinRequest'] + api.calls['declineChatJoinRequest'] == JOINS
+    assert api.calls['sendMessage'] == api.calls['answerCallbackQuery'] == JOINS
+    # the buttons are gone after the verdict
+    assert api.calls['editMessageText'] == JOINS
+    for method in ('restrictChatMember', 'banChatMember', 'kickChatMember', 'deleteMessage', 'deleteMessages'):
+        assert api.calls[method] == 0
+
+# the Bot API calls caused by a join
+JOIN_METHODS = ('restrictChatMember', 'banChatMember', 'kickChatMember', 'sendMessage', 'editMessageText',
+                'answerCallbackQuery', 'deleteMessage', 'deleteMessages',
+                'approveChatJoinRequest', 'declineChatJoinRequest')
+
+def calls_per_join(api: FakeBotAPI) -> float:
+    return sum(api.calls[method] for method in JOIN_METHODS) / JOINS
+
+def settle(api: FakeBotAPI, quiet: float = 3, timeout: float = 60) -> None:
+    '''
+        until no join causes calls anymore
+    '''
+    deadline = time() + timeout
+    last = None
+    while (current := calls_per_join(api)) != last:
+        assert time() < deadline, f'calls so far: {dict(api.calls)}'
+        last = current
+        sleep(quiet)
+
+def test_join_requests_need_fewer_calls_than_restricting(run_bot):
+    # one captcha per join in both modes
+    restrict = run_bot({'FLOOD_LIMIT': 0, 'RAID_LIMIT': 0})
+    requests = run_bot({'JOIN_REQUESTS': True})
+    for api in (restrict, requests):
+        api.answer_captchas = True
+        wait_for(api, lambda calls: calls['getUpdates'] > 0)
+    restrict.raid(CHAT_ID, JOINS)
+    requests.raid(CHAT_ID, JOINS, requests=True)
+    # restricted, then unrestricted or banned
+    wait_for(restrict, lambda calls: calls['restrictChatMember'] + calls['banChatMember'] + calls['kickChatMember']
+                                     >= 2 * JOINS)
+    wait_for(requests, lambda calls: calls['editMessageText'] >= JOINS)
+    # the deletions wait for the action budget
+    settle(restrict)
+    # sendMessage, answerCallbackQuery, approve or decline, editMessageText
+    assert calls_per_join(requests) == 4
+    # restrict, sendMessage, answerCallbackQuery, unrestrict or ban, and coalesced deletions
+    assert calls_per_join(requests) < calls_per_join(restrict)
@@ -0,0 +1,47 @@
+from queue import Queue
+from threading import Event
+from time import time
+from types import SimpleNamespace
+
+import bot
+from deadlines import DeadlineScheduler
+from shards import ShardedDispatcher
+from sqlitepersistence import SQLitePersistence
+
+CHAT_ID = -1001234567890
+
+def sharded(tmp_path, monkeypatch) -> ShardedDispatcher:
+    persistence = SQLitePersistence(str(tmp_path / 'antispambot.sqlite'))
+    dispatcher = ShardedDispatcher(bot.mqbot, Queue(), persistence=persistence, use_context=True, shards=1)
+    monkeypatch.setattr(bot, 'ppersistence', persistence, raising=False)
+    monkeypatch.setattr(bot, 'updater', SimpleNamespace(dispatcher=dispatcher), raising=False)
+    monkeypatch.setattr(bot, 'gc_index', DeadlineScheduler(resolution=60))
+    return dispatcher
+
+def test_gc_does_not_wait_for_a_busy_shard(tmp_path, monkeypatch):
+    dispatcher = sharded(tmp_path, monkeypatch)
+    u_mgr = dispatcher.chat_data[CHAT_ID]['u_mgr'] = bot.UserManager(CHAT_ID)
+    u_mgr.add(bot.restUser(42, 100, 101, None))
+    bot.gc_index.schedule(bot.DL_EXPIRE, CHAT_ID, 42, 100, time() - bot.USER_EXPIRY)
+    busy = Event()
+    dispatcher.shards.submit(CHAT_ID, busy.wait)
+    start = time()
+    bot.do_garbage_collection(None)
+    assert time() - start < 1
+    assert u_mgr.get(42)
+    busy.set()
+    dispatcher.shards.submit(CHAT_ID, lambda: None).result(timeout=5)
+    assert not u_mgr.get(42)
+
+def test_gc_forgets_idle_chats(tmp_path, monkeypatch):
+    dispatcher = sharded(tmp_path, monkeypatch)
+    (idle, pending) = (CHAT_ID, CHAT_ID - 1)
+    dispatcher.chat_data[idle]['settings_ver'] = 1
+    dispatcher.chat_data[pending]['u_mgr'] = bot.UserManager(pending)
+    dispatcher.chat_data[pending]['u_mgr'].add(bot.restUser(42, 100, 101, None))
+    monkeypatch.setattr(bot, 'CHAT_IDLE', 0)
+    bot.do_garbage_collection(None)
+    dispatcher.shards.submit(CHAT_ID, lambda: None).result(timeout=5)
+    assert set(dispatcher.chat_data) == {pending}
+    # written before it was dropped
+    assert dispatcher.chat_data[idle]['settings_ver'] == 1
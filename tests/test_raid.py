@@ -0,0 +1,54 @@
+from concurrent.futures import Future
+from queue import Queue
+from types import SimpleNamespace
+
+import bot
+from deadlines import DeadlineScheduler
+from ratelimited import DelayedMessage
+from shards import ShardedDispatcher
+
+def test_failed_lock_is_not_retried_on_every_join(monkeypatch):
+    chat_id = -1000000000001
+    attempts = list()
+    def lock_chat(context, chat_id):
+        attempts.append(chat_id)
+        return False
+    monkeypatch.setattr(bot, 'lock_chat', lock_chat, raising=False)
+    monkeypatch.setattr(bot, 'deadlines', DeadlineScheduler())
+    context = SimpleNamespace(chat_data=dict(), bot=None)
+    assert all(bot.raid_lockdown(context, chat_id, 1) is None for _ in range(100))
+    assert attempts == [chat_id]
+
+def test_raided_chat_does_not_hold_its_shard(monkeypatch):
+    (raided, other) = (-1000000000002, -1000000000004)
+    limiter = DelayedMessage()
+    # flood control: nothing may be sent to the raided chat for a minute
+    limiter.penalize(60, raided)
+    sent = list()
+    class FakeBot:
+        @limiter.delayed
+        def send_message(self, chat_id, **kwargs):
+            sent.append(chat_id)
+            return SimpleNamespace(message_id=len(sent))
+    def restrict_user(context, chat_id, user_id, **kwargs):
+        future = Future()
+        future.set_result(True)
+        return future
+    dispatcher = ShardedDispatcher(bot.mqbot, Queue(), use_context=True, shards=1)
+    monkeypatch.setattr(bot, 'updater', SimpleNamespace(dispatcher=dispatcher), raising=False)
+    monkeypatch.setattr(bot, 'delayed_message', limiter)
+    monkeypatch.setattr(bot, 'restrict_user', restrict_user, raising=False)
+    monkeypatch.setattr(bot, 'delete_messages', lambda context, chat_id, msgids: None, raising=False)
+    monkeypatch.setattr(bot, 'deadlines', DeadlineScheduler())
+    monkeypatch.setattr(bot, 'gc_index', DeadlineScheduler(resolution=60))
+    context = SimpleNamespace(bot=FakeBot(), chat_data=dispatcher.chat_data[raided])
+    for n in range(50):
+        user = SimpleNamespace(id=5000 + n, full_name=f'user {n}', is_bot=False)
+        dispatcher.shards.submit(raided, bot.simple_challenge, context, raided, user, user, 100 + n)
+    # both chats are on the only shard
+    dispatcher.shards.submit(other, lambda: None).result(timeout=5)
+    dispatcher.shards.submit(raided, lambda: None).result(timeout=5)
+    assert sent == []
+    # the captchas wait on the deadline wheel
+    assert len(dispatcher.chat_data[raided]['u_mgr']) == 50
+    assert all(bot.deadlines.get(bot.DL_SEND, raided, 5000 + n, 100 + n) for n in range(50))
@@ -0,0 +1,56 @@
+from threading import Thread
+from time import monotonic, sleep
+
+from telegram.error import RetryAfter
+
+from ratelimited import ActionQueue, DelayedMessage, TokenBucket, PRIO_KICK
+
+def test_token_bucket_burst():
+    bucket = TokenBucket(20, 60)
+    now = 1000.0
+    assert all(bucket.reserve(now) == now for _ in range(20))
+    assert bucket.reserve(now) == now + 3
+
+def test_noisy_chat_does_not_delay_quiet_chat():
+    limiter = DelayedMessage()
+    noisy = [Thread(target=limiter.wait, args=(-1,), daemon=True) for _ in range(25)]
+    for t in noisy:
+        t.start()
+    sleep(0.2)
+    # 5 messages of the noisy chat wait for its per chat budget, up to 15 seconds
+    assert sum(t.is_alive() for t in noisy) == 5
+    start = monotonic()
+    assert limiter.wait(-2) < 0.1
+    assert monotonic() - start < 0.1
+
+def test_action_queue_requeues_on_flood_control():
+    queue = ActionQueue(burst_limit=10, time_limit_ms=1000, threads=1)
+    calls = list()
+    def action(n: int) -> int:
+        calls.append(n)
+        if len(calls) == 1:
+            raise RetryAfter(0.2)
+        return n
+    start = monotonic()
+    assert queue.submit(PRIO_KICK, -1, action, 7).result(timeout=5) == 7
+    assert calls == [7, 7]
+    assert monotonic() - start >= 0.2
+    # telegram keeps refusing: the caller gets the error in the end
+    def refused() -> None:
+        raise RetryAfter(0)
+    err = queue.submit(PRIO_KICK, -1, refused).exception(timeout=5)
+    assert isinstance(err, RetryAfter)
+
+def test_action_queue_waits_for_its_reservation():
+    class RacingBucket(TokenBucket):
+        # the token looks available, but another worker process takes it first
+        def available(self, at: float) -> float:
+            return at
+    queue = ActionQueue(burst_limit=1, time_limit_ms=200, threads=2)
+    queue._bucket = RacingBucket(1, 0.2)
+    times = list()
+    futures = [queue.submit(PRIO_KICK, -n, lambda: times.append(monotonic())) for n in range(3)]
+    for f in futures:
+        f.result(timeout=5)
+    times.sort()
+    assert all(b - a >= 0.19 for (a, b) in zip(times, times[1:]))
@@ -0,0 +1,75 @@
+from concurrent.futures import Future
+from queue import Queue
+from time import time
+
+import bot
+from deadlines import DeadlineScheduler
+from shards import ShardedDispatcher
+from sqlitepersistence import SQLitePersistence
+from telegram.ext import CallbackContext, JobQueue, Updater
+
+CHAT_ID = -1001234567890
+
+def start(filename: str, monkeypatch) -> Updater:
+    '''
+        what bot.py does on start, without polling
+    '''
+    persistence = SQLitePersistence(filename, on_load=bot.migrate_chat_data)
+    job_queue = JobQueue()
+    dispatcher = ShardedDispatcher(bot.mqbot, Queue(), job_queue=job_queue,
+                                   persistence=persistence, use_context=True, shards=2)
+    job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+    monkeypatch.setattr(bot, 'ppersistence', persistence, raising=False)
+    monkeypatch.setattr(bot, 'updater', updater, raising=False)
+    # a new process starts with an empty wheel
+    monkeypatch.setattr(bot, 'deadlines', DeadlineScheduler())
+    return updater
+
+def test_overdue_challenge_times_out_after_restart(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'antispambot.sqlite')
+    kicked, deleted = list(), list()
+    def kick_user(context, chat_id, user_id, **kwargs):
+        kicked.append((chat_id, user_id))
+        future = Future()
+        future.set_result(True)
+        return future
+    monkeypatch.setattr(bot, 'kick_user', kick_user, raising=False)
+    monkeypatch.setattr(bot, 'delete_messages', lambda context, chat_id, msgids: deleted.extend(msgids), raising=False)
+
+    updater = start(filename, monkeypatch)
+    chat_data = updater.dispatcher.chat_data[CHAT_ID]
+    u_mgr = chat_data['u_mgr'] = bot.UserManager(CHAT_ID)
+    u_mgr.add(bot.restUser(42, 100, 101, None, deadline=time() - 60))
+    bot.ppersistence.update_chat_data(CHAT_ID, chat_data)
+    bot.ppersistence.flush()
+
+    # the pending user is read back from the database
+    updater = start(filename, monkeypatch)
+    bot.restore_pending_challenges()
+    assert len(bot.deadlines) == 1
+    bot.run_deadlines(CallbackContext(updater.dispatcher))
+    # the timeouts run in the shard of the chat
+    updater.dispatcher.shards.submit(CHAT_ID, lambda: None).result(timeout=10)
+    assert kicked == [(CHAT_ID, 42)]
+    assert sorted(deleted) == [100, 101]
+
+    # and the timeout is stored
+    persistence = SQLitePersistence(filename)
+    assert not persistence.get_chat_data()[CHAT_ID]['u_mgr'].get(42)
+
+def test_join_approval_expires_after_restart(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'antispambot.sqlite')
+    updater = start(filename, monkeypatch)
+    chat_data = updater.dispatcher.chat_data[CHAT_ID]
+    # the user was approved, but never joined
+    chat_data['join_approved'] = {42: time() - 60}
+    bot.ppersistence.update_chat_data(CHAT_ID, chat_data)
+    bot.ppersistence.flush()
+
+    updater = start(filename, monkeypatch)
+    bot.restore_pending_challenges()
+    assert bot.deadlines.get(bot.DL_APPROVED, CHAT_ID, 42, 0)
+    bot.run_deadlines(CallbackContext(updater.dispatcher))
+    updater.dispatcher.shards.submit(CHAT_ID, lambda: None).result(timeout=10)
+    assert 'join_approved' not in updater.dispatcher.chat_data[CHAT_ID]
@@ -0,0 +1,61 @@
+import pickle
+
+from sqlitepersistence import SQLitePersistence
+
+CHAT_ID = -1001234567890
+
+class Flaky:
+    '''
+        pickling fails once, as if another thread changed it meanwhile
+    '''
+    def __init__(self) -> None:
+        self.fail = False
+    def __reduce_ex__(self, protocol: int) -> tuple:
+        # copy.deepcopy uses protocol 4
+        if self.fail and protocol == pickle.HIGHEST_PROTOCOL:
+            self.fail = False
+            raise RuntimeError('dictionary changed size during iteration')
+        return (Flaky, (), dict(self.__dict__))
+
+def test_a_key_which_cannot_be_pickled_is_kept(tmp_path):
+    filename = str(tmp_path / 'antispambot.sqlite')
+    persistence = SQLitePersistence(filename)
+    data = {'u_mgr': Flaky(), 'settings_ver': 1}
+    persistence.update_chat_data(CHAT_ID, data)
+    data['u_mgr'].fail = True
+    data['settings_ver'] = 2
+    persistence.update_chat_data(CHAT_ID, data)
+    persistence.close()
+    assert set(SQLitePersistence(filename).get_chat_data()[CHAT_ID]) == {'u_mgr', 'settings_ver'}
+
+class Counted:
+    '''
+        counts how often it is pickled
+    '''
+    dumps = 0
+    def __init__(self) -> None:
+        self.users = list()
+    def __reduce_ex__(self, protocol: int) -> tuple:
+        Counted.dumps += 1
+        return (Counted, (), dict(self.__dict__))
+
+def test_only_touched_keys_are_pickled(tmp_path):
+    filename = str(tmp_path / 'antispambot.sqlite')
+    persistence = SQLitePersistence(filename)
+    chat_data = persistence.get_chat_data()
+    chat_data[CHAT_ID]['u_mgr'] = Counted()
+    persistence.update_chat_data(CHAT_ID, chat_data[CHAT_ID])
+    assert Counted.dumps == 1
+    # an update which does not look at u_mgr
+    chat_data[CHAT_ID]['last_at_admins'] = 1.0
+    persistence.update_chat_data(CHAT_ID, chat_data[CHAT_ID])
+    assert Counted.dumps == 1
+    # changed in place
+    chat_data[CHAT_ID].get('u_mgr').users.append(42)
+    chat_data[CHAT_ID].pop('last_at_admins')
+    persistence.update_chat_data(CHAT_ID, chat_data[CHAT_ID])
+    assert Counted.dumps == 2
+    persistence.close()
+    stored = SQLitePersistence(filename).get_chat_data()[CHAT_ID]
+    assert set(stored) == {'u_mgr'}
+    assert stored['u_mgr'].users == [42]
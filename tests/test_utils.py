@@ -0,0 +1,18 @@
+import re
+
+from utils import SPAM_PATTERNS, is_spam_message, scan_spam_features
+
+def test_scan_reports_every_feature():
+    text = 'Заработок от 1000 рублей, пиши в лс: t.me/cashflow, +79991234567, почта cash.flow@gmail.com'
+    features = scan_spam_features(text)
+    assert features.is_spam and is_spam_message(text)
+    assert features.links == 1 and features.phone and features.email
+    expected = [idx for (idx, (feature, pattern)) in enumerate(SPAM_PATTERNS)
+                if feature == 'keyword' and re.search(pattern, text.lower())]
+    assert sorted(features.keywords) == expected
+    assert 'links: 1' in str(features)
+
+def test_scan_clean_message():
+    features = scan_spam_features('привет всем, как дела?')
+    assert not features.is_spam and not is_spam_message('привет всем, как дела?')
+    assert str(features) == ''
@@ -1,5 +1,7 @@
-# This is the userbot api backend of kick_user, restrict_user, unban_user, delete_message
-from typing import Union, Any, Coroutine
+# This is the userbot api backend of kick_user, restrict_user, unban_user, delete_message, lock_chat, unlock_chat
+# MTProto calls are not queued, with block=False the result is returned as a done Future like bot_backend does
+from typing import Union, Any, List, Dict, Iterable
+from concurrent.futures import Future
 import logging
 logger = logging.getLogger('antispambot.userbot_backend')
 
@@ -9,11 +11,12 @@ from typeguard import typechecked
 
 from telethon import TelegramClient, events
 from telethon.tl.types import PeerUser, PeerChat, PeerChannel
-from telethon.tl.types import InputPeerUser, InputPeerChat, InputPeerChannel
+from telethon.tl.types import InputPeerUser
 from telegram.ext import CallbackContext
 from utils import print_traceback, background
 from time import sleep
 from threading import Lock
+from datetime import timedelta
 
 session_name: str = 'antispam'
 client = TelegramClient(session_name, API_ID, API_HASH)
@@ -97,13 +100,19 @@ async def get_input_entity(user_id: int, chat: Union[int, PeerChat, PeerChannel]
         return await client.get_input_entity(PeerUser(user_id))
 
 
+def until_date(duration: int = 0) -> Union[timedelta, int]:
+    '''
+        expires on the server, 0 is forever, as is anything shorter than 30 seconds
+    '''
+    return timedelta(seconds=max(duration, 30)) if duration > 0 else 0
+
 @typechecked
-async def userbot_kick_user(chat_id: int, user_id: int) -> bool:
+async def userbot_kick_user(chat_id: int, user_id: int, duration: int = 0) -> bool:
     try:
         await client.edit_permissions(
                   await client.get_input_entity(chat_id),
                   await get_input_entity(user_id, chat_id),
-                  until_date = 0,
+                  until_date = until_date(duration),
                   view_messages = False,
                   send_messages = False,
                   send_media = False,
@@ -122,12 +131,12 @@ async def userbot_kick_user(chat_id: int, user_id: int) -> bool:
         return False
 
 @typechecked
-async def userbot_restrict_user(chat_id: int, user_id: int) -> bool:
+async def userbot_restrict_user(chat_id: int, user_id: int, duration: int = 0) -> bool:
     try:
         await client.edit_permissions(
                   await client.get_input_entity(chat_id),
                   await get_input_entity(user_id, chat_id),
-                  until_date = 0,
+                  until_date = until_date(duration),
                   view_messages = True,
                   send_messages = False,
                   send_media = False,
@@ -158,12 +167,41 @@ async def userbot_unban_user(chat_id: int, user_id: int) -> bool:
         print_traceback(debug=DEBUG)
         return False
 
+# default rights of a chat, see lock_chat
+CHAT_RIGHTS = ('send_messages', 'send_media', 'send_stickers', 'send_gifs', 'send_games',
+               'send_inline', 'send_polls', 'change_info', 'invite_users', 'pin_messages')
+
+@typechecked
+async def userbot_lock_chat(chat_id: int) -> Union[dict, bool]:
+    try:
+        chat = await client.get_entity(chat_id)
+        rights = getattr(chat, 'default_banned_rights', None)
+        previous = {r: not (rights and getattr(rights, r, False)) for r in CHAT_RIGHTS}
+        await client.edit_permissions(chat, **{r: False for r in CHAT_RIGHTS})
+        return previous
+    except Exception:
+        print_traceback(debug=DEBUG)
+        return False
+
+@typechecked
+async def userbot_unlock_chat(chat_id: int, permissions: dict) -> bool:
+    try:
+        await client.edit_permissions(await client.get_input_entity(chat_id), **permissions)
+        return True
+    except Exception:
+        print_traceback(debug=DEBUG)
+        return False
+
 @typechecked
 async def userbot_delete_message(chat_id: int, message_id: int) -> bool:
+    return await userbot_delete_messages(chat_id, [message_id,])
+
+@typechecked
+async def userbot_delete_messages(chat_id: int, message_ids: List[int]) -> bool:
     try:
         await client.delete_messages(
                   await client.get_input_entity(chat_id),
-                  [message_id,],
+                  message_ids,
                   revoke = True
               )
         return True
@@ -171,42 +209,83 @@ async def userbot_delete_message(chat_id: int, message_id: int) -> bool:
         print_traceback(debug=DEBUG)
         return False
 
+def _done(ret: Any, block: bool) -> Union[Any, Future]:
+    if block:
+        return ret
+    future = Future()
+    future.set_result(ret)
+    return future
+
 @typechecked
-def kick_user(context: CallbackContext, chat_id: int, user_id: Union[int, str], reason: str = '') -> bool:
+def kick_user(context: CallbackContext, chat_id: int, user_id: Union[int, str], reason: str = '', duration: int = 0,
+              block: bool = True) -> Union[bool, Future]:
     user_id = int(user_id)
-    ret = async_run(myCoro(userbot_kick_user, chat_id, user_id))
+    ret = async_run(myCoro(userbot_kick_user, chat_id, user_id, duration))
     if ret:
-        logger.info(f"Kicked {user_id} in the group {chat_id}{', reason: ' if reason else ''}{reason}")
+        logger.info(f"Kicked {user_id} in the group {chat_id}{f' for {duration}s' if duration > 0 else ''}"
+                    f"{', reason: ' if reason else ''}{reason}")
     else:
         logger.error(f"Cannot kick {user_id} in the group {chat_id}")
-    return ret
+    return _done(ret, block)
 
 @typechecked
-def restrict_user(context: CallbackContext, chat_id: int, user_id: Union[int, str], extra: str = '') -> bool:
+def restrict_user(context: CallbackContext, chat_id: int, user_id: Union[int, str], extra: str = '', duration: int = 0,
+                  block: bool = True) -> Union[bool, Future]:
     user_id = int(user_id)
-    ret = async_run(myCoro(userbot_restrict_user, chat_id, user_id))
+    ret = async_run(myCoro(userbot_restrict_user, chat_id, user_id, duration))
     if ret:
         logger.info(f"Restricted {user_id} in the group {chat_id}{extra}")
     else:
         logger.error(f"Cannot restrict {user_id} in the group {chat_id}")
-    return ret
+    return _done(ret, block)
 
 @typechecked
-def unban_user(context: CallbackContext, chat_id: int, user_id: Union[int, str], reason: str = '') -> bool:
+def unban_user(context: CallbackContext, chat_id: int, user_id: Union[int, str], reason: str = '', block: bool = True) -> Union[bool, Future]:
     user_id = int(user_id)
     ret = async_run(myCoro(userbot_unban_user, chat_id, user_id))
     if ret:
         logger.info(f"Unbanned {user_id} in the group {chat_id}{', reason: ' if reason else ''}{reason}")
     else:
         logger.error(f"Cannot unban {user_id} in the group {chat_id}")
-    return ret
+    return _done(ret, block)
 
 @typechecked
-def delete_message(context: CallbackContext, chat_id: int, message_id: Union[int, str]) -> bool:
+def delete_message(context: CallbackContext, chat_id: int, message_id: Union[int, str], block: bool = True) -> Union[bool, Future]:
     message_id = int(message_id)
     ret = async_run(myCoro(userbot_delete_message, chat_id, message_id))
     if ret:
         logger.debug(f"Deleted message {message_id} in the group {chat_id}")
     else:
         logger.error(f"Cannot delete message {message_id} in the group {chat_id}")
-    return ret
+    return _done(ret, block)
+
+@typechecked
+def delete_messages(context: CallbackContext, chat_id: int, message_ids: Iterable[Union[int, str]],
+                    block: bool = True) -> Union[Dict[int, bool], Future]:
+    message_ids = [int(mid) for mid in message_ids]
+    if not message_ids:
+        return _done(dict(), block)
+    ret = bool(async_run(myCoro(userbot_delete_messages, chat_id, message_ids)))
+    if ret:
+        logger.debug(f"Deleted messages {message_ids} in the group {chat_id}")
+    else:
+        logger.error(f"Cannot delete messages {message_ids} in the group {chat_id}")
+    return _done({mid: ret for mid in message_ids}, block)
+
+@typechecked
+def lock_chat(context: CallbackContext, chat_id: int, block: bool = True) -> Union[dict, bool, Future]:
+    ret = async_run(myCoro(userbot_lock_chat, chat_id))
+    if ret:
+        logger.info(f"Locked the group {chat_id}")
+    else:
+        logger.error(f"Cannot lock the group {chat_id}")
+    return _done(ret or False, block)
+
+@typechecked
+def unlock_chat(context: CallbackContext, chat_id: int, permissions: dict, block: bool = True) -> Union[bool, Future]:
+    ret = async_run(myCoro(userbot_unlock_chat, chat_id, permissions))
+    if ret:
+        logger.info(f"Unlocked the group {chat_id}")
+    else:
+        logger.error(f"Cannot unlock the group {chat_id}")
+    return _done(bool(ret), block)
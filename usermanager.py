@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Pending challenge state of a chat, stored in chat_data['u_mgr']
+import logging
+logger = logging.getLogger('antispambot.usermanager')
+
+from time import time
+from typing import Dict, List, Optional
+
+class restUser:
+    '''
+        A user who has not passed the challenge yet
+    '''
+    __slots__ = ('user_id', 'join_msgid', 'clg_msgid', 'uinvite_id', 'flooding', 'time', 'deadline')
+
+    def __init__(self, user_id: int, join_msgid: int, clg_msgid: int, uinvite_id: int, flooding: bool = False,
+                 deadline: float = 0.0):
+        self.user_id = user_id
+        self.join_msgid = join_msgid
+        self.clg_msgid = clg_msgid
+        self.uinvite_id = uinvite_id
+        self.flooding = flooding
+        self.time = int(time())
+        self.deadline = deadline
+    def __getstate__(self) -> tuple:
+        return tuple(getattr(self, k) for k in self.__slots__)
+    def __setstate__(self, state) -> None:
+        if isinstance(state, dict):
+            # pickled before __slots__, may lack newer fields
+            state = tuple(state.get(k, 0.0 if k == 'deadline' else None) for k in self.__slots__)
+        for (k, v) in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+class UserManager:
+    '''
+        All pending users of a chat in one dict, flooding users are counted
+        separately since they share a single challenge message (fldmsg_id).
+        Version history:
+            0.0.2: two dicts for flooding and non-flooding users, pickled as __dict__
+            0.0.3: __slots__, one dict, loaded from 0.0.2 by __setstate__
+            0.0.4: text and keyboard of the flooding captcha, so it can be edited in place
+            0.0.5: no fldmsg_callbacks, the buttons carry signed tokens
+    '''
+    __slots__ = ('_cver', '_chat_id', '_users', '_nflood', 'fldmsg_id',
+                 'fldmsg_text', 'fldmsg_keyboard', 'fldmsg_shown')
+
+    def __init__(self, chat_id: int) -> None:
+        self._cver = self.ver
+        self._chat_id = chat_id
+        self._users: Dict[int, restUser] = dict()
+        self._nflood = 0
+        self.fldmsg_id: Optional[int] = None
+        self.fldmsg_text: str = ''
+        self.fldmsg_keyboard: tuple = ()  # rows of (text, callback_data)
+        self.fldmsg_shown = 0             # pending users count in the text
+    @property
+    def ver(self):
+        return '0.0.5'
+    @property
+    def flooding(self) -> int:
+        '''
+            number of pending flooding users
+        '''
+        return self._nflood
+    def add(self, ruser: restUser) -> None:
+        if self.pop(ruser.user_id):
+            logger.debug(f'User {ruser.user_id} is already pending, chat {self._chat_id}')
+        self._users[ruser.user_id] = ruser
+        self._nflood += bool(ruser.flooding)
+    def get(self, user_id: int) -> Optional[restUser]:
+        return self._users.get(user_id, None)
+    def pop(self, user_id: int) -> Optional[restUser]:
+        ret = self._users.pop(user_id, None)
+        if ret is not None and ret.flooding:
+            self._nflood -= 1
+        return ret
+    def __len__(self):
+        return len(self._users)
+    def users(self) -> List[restUser]:
+        return list(self._users.values())
+
+    def __getstate__(self) -> tuple:
+        return (self._cver, self._chat_id, tuple(self._users.values()), self.fldmsg_id,
+                self.fldmsg_text, self.fldmsg_keyboard, self.fldmsg_shown)
+    def __setstate__(self, state) -> None:
+        if isinstance(state, dict):
+            # 0.0.2
+            users = [*state.get('_nfusers', dict()).values(), *state.get('_fldusers', dict()).values()]
+            state = (self.ver, state.get('_chat_id', None), users, state.get('fldmsg_id', None), None)
+        if len(state) == 5:
+            # 0.0.3, an old flooding captcha cannot be edited and is replaced by the next one
+            state = (self.ver, *state[1:4], '', (), 0)
+        elif len(state) == 8:
+            # 0.0.4, fldmsg_callbacks are ignored
+            state = (self.ver, *state[1:4], *state[5:])
+        (self._cver, self._chat_id, users, self.fldmsg_id,
+         self.fldmsg_text, self.fldmsg_keyboard, self.fldmsg_shown) = state
+        self._users = {u.user_id: u for u in users}
+        self._nflood = sum(1 for u in users if u.flooding)
+
+if __name__ == "__main__":
+    # memory benchmark: python3 usermanager.py [chats ...]
+    import sys
+    import pickle
+    import tracemalloc
+
+    class legacyRestUser:
+        def __init__(self, user_id, join_msgid, clg_msgid, uinvite_id, flooding=False, deadline=0.0):
+            self.user_id = user_id
+            self.join_msgid = join_msgid
+            self.clg_msgid = clg_msgid
+            self.uinvite_id = uinvite_id
+            self.flooding = flooding
+            self.time = int(time())
+            self.deadline = deadline
+    class legacyUserManager:
+        def __init__(self, chat_id):
+            self._cver = '0.0.2'
+            self._chat_id = chat_id
+            self._nfusers = dict()
+            self._fldusers = dict()
+            self.fldmsg_id = None
+            self.fldmsg_callbacks = [None, ]
+        def add(self, ruser):
+            (self._fldusers if ruser.flooding else self._nfusers)[ruser.user_id] = ruser
+
+    def measure(mgr_cls, user_cls, chats: int) -> tuple:
+        tracemalloc.start()
+        mgrs = [mgr_cls(-1000000000000 - n) for n in range(chats)]
+        idle = tracemalloc.get_traced_memory()[0]
+        for (n, m) in enumerate(mgrs):
+            m.add(user_cls(5000000000 + n, n + 1, n + 2, 6000000000 + n, deadline=time()))
+        pending = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        pickled = len(pickle.dumps(mgrs, protocol=pickle.HIGHEST_PROTOCOL))
+        return (idle / chats, (pending - idle) / chats, pickled / chats)
+
+    for chats in [int(a) for a in sys.argv[1:]] or (1000, 10000, 100000):
+        for (name, mgr_cls, user_cls) in (('0.0.2', legacyUserManager, legacyRestUser),
+                                          (UserManager(0).ver, UserManager, restUser)):
+            (idle, user, pickled) = measure(mgr_cls, user_cls, chats)
+            print(f"{chats:>7} chats {name}: {idle:6.0f} B per idle chat, {user:6.0f} B per pending user, "
+                  f"{pickled:5.0f} B pickled per chat with one user")
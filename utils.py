@@ -1,8 +1,10 @@
 import logging
 import sys
 import traceback
-from threading import Thread
+from threading import Thread, Lock
+from collections import OrderedDict
 from re import compile as re_compile
+from typing import Tuple
 logger = logging.getLogger('antispambot.utils')
 
 def print_traceback(debug: bool = False) -> None:
@@ -100,74 +102,179 @@ _CJKRE = __build_re()
 def find_cjk_letters(text: str) -> list:
     return _CJKRE.findall(text)
 
+# Шаблоны спама/рекламы: (признак, регулярное выражение).
+# Первый атом каждого шаблона (символ, экранированный символ или класс символов,
+# опционально после \b) выносится в префикс, по которому строится одно общее
+# выражение, поэтому сообщение сканируется один раз, а не по разу на шаблон.
+SPAM_PATTERNS = (
+    ('keyword', r'работа.{0,20}\d+\s*за'),
+    ('keyword', r'есть\s*работа'),
+    ('keyword', r'свяжитесь'),
+    ('keyword', r'смен[аы]'),
+    ('keyword', r'каждый день'),
+    ('keyword', r'заработ(а|о)к'),
+    ('keyword', r'подработк'),
+    ('keyword', r'деньги'),
+    ('keyword', r'выплаты'),
+    ('keyword', r'перевод(ы|ы)'),
+    ('keyword', r'вывод'),
+    ('keyword', r'ставк[аи]'),
+    ('keyword', r'казин[оа]'),
+    ('keyword', r'инвестиц'),
+    ('keyword', r'крипто'),
+    ('keyword', r'услуг[аи]'),
+    ('keyword', r'продам'),
+    ('keyword', r'куплю'),
+    ('keyword', r'реклама'),
+    ('keyword', r'подписк'),
+    ('keyword', r'подпишись'),
+    ('keyword', r'ссылка'),
+    ('link',    r'http[s]?://'),
+    ('link',    r't\.me/'),
+    ('mention', r'@\w{3,}'),
+    ('phone',   r'\+\d{7,}'),
+    ('phone',   r'\d\d{6,}'),  # телефоны
+    ('digits',  r'\d\d{3,}'),
+    ('keyword', r'\bjob\b'), ('keyword', r'\bwork\b'), ('keyword', r'\bearn\b'), ('keyword', r'\bcrypto\b'),
+    ('keyword', r'\bcasino\b'), ('keyword', r'\bbonus\b'), ('keyword', r'\bbet\b'),
+    ('keyword', r'\bfree\b'), ('keyword', r'\bsubscribe\b'), ('keyword', r'\bchannel\b'),
+    ('keyword', r'\bpromotion\b'), ('keyword', r'\bdiscount\b'),
+    ('keyword', r'\bguarantee\b'), ('keyword', r'\bguaranteed\b'),
+    ('keyword', r'\bоплата\b'), ('keyword', r'\bзарплата\b'),
+    ('keyword', r'\bдоставка\b'), ('keyword', r'\bакция\b'),
+    ('keyword', r'\bскидка\b'), ('keyword', r'\bвыигрыш\b'),
+    ('keyword', r'\bлотерея\b'), ('keyword', r'\bлотто\b'),
+    ('keyword', r'\bинвестиции\b'), ('keyword', r'\bинвестируй\b'),
+    ('keyword', r'\bставка\b'), ('keyword', r'\bставки\b'),
+    ('keyword', r'\bбот\b'), ('keyword', r'\bбота\b'),
+    ('keyword', r'\bботов\b'),
+    ('email',   r'[a-zA-Z0-9_.+-][a-zA-Z0-9_.+-]*@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+'),
+)
+
+def __split_lead(pattern: str) -> Tuple[str, str]:
+    wordbound = pattern.startswith(r'\b')
+    if wordbound:
+        pattern = pattern[2:]
+    if pattern.startswith('['):
+        n = pattern.index(']') + 1
+    elif pattern.startswith('\\'):
+        n = 2
+    else:
+        n = 1
+    lead, rest = pattern[:n], pattern[n:]
+    if wordbound:
+        # \b before a word character, checked after the lead has been consumed
+        rest = r'(?<!\w.)' + rest
+    return lead, rest
+
+def __build_spam_re():
+    # sre skips a branch at once if its first op is a literal or a charset
+    # which does not match the current character, so grouping the patterns
+    # by their lead costs about one comparison per lead for each position.
+    leads = dict()
+    for idx, (_, pattern) in enumerate(SPAM_PATTERNS):
+        lead, rest = __split_lead(pattern)
+        leads.setdefault(lead, list()).append(f'(?P<p{idx}>{rest})')
+    RE = '|'.join(f"{lead}(?:{'|'.join(alts)})" for lead, alts in leads.items())
+    return re_compile(RE)
+
+_SPAMRE = __build_spam_re()
+
+class SpamFeatures:
+    '''
+        Feature hits of a single scan over a message
+    '''
+    def __init__(self) -> None:
+        self.keywords = list()  # indexes in SPAM_PATTERNS
+        self.links = 0
+        self.mentions = 0
+        self.digit_runs = 0
+        self.phone = False
+        self.email = False
+    def add(self, idx: int) -> None:
+        feature = SPAM_PATTERNS[idx][0]
+        if feature == 'keyword':
+            self.keywords.append(idx)
+        elif feature == 'link':
+            self.links += 1
+        elif feature == 'mention':
+            self.mentions += 1
+        elif feature == 'digits':
+            self.digit_runs += 1
+        elif feature == 'phone':
+            self.digit_runs += 1
+            self.phone = True
+        elif feature == 'email':
+            self.email = True
+    def __str__(self) -> str:
+        hits = [SPAM_PATTERNS[idx][1] for idx in self.keywords]
+        for (name, count) in (('links', self.links), ('mentions', self.mentions), ('digit runs', self.digit_runs)):
+            if count:
+                hits.append(f'{name}: {count}')
+        hits.extend(name for (name, hit) in (('phone', self.phone), ('email', self.email)) if hit)
+        return ', '.join(hits)
+    @property
+    def is_spam(self) -> bool:
+        # each of the patterns is a spam indicator on its own
+        return bool(self.keywords or self.links or self.mentions or
+                    self.digit_runs or self.email)
+
+def scan_spam_features(text: str, stop_early: bool = False) -> SpamFeatures:
+    '''
+        Scan the message once and collect every feature hit.
+        With stop_early the scan ends on the first hit, the verdict is certain by then.
+    '''
+    features = SpamFeatures()
+    for m in _SPAMRE.finditer(text.lower()):
+        features.add(int(m.lastgroup[1:]))
+        if stop_early:
+            break
+    return features
+
 def is_spam_message(text: str) -> bool:
     """
     Проверяет, является ли сообщение спамом или рекламой по ключевым словам и шаблонам.
     Возвращает True, если сообщение похоже на спам/рекламу.
     """
-    import re
-    # Ключевые слова и фразы для поиска рекламы/спама
-    spam_keywords = [
-        r'работа.{0,20}\d+\s*за',
-        r'есть\s*работа',
-        r'свяжитесь',
-        r'смен[аы]',
-        r'каждый день',
-        r'заработ(а|о)к',
-        r'подработк',
-        r'деньги',
-        r'выплаты',
-        r'перевод(ы|ы)',
-        r'вывод',
-        r'ставк[аи]',
-        r'казин[оа]',
-        r'инвестиц',
-        r'крипто',
-        r'услуг[аи]',
-        r'продам',
-        r'куплю',
-        r'реклама',
-        r'подписк',
-        r'подпишись',
-        r'ссылка',
-        r'http[s]?://',
-        r't\.me/',
-        r'@\w{3,}',
-        r'\d{4,}',
-        r'\+?\d{7,}',  # телефоны
-        r'\bjob\b', r'\bwork\b', r'\bearn\b', r'\bcrypto\b',
-        r'\bcasino\b', r'\bbonus\b', r'\bbet\b',
-        r'\bfree\b', r'\bsubscribe\b', r'\bchannel\b',
-        r'\bpromotion\b', r'\bdiscount\b',
-        r'\bguarantee\b', r'\bguaranteed\b',
-        r'\bоплата\b', r'\bзарплата\b',
-        r'\bдоставка\b', r'\bакция\b',
-        r'\bскидка\b', r'\bвыигрыш\b',
-        r'\bлотерея\b', r'\bлотто\b',
-        r'\bинвестиции\b', r'\bинвестируй\b',
-        r'\bставка\b', r'\bставки\b',
-        r'\bбот\b', r'\bбота\b',
-        r'\bботов\b',
-    ]
-    text_l = text.lower()
-    for pattern in spam_keywords:
-        if re.search(pattern, text_l):
-            return True
-    # Эвристика: много ссылок
-    if len(re.findall(r'http[s]?://', text_l)) > 1:
-        return True
-    # Эвристика: много цифр и коротких слов
-    if len(re.findall(r'\d{4,}', text_l)) > 0 and len(text_l.split()) < 20:
-        return True
-    # Эвристика: подозрительные шаблоны (телефоны, email)
-    if re.search(r'\+?\d{7,}', text_l):
-        return True
-    if re.search(r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+', text_l):
-        return True
-    return False
+    return _SPAMRE.search(text.lower()) is not None
 
 # Новая функция для анализа имени пользователя через userfilter
-from userfilter import spam_score
+import userfilter
+
+class ScoreCache:
+    '''
+        Bounded LRU cache of userfilter.spam_score by (user_id, hash of the name).
+        A changed name gets a new key, the old entry is evicted eventually.
+        Call clear() after userfilter is reloaded.
+    '''
+    def __init__(self, maxsize: int = 65536) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+    def score(self, user_id: int, name: str) -> int:
+        key = (user_id, hash(name))
+        with self._lock:
+            score = self._cache.get(key, None)
+            if score is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return score
+            self.misses += 1
+        score = userfilter.spam_score(name)
+        with self._lock:
+            self._cache[key] = score
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return score
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+    def stats(self) -> dict:
+        return {'size': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+score_cache = ScoreCache()
 
 def is_suspect_user(user) -> bool:
     """
@@ -177,5 +284,33 @@ def is_suspect_user(user) -> bool:
     full_name = (user.full_name if hasattr(user, 'full_name') else '')
     if hasattr(user, 'username') and user.username:
         full_name += ' @' + user.username
-    score = spam_score(full_name)
+    score = score_cache.score(user.id, full_name)
     return score >= 80
+
+if __name__ == "__main__":
+    # benchmark: python3 utils.py [iterations]
+    from time import perf_counter
+    from re import search
+    corpus = [
+        'Привет всем! Кто-нибудь знает, когда будет следующая встреча?',
+        'Спасибо за помощь, после обновления пакета всё заработало',
+        'Hello everyone, how do I configure the logging module properly?',
+        'Does anyone have a working example of the inline keyboard?',
+        'Есть работа, 5000 за смену, пишите в личку',
+        'Free crypto bonus, subscribe to my channel https://t.me/spam',
+        'Звоните +79991234567 или пишите на info@example.com',
+        'Ок, понял, посмотрю вечером и отпишусь',
+    ]
+    patterns = [p for _, p in SPAM_PATTERNS]
+    def per_pattern(text: str) -> bool:
+        text_l = text.lower()
+        for p in patterns:
+            if search(p, text_l):
+                return True
+        return False
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for name, func in (('per-pattern search', per_pattern), ('single scan', is_spam_message)):
+        t = perf_counter()
+        for i in range(n):
+            func(corpus[i % len(corpus)])
+        print(f"{name}: {n / (perf_counter() - t):.0f} messages/sec")
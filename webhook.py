@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# Webhook mode: a small embedded HTTP receiver, updates are acknowledged at once
+# and stale ones are dropped from the raw JSON before any Update is built
+import logging
+logger = logging.getLogger('antispambot.webhook')
+
+import json
+import signal
+from hashlib import sha256
+from threading import Thread, Event
+from time import time
+from typing import Callable, Optional
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# updates older than this are not processed (see filter_old_updates in bot.py)
+MAX_UPDATE_AGE = 300
+# update types which carry the time they were sent; callback queries have none,
+# the date of their message is the date of the challenge, not of the click
+DATED_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                'my_chat_member', 'chat_member', 'chat_join_request')
+
+def raw_update_date(update: dict) -> Optional[int]:
+    for field in DATED_FIELDS:
+        obj = update.get(field, None)
+        if obj is not None:
+            return obj.get('edit_date', None) or obj.get('date', None)
+    return None
+
+def is_stale(update: dict, now: float = None, max_age: float = MAX_UPDATE_AGE) -> bool:
+    date = raw_update_date(update)
+    return date is not None and (time() if now is None else now) - date > max_age
+
+def secret_token(*keys: str) -> str:
+    '''
+        the X-Telegram-Bot-Api-Secret-Token of our webhook, derived from the config
+    '''
+    return sha256(''.join(keys).encode()).hexdigest()
+
+class WebhookReceiver:
+    '''
+        Accepts POSTs from Telegram on `path`, answers 200 before doing anything
+        else and hands every fresh update (a dict) to on_update in the request thread.
+    '''
+    def __init__(self, listen: str, port: int, path: str, secret: str,
+                 on_update: Callable[[dict], None], max_age: float = MAX_UPDATE_AGE) -> None:
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.on_update = on_update
+        self.max_age = max_age
+        self.received = 0
+        self.dropped = 0
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def _handler(self) -> type:
+        receiver = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, Telegram reuses connections
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+                if self.path != receiver.path or \
+                   self.headers.get('X-Telegram-Bot-Api-Secret-Token', '') != receiver.secret:
+                    self.send_response(403)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                self.wfile.flush()
+                receiver._received(body)
+            def log_message(self, *args) -> None:
+                pass
+        return Handler
+
+    def _received(self, body: bytes) -> None:
+        try:
+            update = json.loads(body)
+        except ValueError:
+            logger.error(f'Bad webhook body {body[:100]}')
+            return
+        self.received += 1
+        if is_stale(update, max_age=self.max_age):
+            self.dropped += 1
+            return
+        try:
+            self.on_update(update)
+        except Exception:
+            logger.exception(f'Cannot queue update {update.get("update_id", None)}')
+
+    def start(self) -> None:
+        self._server = ThreadingHTTPServer((self.listen, self.port), self._handler())
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, name='webhook', daemon=True).start()
+        logger.info(f'Webhook receiver on {self.listen}:{self.port}{self.path}')
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def stats(self) -> dict:
+        return {'received': self.received, 'dropped_stale': self.dropped}
+
+def set_webhook(bot, url: str, secret: str, allowed_updates: list, max_connections: int = 40) -> bool:
+    return bot.set_webhook(url=url, allowed_updates=allowed_updates, max_connections=max_connections,
+                           api_kwargs={'secret_token': secret})
+
+def webhook_path(url: str) -> str:
+    return urlsplit(url).path or '/'
+
+def serve(updater, receiver: WebhookReceiver) -> None:
+    '''
+        single process webhook mode, returns after SIGINT/SIGTERM
+    '''
+    stop = Event()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(sig, lambda *_: stop.set())
+    Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True).start()
+    receiver.start()
+    try:
+        while not stop.wait(1):
+            pass
+    finally:
+        receiver.stop()
+        updater.job_queue.stop()
+        updater.dispatcher.stop()
+        if updater.persistence:
+            updater.dispatcher.update_persistence()
+            updater.persistence.flush()
+        logger.info(f'Webhook receiver stopped, {receiver.stats()}')
+
+if __name__ == "__main__":
+    # ingest benchmark against long polling: python3 webhook.py [updates] [clients]
+    import sys
+    import http.client
+    from statistics import median
+    from threading import Lock
+    from time import perf_counter, sleep
+    from fakeapi import FakeBotAPI
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    (rate, samples) = (200, 400)  # latency is measured at a steady rate
+
+    api = FakeBotAPI(rate=0)
+    def update(n: int) -> dict:
+        with api._lock:
+            msg = api._message(-1000000000000 - n % 1000, 1000 + n, 'hello everyone')
+        return {'update_id': n, 'message': msg, '_sent': perf_counter()}
+
+    lock = Lock()
+    latencies = list()
+    done = Event()
+    state = {'expected': 0, 'seen': 0}
+    def seen(upd: dict) -> None:
+        with lock:
+            latencies.append(perf_counter() - upd['_sent'])
+            state['seen'] += 1
+            if state['seen'] >= state['expected']:
+                done.set()
+    def expect(n: int) -> None:
+        latencies.clear()
+        done.clear()
+        state.update(expected=n, seen=0)
+    def report(name: str, elapsed: float = None) -> None:
+        lat = sorted(latencies)
+        if elapsed is None:
+            print(f"{name:>8} latency: median {median(lat) * 1000:.2f} ms, p99 {lat[int(len(lat) * 0.99)] * 1000:.2f} ms")
+        else:
+            print(f"{name:>8} throughput: {len(lat) / elapsed:,.0f} updates/s")
+
+    # webhook: Telegram pushes every update in its own request
+    secret = secret_token('bench')
+    receiver = WebhookReceiver('127.0.0.1', 18443, '/hook', secret, seen)
+    receiver.start()
+    def push(ids: range, interval: float = 0) -> None:
+        conn = http.client.HTTPConnection('127.0.0.1', 18443)
+        for n in ids:
+            conn.request('POST', '/hook', json.dumps(update(n)),
+                         {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret})
+            conn.getresponse().read()
+            if interval:
+                sleep(interval)
+        conn.close()
+    expect(samples)
+    push(range(samples), 1 / rate)
+    done.wait()
+    report('webhook')
+    expect(total)
+    start = perf_counter()
+    threads = [Thread(target=push, args=(range(c, total, clients),)) for c in range(clients)]
+    for t in threads:
+        t.start()
+    done.wait()
+    report('webhook', perf_counter() - start)
+    stale = {'update_id': 0, 'message': {'date': int(time()) - 3600, 'chat': {'id': -1}, 'text': 'old'}}
+    start = perf_counter()
+    for _ in range(100000):
+        is_stale(stale)
+    print(f"{'':>8} stale check: {(perf_counter() - start) * 10:.3f} us per update")
+    receiver.stop()
+
+    # long polling: the bot asks for updates, Telegram answers as soon as there are some
+    server = api.serve(18081)
+    stop = Event()
+    def poll() -> None:
+        conn = http.client.HTTPConnection('127.0.0.1', 18081)
+        offset = 0
+        while not stop.is_set():
+            conn.request('POST', '/botX/getUpdates', json.dumps({'offset': offset, 'timeout': 1, 'limit': 100}),
+                         {'Content-Type': 'application/json'})
+            for upd in json.loads(conn.getresponse().read())['result']:
+                offset = upd['update_id'] + 1
+                if not is_stale(upd):
+                    seen(upd)
+        conn.close()
+    def produce(ids: range, interval: float = 0) -> None:
+        for n in ids:
+            upd = update(n)
+            with api._lock:
+                api._pending.append(upd)
+            if interval:
+                sleep(interval)
+    poller = Thread(target=poll)
+    poller.start()
+    expect(samples)
+    produce(range(1, samples + 1), 1 / rate)
+    done.wait()
+    report('polling')
+    expect(total)
+    produce(range(samples + 1, samples + total + 1))
+    start = perf_counter()
+    done.wait()
+    report('polling', perf_counter() - start)
+    stop.set()
+    poller.join()
+    server.shutdown()